@@ -7,10 +7,46 @@ For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import SyncToAsync, sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connections
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'XDrive.settings')
 
-application = get_asgi_application()
+
+class ReleasingASGIHandler(ASGIHandler):
+    """
+    Django's ASGI handler, letting go of a request's thread once its
+    response is ready.
+
+    Django runs the synchronous part of a request (middleware, views, the
+    ORM) in a thread of its own, which asgiref only shuts down after the
+    whole response has been sent, so every slow download would hold an
+    idle thread. Here the thread's database connections are closed and the
+    thread is joined before the body is streamed; the little synchronous
+    work left (closing the response) gets a new thread.
+    """
+
+    async def run_get_response(self, request):
+        response = await super().run_get_response(request)
+        context = SyncToAsync.thread_sensitive_context.get(None)
+        if context in SyncToAsync.context_to_thread_executor:
+            await sync_to_async(connections.close_all)()
+            executor = SyncToAsync.context_to_thread_executor.pop(context)
+            await asyncio.get_running_loop().run_in_executor(
+                None, executor.shutdown)
+        return response
+
+
+django.setup(set_prefix=False)
+application = ReleasingASGIHandler()
+
+# Serve static files in development, as runserver does.
+if settings.DEBUG:
+    application = ASGIStaticFilesHandler(application)
@@ -33,6 +33,111 @@ DEBUG = True
 ALLOWED_HOSTS = ['0.0.0.0', 'localhost']
 
 CHUNK_SIZE = 1024 * 1024 * 5  # 5MB
+# Chunk size negotiated with uploads that give their file_size
+# (upload/utils.py): chunks taking CHUNK_TARGET_SECONDS at the throughput
+# the client measured (CHUNK_SIZE if unknown), at most CHUNK_MAX_COUNT per
+# file, within CHUNK_SIZE_MIN-CHUNK_SIZE_MAX and a multiple of
+# CHUNK_SIZE_ALIGN.
+CHUNK_SIZE_MIN = 1024 * 256  # 256KB
+CHUNK_SIZE_MAX = 1024 * 1024 * 64  # 64MB
+CHUNK_SIZE_ALIGN = 1024 * 64  # 64KB
+CHUNK_TARGET_SECONDS = 4
+CHUNK_MAX_COUNT = 1000
+# Write the chunks of uploads with a negotiated chunk size straight into
+# their preallocated merged file when it is kept on local storage
+# (upload/assembly.py), so they need no merge pass.
+UPLOAD_PREALLOCATE = os.getenv('UPLOAD_PREALLOCATE', 'False') == 'True'
+# Chunk size limits of content-defined chunking (upload/chunking.py), the
+# same as in web/static/cdc.js. CDC_AVG_SIZE must be a power of two.
+CDC_MIN_SIZE = 1024 * 1024  # 1MB
+CDC_AVG_SIZE = 1024 * 1024 * 4  # 4MB
+CDC_MAX_SIZE = 1024 * 1024 * 8  # 8MB
+# Compress stored chunks: '' (off), 'auto' (zstd if installed, else zlib),
+# 'zlib', 'lzma' or 'zstd'. Chunks whose first bytes have more than
+# CHUNK_COMPRESSION_MAX_ENTROPY bits per byte are stored raw.
+CHUNK_COMPRESSION = os.getenv('CHUNK_COMPRESSION', '')
+CHUNK_COMPRESSION_MAX_ENTROPY = 7.5
+# Limits of the masterfile/batch endpoint, which stores many small files
+# in one request. Larger files have to be uploaded in chunks.
+BATCH_MAX_FILES = 1000
+BATCH_MAX_FILE_SIZE = CHUNK_SIZE
+MERGE_BUFFER_SIZE = 1024 * 1024  # 1MB, peak memory per merge
+# Recompute the whole-file digest while merging and compare it with
+# MasterFile.md5_checksum.
+MERGE_VERIFY_CHECKSUM = True
+# Merges run on a local pool of MERGE_WORKERS threads, started as soon as
+# the last chunk of a file arrives when MERGE_ON_COMPLETE is on.
+MERGE_ASYNC = os.getenv('MERGE_ASYNC', 'True') == 'True'
+MERGE_ON_COMPLETE = os.getenv('MERGE_ON_COMPLETE', 'True') == 'True'
+MERGE_WORKERS = int(os.getenv('MERGE_WORKERS', 2))
+MERGE_PROGRESS_STEP = 1024 * 1024 * 16  # 16MB between progress updates
+# A merge whose worker gave no sign of life for MERGE_CLAIM_TIMEOUT seconds
+# (e.g. the process was restarted) can be claimed again.
+MERGE_CLAIM_TIMEOUT = int(os.getenv('MERGE_CLAIM_TIMEOUT', 60 * 10))
+# Assemble merged files inside the store on storages that support it (S3)
+# instead of streaming the chunks through the worker.
+MERGE_COMPOSE = True
+# Page size of the list endpoints and the file list page, which clients
+# can lower or raise with ?page_size= up to LIST_MAX_PAGE_SIZE.
+LIST_PAGE_SIZE = 100
+LIST_MAX_PAGE_SIZE = 1000
+# Garbage collection (manage.py collect_garbage, see upload/cleanup.py), in
+# seconds: uploads untouched for GC_UPLOAD_MAX_AGE are deleted, chunks of
+# files merged GC_MERGED_CHUNK_AGE ago are dropped, and unused blobs and
+# files are only deleted once older than GC_GRACE_PERIOD. Sweeps handle
+# GC_BATCH_SIZE rows at a time and pause GC_BATCH_PAUSE between batches.
+GC_UPLOAD_MAX_AGE = int(os.getenv('GC_UPLOAD_MAX_AGE', 60 * 60 * 24 * 7))
+GC_MERGED_CHUNK_AGE = int(os.getenv('GC_MERGED_CHUNK_AGE', 60 * 60 * 24))
+GC_GRACE_PERIOD = int(os.getenv('GC_GRACE_PERIOD', 60 * 60))
+GC_BATCH_SIZE = 500
+GC_BATCH_PAUSE = 0.1
+# Upload sessions (see upload.sessions) are cached in each process, at most
+# UPLOAD_SESSION_LRU_SIZE of them for UPLOAD_SESSION_LOCAL_TTL seconds, and,
+# when UPLOAD_SESSION_CACHE names one of CACHES, shared between processes
+# for UPLOAD_SESSION_CACHE_TIMEOUT seconds. Session tokens are valid for
+# UPLOAD_SESSION_MAX_AGE seconds.
+UPLOAD_SESSION_LRU_SIZE = 10000
+UPLOAD_SESSION_LOCAL_TTL = 5
+UPLOAD_SESSION_CACHE = os.getenv('UPLOAD_SESSION_CACHE', '')
+UPLOAD_SESSION_CACHE_TIMEOUT = 60 * 10
+UPLOAD_SESSION_MAX_AGE = 60 * 60 * 24 * 7
+# Record request, upload, merge and download metrics, served in the
+# Prometheus text format at /metrics.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+DOWNLOAD_BUFFER_SIZE = 256 * 1024  # 256KB
+DOWNLOAD_MAX_RANGES = 16
+
+# Let the front-end server send downloaded files: '' (Django streams them),
+# 'x-accel-redirect' (nginx, internal location at DOWNLOAD_OFFLOAD_PREFIX
+# aliased to MEDIA_ROOT) or 'x-sendfile' (Apache/lighttpd).
+DOWNLOAD_OFFLOAD = os.getenv('DOWNLOAD_OFFLOAD', '')
+DOWNLOAD_OFFLOAD_PREFIX = os.getenv('DOWNLOAD_OFFLOAD_PREFIX',
+                                    '/protected/media/')
+# Lifetime in seconds of the presigned URLs downloads are redirected to on
+# S3 storage.
+DOWNLOAD_URL_EXPIRE = int(os.getenv('DOWNLOAD_URL_EXPIRE', 3600))
+# Lifetime in seconds of the URLs clients upload chunks to directly.
+UPLOAD_URL_EXPIRE = int(os.getenv('UPLOAD_URL_EXPIRE', 3600))
+
+# Where chunks and merged files are stored: 'local' (MEDIA_ROOT) or 's3',
+# an S3-compatible bucket through django-storages. For MinIO set
+# AWS_S3_ENDPOINT_URL; credentials come from the usual AWS_* variables.
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+if STORAGE_BACKEND == 's3':
+    STORAGES = {
+        'default': {
+            'BACKEND': 'storages.backends.s3boto3.S3Boto3Storage',
+        },
+        'staticfiles': {
+            'BACKEND': 'django.contrib.staticfiles.storage.'
+                       'StaticFilesStorage',
+        },
+    }
+    AWS_STORAGE_BUCKET_NAME = os.getenv('AWS_STORAGE_BUCKET_NAME', 'xdrive')
+    AWS_S3_ENDPOINT_URL = os.getenv('AWS_S3_ENDPOINT_URL') or None
+    AWS_S3_REGION_NAME = os.getenv('AWS_S3_REGION_NAME') or None
+    AWS_S3_FILE_OVERWRITE = False
+    AWS_QUERYSTRING_EXPIRE = DOWNLOAD_URL_EXPIRE
 
 # Application definition
 MEDIA_URL = '/media/'
@@ -47,6 +152,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'rest_framework',
+    'django_filters',
     'django_cypress',
     'drf_yasg',
     'upload',
@@ -55,6 +161,7 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    'upload.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -96,6 +203,21 @@ DATABASES = {
     )
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by every process: Redis when REDIS_URL is set (needs the redis
+    # package), else a table created by `python manage.py createcachetable`.
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL'),
+    } if os.getenv('REDIS_URL') else {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'xdrive_cache',
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -21,6 +21,8 @@ from drf_yasg import openapi
 from django.conf import settings
 from rest_framework import permissions
 
+from upload.metrics import metrics_view
+
 schema_view = get_schema_view(
     openapi.Info(
         title="XDrive API",
@@ -46,6 +48,8 @@ urlpatterns = [
     path('docs/', schema_view.with_ui('swagger', cache_timeout=0),
          name='schema-swagger-ui'),
 
+    path('metrics', metrics_view, name='metrics'),
+
 ]+static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
 if settings.DEBUG:
@@ -0,0 +1,12 @@
+"""
+Performance benchmarks for the upload pipeline.
+
+They are regular Django test cases kept out of the default test run by
+their ``bench_*.py`` file names. Run them with::
+
+    python manage.py test benchmarks --pattern="bench_*.py"
+
+Results are stored as JSON by ``benchmarks.results``, compared across
+runs by ``benchmarks.compare``, and ``benchmarks.loadgen`` puts a running
+server under load.
+"""
@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.client import FakePayload, encode_multipart
+from django.urls import reverse
+
+from upload import merge
+from upload.models import ChunkedFile, MasterFile
+from XDrive.asgi import application
+
+CLIENTS = int(os.getenv('BENCH_ASYNC_CLIENTS', '2000'))
+CLIENT_SECONDS = float(os.getenv('BENCH_ASYNC_CLIENT_SECONDS', '2'))
+WSGI_WORKERS = int(os.getenv('BENCH_ASYNC_WSGI_WORKERS', '8'))
+FILE_SIZE = 1024 * 1024
+CHUNK_SIZE = 256 * 1024
+# Number of pieces each slow client sends or reads its body in.
+PIECES = 16
+BOUNDARY = 'BenchBoundary'
+
+
+class SlowClient:
+    """
+    An ASGI client sending its request body, or reading a ``FILE_SIZE``
+    response, in ``PIECES`` pieces spread over ``CLIENT_SECONDS``.
+    """
+
+    def __init__(self, method, path, query='', body=b'', content_type=None):
+        headers = [(b'host', b'testserver')]
+        if content_type:
+            headers += [(b'content-type', content_type.encode()),
+                        (b'content-length', str(len(body)).encode())]
+        self.scope = {
+            'type': 'http', 'asgi': {'version': '3.0'},
+            'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'raw_path': path.encode(), 'root_path': '',
+            'query_string': query.encode(), 'headers': headers,
+            'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+        }
+        size = -(-len(body) // PIECES) or 1
+        self.pieces = [body[n:n + size] for n in range(0, len(body), size)] \
+            or [b'']
+        self.delay = CLIENT_SECONDS / PIECES
+        self.status = None
+        self.received = 0
+        self.complete = False
+
+    async def run(self):
+        await application(self.scope, self.receive, self.send)
+        return self
+
+    async def receive(self):
+        if not self.pieces:
+            # Stay connected until the response has been sent.
+            await asyncio.Event().wait()
+        body = self.pieces.pop(0)
+        if body:
+            await asyncio.sleep(self.delay)
+        return {'type': 'http.request', 'body': body,
+                'more_body': bool(self.pieces)}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.status = message['status']
+            return
+        self.complete = not message.get('more_body', False)
+        if message.get('body'):
+            self.received += len(message['body'])
+            await asyncio.sleep(self.delay * len(message['body']) /
+                                (FILE_SIZE / PIECES))
+
+    @property
+    def in_flight(self):
+        """
+        Whether the request or response body is on its way, when the server
+        should hold no thread for the client.
+        """
+        return bool(self.pieces) or (self.status is not None and
+                                     not self.complete)
+
+
+@override_settings(MERGE_ASYNC=False, MERGE_ON_COMPLETE=False)
+class AsyncEndpointBenchmark(TransactionTestCase):
+    """
+    Serves ``BENCH_ASYNC_CLIENTS`` slow clients at once (uploading a chunk
+    or downloading a file, each taking ``BENCH_ASYNC_CLIENT_SECONDS``)
+    through the ASGI application and the asynchronous endpoints, and
+    compares the rate with the synchronous download endpoint on a WSGI
+    server with ``BENCH_ASYNC_WSGI_WORKERS`` worker threads, where every
+    slow client holds a worker.
+
+    Under ASGI a request only holds a thread while its synchronous code
+    runs: the thread count is checked never to exceed the requests
+    between their bodies plus the event loop's shared executor, whatever
+    the number of slow clients.
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_override.enable()
+        content = os.urandom(FILE_SIZE)
+        self.download = MasterFile.objects.create(
+            file_name='download.bin',
+            md5_checksum=hashlib.md5(content).hexdigest(),
+            number_of_chunks=1)
+        chunk = ChunkedFile(master_file=self.download, chunk_number=0,
+                            md5_checksum=self.download.md5_checksum)
+        chunk.file.save('chunk', ContentFile(content), save=False)
+        chunk.save()
+        merge.merge_chunks(self.download)
+        self.upload = MasterFile.objects.create(
+            file_name='upload.bin', md5_checksum='',
+            number_of_chunks=CLIENTS)
+        self.chunk = os.urandom(CHUNK_SIZE)
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload_client(self, number):
+        body = encode_multipart(BOUNDARY, {
+            'master_file': self.upload.id,
+            'file': ContentFile(self.chunk, name=f'chunk-{number}'),
+            'chunk_number': number,
+            'md5_checksum': hashlib.md5(self.chunk).hexdigest(),
+        })
+        return SlowClient('POST', reverse('async-chunkedfile-list'),
+                          body=body, content_type='multipart/form-data; '
+                                                  f'boundary={BOUNDARY}')
+
+    def download_client(self):
+        return SlowClient('GET',
+                          reverse('async-chunkedfile-download-file'),
+                          urlencode({'master_file_id': self.download.id}))
+
+    def serve_asgi(self, uploads=True):
+        clients = [self.upload_client(n) if uploads and n % 2
+                   else self.download_client() for n in range(CLIENTS)]
+        peak_threads = extra_threads = threading.active_count()
+
+        async def serve():
+            nonlocal peak_threads, extra_threads
+            tasks = [asyncio.ensure_future(client.run())
+                     for client in clients]
+            while not all(task.done() for task in tasks):
+                threads = threading.active_count()
+                peak_threads = max(peak_threads, threads)
+                # Threads not accounted for by a request running
+                # synchronous code (neither body is in flight).
+                extra_threads = max(extra_threads, threads - sum(
+                    not task.done() and not client.in_flight
+                    for client, task in zip(clients, tasks)))
+                await asyncio.sleep(0.05)
+            return [task.result() for task in tasks]
+
+        started = time.perf_counter()
+        clients = asyncio.run(serve())
+        elapsed = time.perf_counter() - started
+        for client in clients:
+            self.assertIn(client.status, (200, 201))
+        downloads = [client for client in clients
+                     if client.scope['method'] == 'GET']
+        self.assertTrue(all(client.received == FILE_SIZE
+                            for client in downloads))
+        self.assertEqual(ChunkedFile.objects.filter(
+            master_file=self.upload).count(), CLIENTS - len(downloads))
+        return elapsed, peak_threads, extra_threads
+
+    def serve_wsgi(self, clients):
+        handler = WSGIHandler()
+        query = urlencode({'master_file_id': self.download.id})
+        delay = CLIENT_SECONDS / PIECES
+
+        def client(_):
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': reverse(
+                    'chunkedfile-download-file'),
+                'QUERY_STRING': query, 'SERVER_NAME': 'testserver',
+                'SERVER_PORT': '80', 'wsgi.input': FakePayload(b''),
+                'wsgi.url_scheme': 'http',
+            }
+            response = handler(environ, lambda status, headers: None)
+            received = 0
+            for part in response:
+                received += len(part)
+                # The worker thread waits for the slow client to read.
+                time.sleep(delay * len(part) / (FILE_SIZE / PIECES))
+            response.close()
+            return received
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(WSGI_WORKERS) as workers:
+            received = list(workers.map(client, range(clients)))
+        self.assertEqual(received, [FILE_SIZE] * clients)
+        return time.perf_counter() - started
+
+    def test_slow_clients(self):
+        # SQLite's in-memory test database locks whole tables, failing
+        # concurrent writes: uploads need PostgreSQL.
+        uploads = connection.vendor != 'sqlite'
+        idle_threads = threading.active_count()
+        elapsed, peak_threads, extra_threads = self.serve_asgi(uploads)
+        # The main thread and asyncio's default executor, which reads
+        # downloads, may run beside the requests' own threads.
+        self.assertLessEqual(
+            extra_threads, idle_threads + min(32, os.cpu_count() + 4))
+        wsgi_clients = WSGI_WORKERS * 2
+        wsgi_elapsed = self.serve_wsgi(wsgi_clients)
+
+        if not uploads:
+            print('\nuploads skipped: SQLite cannot write concurrently')
+        print(f'\nasgi: {CLIENTS} slow clients in {elapsed:.1f}s '
+              f'({CLIENTS / elapsed:.0f} clients/s, peak {peak_threads} '
+              f'threads, at most {extra_threads} besides requests running '
+              f'synchronous code)')
+        print(f'wsgi: {wsgi_clients} slow clients in {wsgi_elapsed:.1f}s '
+              f'({wsgi_clients / wsgi_elapsed:.1f} clients/s, '
+              f'{WSGI_WORKERS} workers)')
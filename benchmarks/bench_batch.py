@@ -0,0 +1,76 @@
+import hashlib
+import io
+import os
+import tarfile
+import shutil
+import tempfile
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+FILES = int(os.getenv('BENCH_BATCH_FILES', '200'))
+FILE_SIZE = 20 * 1024
+
+
+@override_settings(MERGE_ASYNC=False)
+class BatchUploadBenchmark(TestCase):
+    """
+    Compares the rate at which small files are stored one by one (master
+    file, chunk upload and merge) and through a single ``batch`` request
+    of a tar archive.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_override.enable()
+        self.files = {f'file-{n}.txt': os.urandom(FILE_SIZE // 2).hex()
+                      .encode() for n in range(FILES)}
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload_one_by_one(self):
+        for name, content in self.files.items():
+            checksum = hashlib.md5(content).hexdigest()
+            master_file = self.client.post(reverse('masterfile-list'), {
+                'file_name': name, 'md5_checksum': checksum,
+                'number_of_chunks': 1}, format='json').data
+            self.client.post(reverse('chunkedfile-list'), {
+                'master_file': master_file['id'],
+                'file': SimpleUploadedFile(name, content),
+                'chunk_number': 0, 'md5_checksum': checksum,
+                'uploaded_at': timezone.now()}, format='multipart')
+
+    def upload_batch(self):
+        # Multipart bodies are limited to DATA_UPLOAD_MAX_NUMBER_FILES files,
+        # larger batches are sent as a tar archive.
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as archive:
+            for name, content in self.files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        response = self.client.post(reverse('masterfile-batch'),
+                                    buffer.getvalue(),
+                                    content_type='application/x-tar')
+        self.assertEqual(response.status_code, 201)
+
+    def rate(self, upload):
+        started = time.perf_counter()
+        upload()
+        return FILES / (time.perf_counter() - started)
+
+    def test_ingestion_rate(self):
+        one_by_one = self.rate(self.upload_one_by_one)
+        batch = self.rate(self.upload_batch)
+        print(f'\n{FILES} files of {FILE_SIZE // 1024} KB: one by one '
+              f'{one_by_one:.0f} files/s, batch {batch:.0f} files/s '
+              f'({batch / one_by_one:.1f}x)')
+        self.assertGreater(batch, one_by_one)
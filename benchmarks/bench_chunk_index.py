@@ -0,0 +1,81 @@
+import os
+import statistics
+import time
+
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from upload.models import ChunkedFile, MasterFile
+
+SIZES = [int(size) for size in
+         os.getenv('BENCH_CHUNK_COUNTS', '1000,10000,100000').split(',')]
+REPEAT = 25
+SORT_MARKERS = ('TEMP B-TREE', 'Sort ', 'Sort\n', 'filesort')
+
+
+class ChunkIndexBenchmark(TestCase):
+    """
+    Times ``last-chunk`` and the merge ordering on master files with a
+    growing number of chunks, next to an equally large unrelated master
+    file, and checks that both queries walk the
+    ``(master_file, chunk_number)`` index instead of sorting.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.master_files = {}
+        for count in SIZES:
+            cls.master_files[count] = cls.create_master_file(count)
+            cls.create_master_file(count)
+
+    @classmethod
+    def create_master_file(cls, count):
+        master_file = MasterFile.objects.create(
+            file_name=f'bench-{count}.bin', md5_checksum='',
+            number_of_chunks=count)
+        ChunkedFile.objects.bulk_create(
+            (ChunkedFile(master_file=master_file, chunk_number=number,
+                         file=f'chunked_files/bench-{number}', size=1)
+             for number in range(count)), batch_size=5000)
+        return master_file
+
+    def setUp(self):
+        self.client = APIClient()
+        self.last_chunk_url = reverse('chunkedfile-last-chunk')
+
+    def median_time(self, func):
+        timings = []
+        for _ in range(REPEAT):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
+
+    def assert_uses_index(self, queryset):
+        plan = queryset.explain()
+        for marker in SORT_MARKERS:
+            self.assertNotIn(marker, plan)
+
+    def test_last_chunk(self):
+        print('\nlast-chunk')
+        timings = {}
+        for count, master_file in self.master_files.items():
+            url = f'{self.last_chunk_url}?master_file_id={master_file.id}'
+            timings[count] = self.median_time(lambda: self.client.get(url))
+            print(f'  {count:>8} chunks  {timings[count] * 1000:>8.2f} ms')
+            self.assert_uses_index(ChunkedFile.objects.filter(
+                master_file=master_file).order_by('-chunk_number')[:1])
+        self.assertLess(timings[SIZES[-1]], 10 * timings[SIZES[0]])
+
+    def test_merge_ordering(self):
+        print('\nmerge ordering, first 100 chunks')
+        timings = {}
+        for count, master_file in self.master_files.items():
+            chunks = ChunkedFile.objects.filter(
+                master_file=master_file).order_by('chunk_number')
+            timings[count] = self.median_time(
+                lambda: list(chunks.values_list('id')[:100]))
+            print(f'  {count:>8} chunks  {timings[count] * 1000:>8.2f} ms')
+            self.assert_uses_index(chunks)
+        self.assertLess(timings[SIZES[-1]], 10 * timings[SIZES[0]])
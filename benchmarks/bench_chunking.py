@@ -0,0 +1,65 @@
+import io
+import os
+import random
+import time
+
+from django.test import SimpleTestCase
+
+from upload import chunking
+
+SIZE_MB = int(os.getenv('BENCH_CDC_SIZE_MB', '32'))
+EDITS = int(os.getenv('BENCH_CDC_EDITS', '4'))
+
+
+def fixed_chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def cdc_chunks(data):
+    return list(chunking.iter_chunks(io.BytesIO(data)))
+
+
+class ChunkingBenchmark(SimpleTestCase):
+    """
+    Measures content-defined chunking throughput and how much of an
+    edited copy of a file deduplicates against the original with fixed
+    and with content-defined chunk boundaries.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = random.Random(0)
+        cls.original = rng.randbytes(SIZE_MB * 1024 * 1024)
+        edited = bytearray(cls.original)
+        # Insert a few bytes at random places, as editing a document does.
+        for offset in sorted(rng.sample(range(len(edited)), EDITS),
+                             reverse=True):
+            edited[offset:offset] = rng.randbytes(rng.randint(1, 64))
+        cls.edited = bytes(edited)
+
+    def dedup_ratio(self, split):
+        # Share of the edited copy's bytes already stored by the original.
+        stored = set(split(self.original))
+        edited = split(self.edited)
+        reused = sum(len(chunk) for chunk in edited if chunk in stored)
+        return reused / len(self.edited)
+
+    def test_throughput(self):
+        started = time.perf_counter()
+        boundaries = chunking.chunk_boundaries(io.BytesIO(self.original))
+        elapsed = time.perf_counter() - started
+        print(f'\ncontent-defined chunking of {SIZE_MB} MB: '
+              f'{SIZE_MB / elapsed:.1f} MB/s, {len(boundaries)} chunks, '
+              f'average {len(self.original) / len(boundaries) / 2 ** 20:.2f}'
+              f' MB')
+        self.assertEqual(boundaries[-1], len(self.original))
+        chunking.validate_boundaries(boundaries)
+
+    def test_dedup_ratio(self):
+        average = chunking.get_sizes()[1]
+        fixed = self.dedup_ratio(lambda data: fixed_chunks(data, average))
+        cdc = self.dedup_ratio(cdc_chunks)
+        print(f'\nbytes reused after {EDITS} insertions: '
+              f'fixed {fixed:.1%}, content-defined {cdc:.1%}')
+        self.assertGreater(cdc, fixed)
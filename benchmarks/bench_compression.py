@@ -0,0 +1,72 @@
+import io
+import os
+import random
+import time
+
+from django.test import SimpleTestCase
+
+from upload import compression
+
+SIZE_MB = int(os.getenv('BENCH_COMPRESSION_SIZE_MB', '16'))
+
+
+def csv_data(size):
+    rng = random.Random(0)
+    rows = []
+    length = 0
+    while length < size:
+        row = f'{len(rows)},2024-{rng.randint(1, 12):02d}-' \
+              f'{rng.randint(1, 28):02d},user{rng.randint(1, 500)},' \
+              f'{rng.choice(["GET", "POST", "PUT"])},/api/files/' \
+              f'{rng.randint(1, 10 ** 6)},{rng.random() * 100:.3f}\n'
+        rows.append(row)
+        length += len(row)
+    return ''.join(rows).encode()[:size]
+
+
+class CompressionBenchmark(SimpleTestCase):
+    """
+    Measures the ratio and compression/decompression throughput of every
+    available chunk codec on log-like text and on random (already
+    compressed) data, and how fast the entropy probe rejects the latter.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        size = SIZE_MB * 1024 * 1024
+        cls.samples = {
+            'csv': csv_data(size),
+            'random': random.Random(0).randbytes(size),
+        }
+
+    def test_codecs(self):
+        print()
+        for label, data in self.samples.items():
+            for codec in compression.available_codecs():
+                if codec == compression.NONE:
+                    continue
+                compressed = io.BytesIO()
+                started = time.perf_counter()
+                with compression.compressor(codec, compressed) as writer:
+                    writer.write(data)
+                packed = time.perf_counter() - started
+                compressed.seek(0)
+                started = time.perf_counter()
+                restored = compression.decompressor(codec, compressed).read()
+                unpacked = time.perf_counter() - started
+                self.assertEqual(restored, data)
+                print(f'{label:>6} {codec:>4}: ratio '
+                      f'{len(data) / compressed.tell():6.2f}, '
+                      f'compress {SIZE_MB / packed:7.1f} MB/s, '
+                      f'decompress {SIZE_MB / unpacked:7.1f} MB/s')
+
+    def test_probe(self):
+        sample = self.samples['random'][:compression.PROBE_SIZE]
+        started = time.perf_counter()
+        compressible = compression.entropy(sample)
+        elapsed = time.perf_counter() - started
+        print(f'\nentropy probe of {len(sample) // 1024} KB: '
+              f'{elapsed * 1000:.2f} ms ({compressible:.3f} bits/byte)')
+        self.assertLess(elapsed, 1)
+        self.assertGreater(compressible, 7.9)
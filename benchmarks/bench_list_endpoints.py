@@ -0,0 +1,106 @@
+import os
+import statistics
+import time
+from datetime import timedelta
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from upload.models import ChunkedFile, MasterFile
+from upload.pagination import ORDERING, encode_cursor
+
+SIZES = [int(size) for size in
+         os.getenv('BENCH_LIST_SIZES', '1000,10000,100000').split(',')]
+REPEAT = 25
+SORT_MARKERS = ('TEMP B-TREE', 'Sort ', 'Sort\n', 'filesort')
+
+
+class ListEndpointBenchmark(TestCase):
+    """
+    Times the first and a deep page of the chunk list endpoint, over all
+    chunks and filtered by master file, as the table grows, and checks
+    that every page costs the same number of queries and walks the
+    ``(uploaded_at, id)`` indexes instead of sorting.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.master_files = {}
+        start = timezone.now()
+        for count in SIZES:
+            master_file = MasterFile.objects.create(
+                file_name=f'bench-{count}.bin', md5_checksum='',
+                number_of_chunks=count)
+            ChunkedFile.objects.bulk_create(
+                (ChunkedFile(master_file=master_file, chunk_number=number,
+                             file=f'chunked_files/bench-{number}', size=1)
+                 for number in range(count)), batch_size=5000)
+            # Spread the chunks over time, a few to each timestamp.
+            for number in range(0, count, 5000):
+                ChunkedFile.objects.filter(
+                    master_file=master_file,
+                    chunk_number__gte=number,
+                    chunk_number__lt=number + 5000,
+                ).update(uploaded_at=start - timedelta(seconds=number // 3))
+            cls.master_files[count] = master_file
+
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('chunkedfile-list')
+
+    def median_time(self, func):
+        timings = []
+        for _ in range(REPEAT):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
+
+    def deep_cursor(self, queryset):
+        # Cursor of the page starting halfway through the rows.
+        return encode_cursor(
+            queryset.order_by(*ORDERING)[queryset.count() // 2])
+
+    def assert_uses_index(self, queryset):
+        plan = queryset.order_by(*ORDERING)[:100].explain()
+        for marker in SORT_MARKERS:
+            self.assertNotIn(marker, plan)
+
+    def check_pages(self, label, params):
+        print(f'\n{label}')
+        timings, query_counts = {}, set()
+        for count, master_file in self.master_files.items():
+            page_params = params(master_file)
+            for page in ('first', 'deep'):
+                if page == 'deep':
+                    queryset = ChunkedFile.objects.filter(
+                        master_file=master_file)
+                    page_params = {**page_params,
+                                   'cursor': self.deep_cursor(queryset)}
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(self.url, page_params)
+                self.assertEqual(response.status_code, 200)
+                query_counts.add(len(queries))
+                elapsed = self.median_time(
+                    lambda: self.client.get(self.url, page_params))
+                timings[count, page] = elapsed
+                print(f'  {count:>8} chunks  {page:>5} page '
+                      f'{elapsed * 1000:>8.2f} ms')
+        self.assertEqual(len(query_counts), 1)
+        for page in ('first', 'deep'):
+            self.assertLess(timings[SIZES[-1], page],
+                            10 * timings[SIZES[0], page])
+
+    def test_all_chunks(self):
+        self.check_pages('chunk list', lambda master_file: {})
+        self.assert_uses_index(ChunkedFile.objects.all())
+
+    def test_chunks_of_master_file(self):
+        self.check_pages('chunk list of one master file',
+                         lambda master_file: {'master_file': master_file.id})
+        self.assert_uses_index(ChunkedFile.objects.filter(
+            master_file=self.master_files[SIZES[-1]]))
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+
+from upload import merge
+from upload.models import ChunkedFile, MasterFile
+
+MB = 1024 * 1024
+CHUNK_SIZE = 5 * MB
+BUFFER_SIZE = 1 * MB
+SIZES_MB = [int(size) for size in
+            os.getenv('BENCH_MERGE_SIZES_MB', '16,64,256').split(',')]
+
+
+class MergeMemoryBenchmark(TestCase):
+    """
+    Merges files of growing size and checks that the peak memory allocated
+    by the merge stays bounded by the buffer size, not by the file size.
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_override.enable()
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_master_file(self, size):
+        master_file = MasterFile.objects.create(
+            file_name=f'bench-{size}.bin', md5_checksum='',
+            number_of_chunks=-(-size // CHUNK_SIZE))
+        block = os.urandom(CHUNK_SIZE)
+        md5 = hashlib.md5()
+        for number in range(master_file.number_of_chunks):
+            chunk = ChunkedFile(master_file=master_file, chunk_number=number)
+            length = min(CHUNK_SIZE, size - number * CHUNK_SIZE)
+            chunk.file.save(f'bench-{number}', ContentFile(block[:length]))
+            md5.update(block[:length])
+        master_file.md5_checksum = md5.hexdigest()
+        master_file.save()
+        return master_file
+
+    def measure(self, master_file):
+        tracemalloc.start()
+        started = time.perf_counter()
+        size = merge.merge_chunks(master_file, buffer_size=BUFFER_SIZE,
+                                  verify=self.verify)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size, elapsed, peak
+
+    def run_sizes(self, label):
+        print(f'\n{label}: buffer {BUFFER_SIZE // 1024} KB')
+        for size_mb in SIZES_MB:
+            master_file = self.create_master_file(size_mb * MB)
+            size, elapsed, peak = self.measure(master_file)
+            print(f'  {size_mb:>6} MB  {size / MB / elapsed:>8.1f} MB/s  '
+                  f'peak {peak / 1024:>8.1f} KB')
+            self.assertEqual(size, size_mb * MB)
+            self.assertLess(peak, 2 * BUFFER_SIZE)
+
+    def test_kernel_copy_merge(self):
+        self.verify = False
+        self.run_sizes('kernel copy')
+
+    def test_buffered_merge(self):
+        self.verify = False
+        with mock.patch.object(merge, 'kernel_copy', return_value=None):
+            self.run_sizes('buffered copy')
+
+    def test_verified_merge(self):
+        self.verify = True
+        self.run_sizes('buffered copy + md5 verification')
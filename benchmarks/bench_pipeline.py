@@ -0,0 +1,184 @@
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import skipIf
+
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from benchmarks.results import MB_PER_SECOND, record
+from upload import merge
+from upload.models import ChunkedFile, MasterFile
+
+MB = 1024 * 1024
+ROUNDS = int(os.getenv('BENCH_PIPELINE_ROUNDS', '50'))
+CHUNK_SIZE = int(os.getenv('BENCH_PIPELINE_CHUNK_KB', '1024')) * 1024
+SIZES_MB = [int(size) for size in
+            os.getenv('BENCH_PIPELINE_SIZES_MB', '4,16,64').split(',')]
+CLIENTS = int(os.getenv('BENCH_PIPELINE_CLIENTS', '8'))
+RANGE_SIZE = 64 * 1024
+
+
+class PipelineMixin:
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_override.enable()
+        self.block = os.urandom(CHUNK_SIZE)
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        super().tearDown()
+
+    def chunk(self, number):
+        # Different bytes per chunk, so none deduplicates.
+        return number.to_bytes(8, 'big') + self.block[8:]
+
+    def post_chunk(self, client, master_file, number):
+        chunk = self.chunk(number)
+        return client.post(reverse('chunkedfile-list'), {
+            'master_file': master_file.id,
+            'file': SimpleUploadedFile(f'chunk-{number}', chunk),
+            'chunk_number': number,
+            'md5_checksum': hashlib.md5(chunk).hexdigest(),
+        }, format='multipart')
+
+    def create_master_file(self, number_of_chunks):
+        return MasterFile.objects.create(
+            file_name='bench.bin', md5_checksum='',
+            number_of_chunks=number_of_chunks)
+
+    def create_chunks(self, size):
+        """A master file of ``size`` bytes with all its chunks stored."""
+        master_file = self.create_master_file(-(-size // CHUNK_SIZE))
+        md5 = hashlib.md5()
+        for number in range(master_file.number_of_chunks):
+            content = self.chunk(number)[:size - number * CHUNK_SIZE]
+            chunk = ChunkedFile(master_file=master_file, chunk_number=number)
+            chunk.file.save(f'bench-{number}', ContentFile(content))
+            md5.update(content)
+        MasterFile.objects.filter(pk=master_file.pk).update(
+            md5_checksum=md5.hexdigest())
+        master_file.refresh_from_db()
+        return master_file
+
+
+@override_settings(MERGE_ASYNC=False, MERGE_ON_COMPLETE=False)
+class PipelineBenchmark(PipelineMixin, TestCase):
+    """
+    Micro-benchmarks of the upload pipeline: chunk POST latency, merge
+    throughput by file size, and the throughput of full downloads and the
+    latency of ``Range`` requests, of merged files and of files served
+    from their chunks. Results are added to ``BENCH_RESULTS``.
+    """
+
+    def report(self, name, samples, **kwargs):
+        summary = record(f'pipeline.{name}', samples, **kwargs)
+        print(f'  {name:<40} median {summary["median"]:>10.4f} '
+              f'{summary["unit"]:<5} p95 {summary["p95"]:>10.4f}')
+
+    def download(self, master_file, **headers):
+        response = self.client.get(
+            f"{reverse('chunkedfile-download-file')}"
+            f"?master_file_id={master_file.id}", headers=headers)
+        size = sum(len(part) for part in response.streaming_content)
+        response.close()
+        return response.status_code, size
+
+    def test_chunk_post_latency(self):
+        print(f'\nchunk POST, {CHUNK_SIZE // 1024} KB chunks')
+        master_file = self.create_master_file(ROUNDS)
+        timings = []
+        for number in range(ROUNDS):
+            started = time.perf_counter()
+            response = self.post_chunk(self.client, master_file, number)
+            timings.append(time.perf_counter() - started)
+            self.assertEqual(response.status_code, 201)
+        self.report('chunk_post', timings, chunk_size=CHUNK_SIZE)
+
+    def test_merge_throughput(self):
+        print('\nmerge')
+        for size_mb in SIZES_MB:
+            master_file = self.create_chunks(size_mb * MB)
+            started = time.perf_counter()
+            size = merge.merge_chunks(master_file)
+            elapsed = time.perf_counter() - started
+            self.assertEqual(size, size_mb * MB)
+            self.report(f'merge_{size_mb}mb', [size / MB / elapsed],
+                        unit=MB_PER_SECOND, higher_is_better=True)
+
+    def test_download_throughput(self):
+        size = SIZES_MB[-1] * MB
+        from_chunks = self.create_chunks(size)
+        merged = self.create_chunks(size)
+        merge.merge_chunks(merged)
+        print(f'\ndownload, {SIZES_MB[-1]} MB')
+        for label, master_file in (('merged', merged),
+                                   ('chunks', from_chunks)):
+            rates = []
+            for _ in range(3):
+                started = time.perf_counter()
+                self.assertEqual(self.download(master_file), (200, size))
+                rates.append(size / MB / (time.perf_counter() - started))
+            self.report(f'download_{label}', rates, unit=MB_PER_SECOND,
+                        higher_is_better=True)
+
+            timings = []
+            for _ in range(ROUNDS):
+                start = random.randrange(size - RANGE_SIZE)
+                started = time.perf_counter()
+                result = self.download(
+                    master_file,
+                    Range=f'bytes={start}-{start + RANGE_SIZE - 1}')
+                timings.append(time.perf_counter() - started)
+                self.assertEqual(result, (206, RANGE_SIZE))
+            self.report(f'range_{label}', timings, range_size=RANGE_SIZE)
+
+
+@skipIf(connection.vendor == 'sqlite',
+        "SQLite's in-memory test database cannot write concurrently")
+@override_settings(MERGE_ASYNC=False, MERGE_ON_COMPLETE=False)
+class ConcurrentUploadBenchmark(PipelineMixin, TransactionTestCase):
+    """
+    Uploads the chunks of one file from ``BENCH_PIPELINE_CLIENTS``
+    threads at once and records the aggregate ingestion rate.
+    """
+
+    def test_concurrent_chunk_posts(self):
+        master_file = self.create_master_file(ROUNDS)
+
+        def upload(numbers):
+            client = APIClient()
+            try:
+                return [self.post_chunk(client, master_file,
+                                        number).status_code
+                        for number in numbers]
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(CLIENTS) as clients:
+            statuses = [status for result in clients.map(
+                upload, [range(n, ROUNDS, CLIENTS) for n in range(CLIENTS)])
+                for status in result]
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(statuses, [201] * ROUNDS)
+        rate = ROUNDS * CHUNK_SIZE / MB / elapsed
+        summary = record('pipeline.concurrent_chunk_posts', [rate],
+                         unit=MB_PER_SECOND, higher_is_better=True,
+                         clients=CLIENTS)
+        print(f'\n{CLIENTS} clients, {ROUNDS} chunks: '
+              f'{summary["median"]:.1f} MB/s')
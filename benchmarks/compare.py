@@ -0,0 +1,57 @@
+"""
+Compare two benchmark results files and fail on regressions::
+
+    python -m benchmarks.compare baseline.json current.json [--tolerance 0.1]
+
+A measurement regresses when its median is worse than the baseline's by
+more than ``tolerance`` (a fraction). Exits with status 1 if any did.
+"""
+import argparse
+import sys
+
+from .results import load
+
+
+def compare(baseline, current, tolerance):
+    """
+    ``(name, baseline median, current median, change, regressed)`` for
+    every measurement in both results, ``change`` being the relative
+    difference of the medians, positive when worse.
+    """
+    rows = []
+    for name in sorted(baseline['results'].keys() &
+                       current['results'].keys()):
+        old = baseline['results'][name]
+        new = current['results'][name]
+        change = (new['median'] - old['median']) / old['median'] \
+            if old['median'] else 0.0
+        if old.get('higher_is_better'):
+            change = -change
+        rows.append((name, old['median'], new['median'], change,
+                     change > tolerance))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare benchmark results with a baseline.')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed slowdown, as a fraction (default 0.1)')
+    args = parser.parse_args(argv)
+
+    baseline, current = load(args.baseline), load(args.current)
+    rows = compare(baseline, current, args.tolerance)
+    for name, old, new, change, regressed in rows:
+        unit = current['results'][name]['unit']
+        print(f'{"REGRESSED" if regressed else "ok":<9}  {name:<40} '
+              f'{old:>12.4f} -> {new:>12.4f} {unit:<5} {change:>+8.1%}')
+    for name in sorted(baseline['results'].keys() -
+                       current['results'].keys()):
+        print(f'{"missing":<9}  {name}')
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
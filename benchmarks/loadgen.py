@@ -0,0 +1,251 @@
+"""
+Load generator for a running server::
+
+    python -m benchmarks.loadgen --url http://localhost:8000 --clients 20
+
+Each of ``--clients`` concurrent clients uploads files (a master file,
+its chunks in order, then the merge, waited for), downloads each one in
+full and reads ``--ranges`` random byte ranges of it, over one keep-alive
+connection driven by asyncio. Latencies and throughputs are printed and,
+with ``--output``, stored like the other benchmarks' results (see
+``benchmarks.results``) under ``load.*`` names.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlencode, urlsplit
+
+from .results import MB_PER_SECOND, record
+
+MB = 1024 * 1024
+BOUNDARY = 'LoadgenBoundary'
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Connection:
+    """A minimal HTTP/1.1 client connection, reopened when closed."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=b'', headers=None):
+        """Send a request and return its status, headers and body."""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}',
+                 f'Content-Length: {len(body)}']
+        lines += [f'{name}: {value}' for name, value in
+                  (headers or {}).items()]
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise HTTPError('Connection closed by the server')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while (line := await self.reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if 'content-length' in response_headers:
+            content = await self.reader.readexactly(
+                int(response_headers['content-length']))
+        elif response_headers.get('transfer-encoding') == 'chunked':
+            content = await self._read_chunked()
+        else:
+            content = await self.reader.read()
+            response_headers['connection'] = 'close'
+        if response_headers.get('connection') == 'close':
+            self.close()
+        return status, response_headers, content
+
+    async def _read_chunked(self):
+        parts = []
+        while size := int((await self.reader.readline()).split(b';')[0],
+                          16):
+            parts.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+        while await self.reader.readline() not in (b'\r\n', b''):
+            pass
+        return b''.join(parts)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+def multipart(fields, file):
+    parts = [f'--{BOUNDARY}\r\nContent-Disposition: form-data; '
+             f'name="{name}"\r\n\r\n{value}\r\n'.encode()
+             for name, value in fields.items()]
+    parts.append(f'--{BOUNDARY}\r\nContent-Disposition: form-data; '
+                 f'name="file"; filename="chunk"\r\nContent-Type: '
+                 f'application/octet-stream\r\n\r\n'.encode() + file +
+                 b'\r\n')
+    return b''.join(parts) + f'--{BOUNDARY}--\r\n'.encode()
+
+
+class LoadGenerator:
+
+    def __init__(self, args):
+        self.args = args
+        url = urlsplit(args.url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.prefix = url.path.rstrip('/') + '/upload/'
+        self.chunked = self.prefix + ('async/chunkedfile/'
+                                      if args.async_endpoints
+                                      else 'chunkedfile/')
+        self.timings = {name: [] for name in
+                        ('chunk_post', 'merge', 'download', 'range')}
+        self.errors = 0
+
+    def check(self, status, expected=(200,)):
+        if status not in expected:
+            self.errors += 1
+            raise HTTPError(f'Unexpected status {status}')
+
+    async def run_client(self, number):
+        connection = Connection(self.host, self.port)
+        try:
+            for index in range(number, self.args.files, self.args.clients):
+                try:
+                    await self.upload_and_download(connection, index)
+                except (HTTPError, OSError,
+                        asyncio.IncompleteReadError) as e:
+                    print(f'file {index}: {e}', file=sys.stderr)
+                    connection.close()
+        finally:
+            connection.close()
+
+    async def upload_and_download(self, connection, index):
+        args = self.args
+        content = os.urandom(args.file_size_mb * MB)
+        chunk_size = args.chunk_size_kb * 1024
+        chunks = [content[n:n + chunk_size]
+                  for n in range(0, len(content), chunk_size)]
+        status, _, body = await connection.request(
+            'POST', self.prefix + 'masterfile/', json.dumps({
+                'file_name': f'load-{index}.bin',
+                'md5_checksum': hashlib.md5(content).hexdigest(),
+                'number_of_chunks': len(chunks),
+            }).encode(), {'Content-Type': 'application/json'})
+        self.check(status, (201,))
+        session = json.loads(body)
+        query = urlencode({'master_file_id': session['id']})
+
+        for number, chunk in enumerate(chunks):
+            started = time.perf_counter()
+            status, _, _ = await connection.request(
+                'POST', self.chunked, multipart({
+                    'chunk_number': number,
+                    'md5_checksum': hashlib.md5(chunk).hexdigest(),
+                }, chunk), {
+                    'Content-Type': f'multipart/form-data; '
+                                    f'boundary={BOUNDARY}',
+                    'X-Upload-Session': session['upload_session'],
+                })
+            self.timings['chunk_post'].append(time.perf_counter() - started)
+            self.check(status, (200, 201))
+
+        started = time.perf_counter()
+        status, _, body = await connection.request(
+            'GET', f'{self.prefix}chunkedfile/merge-chunks/?{query}')
+        self.check(status, (200, 202))
+        while json.loads(body)['status'] not in ('completed', 'failed'):
+            await asyncio.sleep(0.05)
+            status, _, body = await connection.request(
+                'GET', f'{self.chunked}merge-status/?{query}')
+            self.check(status)
+        self.timings['merge'].append(time.perf_counter() - started)
+        if json.loads(body)['status'] != 'completed':
+            self.check(500)
+
+        started = time.perf_counter()
+        status, _, body = await connection.request(
+            'GET', f'{self.chunked}download/?{query}')
+        self.check(status)
+        self.timings['download'].append(
+            len(body) / MB / (time.perf_counter() - started))
+        if body != content:
+            self.check(500)
+
+        size = args.range_kb * 1024
+        for _ in range(args.ranges):
+            start = random.randrange(max(len(content) - size, 1))
+            end = min(start + size, len(content)) - 1
+            started = time.perf_counter()
+            status, _, body = await connection.request(
+                'GET', f'{self.chunked}download/?{query}',
+                headers={'Range': f'bytes={start}-{end}'})
+            self.timings['range'].append(time.perf_counter() - started)
+            self.check(status, (206,))
+            if body != content[start:end + 1]:
+                self.check(500)
+
+    async def run(self):
+        started = time.perf_counter()
+        await asyncio.gather(*(self.run_client(number)
+                               for number in range(self.args.clients)))
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        args = self.args
+        summaries = {}
+        for name, samples in self.timings.items():
+            if not samples:
+                continue
+            unit_args = {'unit': MB_PER_SECOND, 'higher_is_better': True} \
+                if name == 'download' else {}
+            summaries[name] = record(
+                f'load.{name}', samples, path=args.output,
+                database='server', clients=args.clients, **unit_args)
+        uploaded = len(self.timings['merge']) * args.file_size_mb
+        summaries['ingest'] = record(
+            'load.ingest', [uploaded / elapsed], MB_PER_SECOND, True,
+            path=args.output, database='server', clients=args.clients,
+            errors=self.errors)
+
+        print(f'{args.clients} clients, {args.files} files of '
+              f'{args.file_size_mb} MB in {elapsed:.1f}s, '
+              f'{self.errors} errors')
+        for name, summary in summaries.items():
+            print(f'  {name:<12} median {summary["median"]:>10.4f} '
+                  f'{summary["unit"]:<5} p95 {summary["p95"]:>10.4f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Upload and download files against a running server.')
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--file-size-mb', type=int, default=8)
+    parser.add_argument('--chunk-size-kb', type=int, default=1024)
+    parser.add_argument('--ranges', type=int, default=10,
+                        help='range requests per downloaded file')
+    parser.add_argument('--range-kb', type=int, default=64)
+    parser.add_argument('--async-endpoints', action='store_true',
+                        help='upload and download through /upload/async/')
+    parser.add_argument('--output', help='results file to add to')
+    args = parser.parse_args(argv)
+
+    generator = LoadGenerator(args)
+    generator.report(asyncio.run(generator.run()))
+    return 1 if generator.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Benchmark results stored as JSON, so runs of different releases can be
+compared (see ``benchmarks.compare``).
+
+Each measurement is a list of samples summarized under a name such as
+``pipeline.chunk_post``. When ``BENCH_RESULTS`` names a file, benchmarks
+add their measurements to it as they finish, replacing earlier ones of
+the same name, along with a description of the environment they ran in.
+"""
+import json
+import math
+import os
+import platform
+import statistics
+from datetime import datetime, timezone
+
+import django
+from django.db import connection
+
+SECONDS = 's'
+MB_PER_SECOND = 'MB/s'
+
+
+def summarize(samples, unit=SECONDS, higher_is_better=False, **info):
+    """Statistics of ``samples``, as stored for one measurement."""
+    samples = sorted(samples)
+    return {
+        'unit': unit,
+        'higher_is_better': higher_is_better,
+        'rounds': len(samples),
+        'min': samples[0],
+        'max': samples[-1],
+        'mean': statistics.fmean(samples),
+        'median': statistics.median(samples),
+        'stddev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'p95': samples[min(math.ceil(len(samples) * 0.95),
+                           len(samples)) - 1],
+        **info,
+    }
+
+
+def environment(database=None):
+    return {
+        'label': os.getenv('BENCH_LABEL', ''),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'database': database or connection.vendor,
+    }
+
+
+def record(name, samples, unit=SECONDS, higher_is_better=False,
+           path=None, database=None, **info):
+    """
+    Summarize the ``samples`` of measurement ``name`` and add them to the
+    results file ``path`` (``BENCH_RESULTS`` by default), if any. Returns
+    the summary.
+    """
+    summary = summarize(samples, unit, higher_is_better, **info)
+    path = path or os.getenv('BENCH_RESULTS')
+    if path:
+        results = load(path) if os.path.exists(path) else {'results': {}}
+        results['environment'] = environment(database)
+        results['results'][name] = summary
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return summary
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
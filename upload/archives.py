@@ -0,0 +1,168 @@
+"""
+Zip and tar archives of many master files, generated while they are sent.
+
+Member data is read from storage through a ``DOWNLOAD_BUFFER_SIZE``
+buffer and every piece of the archive is yielded as soon as it is
+written, so memory use does not depend on the number or size of the
+files. Zip archives switch to ZIP64 records where a member or the
+archive outgrows the 4 GB limits of plain zip; tar archives use the PAX
+format, which has no size limit.
+"""
+import io
+import posixpath
+import tarfile
+import zipfile
+
+from django.conf import settings
+from django.utils import timezone
+
+from .assembly import open_assembled
+from .streams import ChunkStream
+
+ZIP = 'zip'
+TAR = 'tar'
+FORMAT_CHOICES = [ZIP, TAR]
+STORED = 'stored'
+DEFLATE = 'deflate'
+COMPRESSION_CHOICES = [STORED, DEFLATE]
+CONTENT_TYPES = {ZIP: 'application/zip', TAR: 'application/x-tar'}
+
+_ZIP_COMPRESSION = {STORED: zipfile.ZIP_STORED, DEFLATE: zipfile.ZIP_DEFLATED}
+
+
+def open_content(master_file):
+    """
+    ``(file, size)`` for the content of ``master_file``: the merged file,
+    or its chunks if it is complete but not merged. ``None`` when neither
+    is available.
+    """
+    field_file = master_file.file
+    if field_file:
+        return field_file.storage.open(field_file.name, 'rb'), \
+            field_file.size
+    if master_file.is_complete() and master_file.assembly_file:
+        return open_assembled(master_file)
+    if master_file.is_complete():
+        stream = ChunkStream(master_file.chunkedfile_set.select_related(
+            'blob').order_by('chunk_number'))
+        return stream, stream.size
+    return None
+
+
+def iter_members(master_files):
+    """
+    ``(name, master_file, file, size)`` of each master file with content,
+    with archive-safe member names made unique within the archive.
+    """
+    seen = set()
+    for master_file in master_files:
+        content = open_content(master_file)
+        if content is not None:
+            yield (_member_name(master_file.file_name, seen), master_file,
+                   *content)
+
+
+def _member_name(file_name, seen):
+    # No absolute paths or '..' components, which would let extraction
+    # escape the target directory.
+    parts = [part for part in posixpath.normpath(
+        file_name.replace('\\', '/')).split('/') if part not in ('', '.',
+                                                                 '..')]
+    name = '/'.join(parts) or 'file'
+    stem, ext = posixpath.splitext(name)
+    number = 1
+    while name in seen:
+        name = f'{stem} ({number}){ext}'
+        number += 1
+    seen.add(name)
+    return name
+
+
+class _Pipe(io.RawIOBase):
+    """Write-only sink whose content is taken out as it is written."""
+
+    def __init__(self):
+        self._pending = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._pending.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        """Take the pieces written since the last call."""
+        pending, self._pending = self._pending, []
+        return pending
+
+
+def _read_blocks(file, buffer_size):
+    with file:
+        while True:
+            data = file.read(buffer_size)
+            if not data:
+                return
+            yield data
+
+
+def iter_zip(master_files, compression=DEFLATE, buffer_size=None):
+    """Yield a zip archive of ``master_files`` piece by piece."""
+    buffer_size = buffer_size or settings.DOWNLOAD_BUFFER_SIZE
+    pipe = _Pipe()
+    # The pipe cannot seek, so sizes and CRCs follow each member in a data
+    # descriptor instead of being patched into its header.
+    with zipfile.ZipFile(pipe, 'w', compression=_ZIP_COMPRESSION[
+            compression], allowZip64=True) as archive:
+        for name, master_file, file, size in iter_members(master_files):
+            info = zipfile.ZipInfo(name, _zip_date_time(master_file))
+            info.compress_type = _ZIP_COMPRESSION[compression]
+            info.external_attr = 0o644 << 16
+            # Lets zipfile choose ZIP64 headers for members over 4 GB.
+            info.file_size = size
+            with archive.open(info, 'w') as member:
+                for data in _read_blocks(file, buffer_size):
+                    member.write(data)
+                    yield from pipe.drain()
+            yield from pipe.drain()
+    yield from pipe.drain()
+
+
+def _zip_date_time(master_file):
+    uploaded_at = timezone.localtime(master_file.uploaded_at)
+    # Zip timestamps cannot predate 1980.
+    return max(uploaded_at.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def iter_tar(master_files, buffer_size=None):
+    """Yield a PAX tar archive of ``master_files`` piece by piece."""
+    buffer_size = buffer_size or settings.DOWNLOAD_BUFFER_SIZE
+    written = 0
+    for name, master_file, file, size in iter_members(master_files):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        info.mtime = int(master_file.uploaded_at.timestamp())
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        yield header
+        copied = 0
+        for data in _read_blocks(file, buffer_size):
+            copied += len(data)
+            if copied > size:
+                raise IOError(f'{master_file.file_name} is longer than its '
+                              f'recorded size')
+            yield data
+        if copied != size:
+            raise IOError(f'{master_file.file_name} is shorter than its '
+                          f'recorded size')
+        padding = -size % tarfile.BLOCKSIZE
+        yield tarfile.NUL * padding
+        written += len(header) + size + padding
+    # Two empty blocks end the archive, padded to a whole record.
+    written += 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + -written % tarfile.RECORDSIZE)
@@ -0,0 +1,176 @@
+"""
+Preallocated assembly of uploads.
+
+When ``settings.UPLOAD_PREALLOCATE`` is on, an upload with a negotiated
+chunk size (see ``MasterFileSerializer``) whose merged file would be kept
+on local ``FileSystemStorage`` gets that file created and preallocated to
+its full size as soon as the master file is, and named by
+``MasterFile.assembly_file``. Each chunk is then written at its offset,
+``chunk_number * chunk_size``, with positional writes, so chunks can
+arrive in any order and in parallel, and none is kept as a file of its
+own: the chunk rows only record what was received. Merging such an
+upload only makes the assembled file the master file's ``file``.
+"""
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+
+from .exceptions import ChecksumMismatch
+from .handlers import StoredUploadedFile
+from .streams import get_buffer_size
+from .utils import file_digest
+
+
+def can_assemble(master_file):
+    return settings.UPLOAD_PREALLOCATE and \
+        master_file.chunk_size is not None and \
+        isinstance(master_file.file.storage, FileSystemStorage)
+
+
+def preallocate(master_file):
+    """
+    Create the file the chunks of ``master_file`` are written into, with
+    its blocks allocated, and name it in ``master_file.assembly_file``.
+    """
+    field_file = master_file.file
+    storage = field_file.storage
+    name = field_file.field.generate_filename(master_file,
+                                              master_file.file_name)
+    while True:
+        name = storage.get_available_name(
+            name, max_length=field_file.field.max_length)
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            continue  # Taken by a concurrent upload; pick another name.
+        break
+    try:
+        _allocate(fd, master_file.file_size)
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        os.close(fd)
+    master_file.assembly_file = name
+    master_file.save(update_fields=['assembly_file'])
+
+
+def _allocate(fd, size):
+    if not size:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not supported here (e.g. macOS, some file systems): a sparse
+        # file of the right size still takes writes at any offset.
+        os.ftruncate(fd, size)
+
+
+def write_chunk(master_file, chunk_number, source, buffer_size=None):
+    """
+    Write the bytes read from ``source`` as chunk ``chunk_number`` of the
+    assembled file of ``master_file`` and return their number.
+    """
+    offset = chunk_number * master_file.chunk_size
+    path = master_file.file.storage.path(master_file.assembly_file)
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        copied = _copy_file_range(source, fd, offset)
+        if copied is not None:
+            return copied
+        buffer_size = get_buffer_size(buffer_size)
+        written = 0
+        while data := source.read(buffer_size):
+            view = memoryview(data)
+            while view:
+                count = os.pwrite(fd, view, offset + written)
+                written += count
+                view = view[count:]
+        return written
+    finally:
+        os.close(fd)
+
+
+def write_upload(master_file, chunk_number, file):
+    """
+    ``write_chunk`` for an uploaded ``file``. An upload streamed to
+    storage is deleted once the chunk is committed; until then a request
+    whose chunk insert fails can still store it as a replacement.
+    """
+    file.open('rb')
+    try:
+        return write_chunk(master_file, chunk_number, file)
+    finally:
+        file.close()
+        if isinstance(file, StoredUploadedFile):
+            transaction.on_commit(file.delete)
+
+
+def _copy_file_range(source, fd, offset):
+    """
+    Copy ``source`` to ``fd`` at ``offset`` inside the kernel when both
+    are plain files, or return ``None`` to copy in user space.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        return None
+    try:
+        source_fd = source.fileno()
+        source_offset = source.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    copied = 0
+    try:
+        while count := os.copy_file_range(source_fd, fd, 1 << 30,
+                                          source_offset + copied,
+                                          offset + copied):
+            copied += count
+    except OSError:
+        if copied:
+            raise
+        return None  # e.g. across file systems on older kernels
+    return copied
+
+
+def finalize(master_file, verify=False, buffer_size=None):
+    """
+    Make the assembled file of ``master_file`` its ``file`` once all its
+    chunks were written, and return its size. Raises ``ChecksumMismatch``
+    if chunks are missing or, with ``verify``, if the file does not match
+    ``master_file.md5_checksum``; the assembled file is kept either way,
+    for the chunks to be uploaded again.
+    """
+    if not master_file.is_complete():
+        raise ChecksumMismatch(
+            f'Only {master_file.received_chunks} of '
+            f'{master_file.number_of_chunks} chunks were received')
+    storage = master_file.file.storage
+    fd = os.open(storage.path(master_file.assembly_file), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    verified = verify and bool(master_file.md5_checksum)
+    if verified:
+        with storage.open(master_file.assembly_file, 'rb') as f:
+            digest = file_digest(f, master_file.checksum_algorithm,
+                                 get_buffer_size(buffer_size))
+        if digest != master_file.md5_checksum.lower():
+            raise ChecksumMismatch(
+                f'Assembled file does not match its '
+                f'{master_file.checksum_algorithm} checksum')
+    master_file.file.name = master_file.assembly_file
+    master_file.assembly_file = ''
+    master_file.merge_verified = verified
+    master_file.save(update_fields=['file', 'assembly_file',
+                                    'merge_verified'])
+    return master_file.file_size
+
+
+def open_assembled(master_file):
+    """``(file, size)`` for the assembled file of ``master_file``."""
+    return master_file.file.storage.open(master_file.assembly_file, 'rb'), \
+        master_file.file_size
@@ -0,0 +1,87 @@
+"""
+Asynchronous chunk upload, merge status and download endpoints, for
+serving under an ASGI server (``XDrive.asgi``).
+
+Under ASGI the request body is received by the event loop before the
+view runs and these views stream downloads from an asynchronous
+iterator. ``XDrive.asgi`` shuts the request's thread down once the
+response is ready, so a slow client holds no thread while its bytes are
+in flight. What has to stay synchronous (parsing and storing an upload,
+transactions, storage reads) runs in worker threads only for as long as
+it takes.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from . import metrics
+from .downloads import stream_async
+from .models import MasterFile
+from .serializers import MergeStatusSerializer
+from .views import ChunkedFileModelViewSet, serve_chunks, serve_master_file
+
+create_chunk = ChunkedFileModelViewSet.as_view({'post': 'create'})
+
+
+@csrf_exempt
+@require_POST
+async def upload_chunk(request):
+    """
+    Store a chunk as ``POST /upload/chunkedfile/`` does, taking the same
+    multipart form and answering the same way.
+    """
+    return await sync_to_async(create_chunk)(request)
+
+
+@require_GET
+async def merge_status(request):
+    # Merge progress changes too often to be cached with the session.
+    master_file, error = await get_master_file(
+        request, lambda pk: MasterFile.objects.get(pk=pk))
+    if error is not None:
+        return error
+    return JsonResponse(MergeStatusSerializer(master_file).data)
+
+
+@require_GET
+async def download_file(request):
+    """
+    Download a file as ``GET /upload/chunkedfile/download/`` does, reading
+    it in worker threads one buffer at a time while the event loop sends
+    it.
+    """
+    started = time.perf_counter()
+    master_file, error = await get_master_file(request)
+    if error is not None:
+        return error
+
+    if master_file.file:
+        response = await sync_to_async(serve_master_file)(request,
+                                                          master_file)
+    elif master_file.is_complete():
+        response = await sync_to_async(serve_chunks)(request, master_file)
+    else:
+        return JsonResponse({"error": "File not found for this master_file"},
+                            status=404)
+    stream_async(response)
+    metrics.observe_download(response, 'file', started)
+    return response
+
+
+async def get_master_file(request, get=MasterFile.objects.get_session):
+    """
+    The ``MasterFile`` named by the ``master_file_id`` query parameter, as
+    returned by ``get`` (its upload session by default), and ``None``, or
+    ``None`` and the error response to send.
+    """
+    master_file_id = request.GET.get('master_file_id')
+    if not master_file_id:
+        return None, JsonResponse(
+            {"error": "master_file_id parameter is required"}, status=400)
+    try:
+        return await sync_to_async(get)(master_file_id), None
+    except (MasterFile.DoesNotExist, ValueError):
+        return None, JsonResponse({"detail": "Not found."}, status=404)
@@ -0,0 +1,161 @@
+import base64
+import posixpath
+
+from django.conf import settings
+from django.utils.http import content_disposition_header
+
+# S3 rejects multipart parts smaller than this, except the last one.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def get_backend(storage):
+    """
+    Storage-specific operations for ``storage``: an ``S3Backend`` for
+    django-storages' S3 storage, a plain ``StorageBackend`` otherwise.
+    """
+    if hasattr(storage, 'bucket_name') and hasattr(storage, 'connection'):
+        return S3Backend(storage.connection.meta.client, storage.bucket_name,
+                         getattr(storage, 'location', ''))
+    return StorageBackend(storage)
+
+
+class StorageBackend:
+    """
+    Storages that can only be read and written through Django: files are
+    merged by streaming the chunks, and uploads and downloads go through
+    Django.
+    """
+    can_compose = False
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def compose(self, sources, name, progress=None):
+        raise NotImplementedError
+
+    def download_url(self, name, filename):
+        return None
+
+    def upload_request(self, name, digest):
+        """
+        How a client can store the bytes with SHA-256 hex ``digest`` as
+        ``name`` directly in the storage, as a ``{"url", "method",
+        "headers"}`` dict, or ``None`` when it has to go through Django.
+        """
+        return None
+
+    def stored_size(self, name, digest):
+        """
+        Size of ``name`` if it is stored with content matching ``digest``,
+        else ``None``. Only content verified on the way in is written to
+        the chunk store here, so existing files are trusted.
+        """
+        if not self.storage.exists(name):
+            return None
+        return self.storage.size(name)
+
+
+class S3Backend(StorageBackend):
+    """
+    S3 or an S3-compatible store such as MinIO. Chunks are composed into
+    the merged object with a multipart upload copying them server-side,
+    and downloads are served from presigned URLs.
+    """
+    can_compose = True
+
+    def __init__(self, client, bucket, location=''):
+        self.client = client
+        self.bucket = bucket
+        self.location = location
+
+    def key(self, name):
+        return posixpath.join(self.location, name) if self.location else name
+
+    def compose(self, sources, name, progress=None):
+        """
+        Create object ``name`` from the ``(name, size)`` pairs of
+        ``sources`` laid back to back and return its size. Sources of at
+        least ``S3_MIN_PART_SIZE`` are copied inside the store; runs of
+        smaller ones are read and uploaded together as one part, so only
+        about one part's worth of bytes is held in memory.
+        """
+        key = self.key(name)
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key)['UploadId']
+        parts = []
+        pending = bytearray()
+        size = 0
+        try:
+            for source, source_size in sources:
+                if not pending and source_size >= S3_MIN_PART_SIZE:
+                    result = self.client.upload_part_copy(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id,
+                        PartNumber=len(parts) + 1,
+                        CopySource={'Bucket': self.bucket,
+                                    'Key': self.key(source)})
+                    parts.append(result['CopyPartResult']['ETag'])
+                else:
+                    pending += self.client.get_object(
+                        Bucket=self.bucket,
+                        Key=self.key(source))['Body'].read()
+                    if len(pending) >= S3_MIN_PART_SIZE:
+                        parts.append(self._upload_part(key, upload_id,
+                                                       len(parts) + 1,
+                                                       pending))
+                        pending = bytearray()
+                size += source_size
+                if progress is not None:
+                    progress(size)
+            if pending or not parts:
+                parts.append(self._upload_part(key, upload_id,
+                                               len(parts) + 1, pending))
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': [
+                    {'ETag': etag, 'PartNumber': number}
+                    for number, etag in enumerate(parts, 1)]})
+        except BaseException:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return size
+
+    def _upload_part(self, key, upload_id, number, data):
+        return self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=upload_id,
+            PartNumber=number, Body=bytes(data))['ETag']
+
+    def download_url(self, name, filename):
+        return self.client.generate_presigned_url('get_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.key(name),
+            'ResponseContentDisposition': content_disposition_header(
+                True, filename),
+        }, ExpiresIn=settings.DOWNLOAD_URL_EXPIRE)
+
+    def upload_request(self, name, digest):
+        # The store itself rejects a body that does not match the SHA-256
+        # checksum the URL is signed with.
+        checksum = _base64_digest(digest)
+        url = self.client.generate_presigned_url('put_object', Params={
+            'Bucket': self.bucket,
+            'Key': self.key(name),
+            'ChecksumSHA256': checksum,
+        }, ExpiresIn=settings.UPLOAD_URL_EXPIRE)
+        return {'url': url, 'method': 'PUT',
+                'headers': {'x-amz-checksum-sha256': checksum}}
+
+    def stored_size(self, name, digest):
+        try:
+            head = self.client.head_object(Bucket=self.bucket,
+                                           Key=self.key(name),
+                                           ChecksumMode='ENABLED')
+        except self.client.exceptions.ClientError:
+            return None
+        if head.get('ChecksumSHA256') != _base64_digest(digest):
+            return None
+        return head['ContentLength']
+
+
+def _base64_digest(digest):
+    return base64.b64encode(bytes.fromhex(digest)).decode()
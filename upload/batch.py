@@ -0,0 +1,103 @@
+"""
+Ingestion of many small files in a single request.
+
+Every file becomes a ``MasterFile`` whose merged file is written right
+away from the bytes already in memory, so the file is ``completed``
+without a merge step. Nothing goes to the chunk store, so the bytes are
+written once: the file is left as garbage collection leaves a verified
+merged file whose chunks it released (see ``upload.cleanup``), its
+single chunk counted as received. All rows are inserted with
+``bulk_create`` in one transaction: the batch is stored as a whole or
+not at all.
+"""
+import hashlib
+import posixpath
+import tarfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+
+from .exceptions import BatchTooLarge, ChecksumMismatch
+from .models import MasterFile
+from .utils import set_chunk_bit
+
+TAR_CONTENT_TYPES = {'application/x-tar', 'application/gzip',
+                     'application/x-gzip'}
+
+
+def iter_uploaded_files(files, checksums=()):
+    """
+    ``(name, content, checksum)`` of each file uploaded in a multipart
+    body; ``checksums``, when given, holds one checksum per file.
+    """
+    checksums = list(checksums) or [None] * len(files)
+    for file, checksum in zip(files, checksums):
+        _check_size(file.name, file.size)
+        yield file.name, file.read(), checksum
+
+
+def iter_tar_members(stream):
+    """
+    ``(name, content, None)`` of each regular file of the tar archive
+    (optionally gzip compressed) read from ``stream``, one member at a
+    time.
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            _check_size(member.name, member.size)
+            yield member.name, archive.extractfile(member).read(), None
+
+
+def _check_size(name, size):
+    if size > settings.BATCH_MAX_FILE_SIZE:
+        raise BatchTooLarge(f'{name} is larger than '
+                            f'{settings.BATCH_MAX_FILE_SIZE} bytes, upload '
+                            f'it in chunks')
+
+
+def ingest(files, checksum_algorithm='md5'):
+    """
+    Store the ``(name, content, checksum)`` entries of ``files`` as
+    completed master files and return them. A checksum that is not
+    ``None`` must match the content's ``checksum_algorithm`` digest or
+    ``ChecksumMismatch`` is raised and nothing is stored.
+    """
+    field = MasterFile._meta.get_field('file')
+    storage = field.storage
+    written = []
+    try:
+        with transaction.atomic():
+            master_files = []
+            now = timezone.now()
+            for number, (name, content, checksum) in enumerate(files):
+                if number >= settings.BATCH_MAX_FILES:
+                    raise BatchTooLarge(f'A batch holds at most '
+                                        f'{settings.BATCH_MAX_FILES} files')
+                digest = hashlib.new(checksum_algorithm,
+                                     content).hexdigest()
+                if checksum is not None and checksum.lower() != digest:
+                    raise ChecksumMismatch(
+                        f'{name} does not match its {checksum_algorithm} '
+                        f'checksum')
+                stored_name = storage.save(
+                    field.generate_filename(None, posixpath.basename(name)),
+                    ContentFile(content), max_length=field.max_length)
+                written.append(stored_name)
+                master_files.append(MasterFile(
+                    file=stored_name, file_name=name, md5_checksum=digest,
+                    checksum_algorithm=checksum_algorithm,
+                    number_of_chunks=1, status=MasterFile.COMPLETED,
+                    merged_bytes=len(content), merged_at=now,
+                    merge_verified=True, received_chunks=1,
+                    received_bytes=len(content),
+                    received_bitmap=set_chunk_bit(b'', 0)))
+            MasterFile.objects.bulk_create(master_files)
+    except BaseException:
+        for name in written:
+            storage.delete(name)
+        raise
+    return master_files
@@ -0,0 +1,221 @@
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.utils.crypto import get_random_string
+
+from . import assembly, compression
+from .exceptions import ChecksumMismatch
+from .handlers import StoredUploadedFile
+from .models import ChunkBlob, ChunkedFile
+from .streams import copy_stream
+
+
+def get_blob_storage():
+    return ChunkBlob._meta.get_field('file').storage
+
+
+def blob_name(digest, codec=compression.NONE):
+    # Fan out over two directory levels so no directory grows too large.
+    return f'chunk_store/{digest[:2]}/{digest[2:4]}/{digest}' \
+        f'{compression.EXTENSIONS[codec]}'
+
+
+def acquire_blob(file, digest):
+    """
+    Return the ``ChunkBlob`` holding the content of the uploaded ``file``,
+    whose SHA-256 hex digest is ``digest``, with one more reference taken
+    on it. Content already in the store is reused and the upload
+    discarded; otherwise the upload is stored compressed (see
+    ``upload.compression``) or becomes the blob's file, moved rather than
+    copied when it was streamed to local storage.
+    """
+    with transaction.atomic():
+        blob = ChunkBlob.objects.select_for_update().filter(
+            digest=digest).first()
+        if blob is None:
+            name, codec, stored_size = _store_content(file, digest)
+            try:
+                with transaction.atomic():
+                    return ChunkBlob.objects.create(
+                        digest=digest, file=name, size=file.size,
+                        codec=codec, stored_size=stored_size, ref_count=1)
+            except IntegrityError:
+                # Another request stored the same bytes concurrently.
+                blob = ChunkBlob.objects.select_for_update().get(
+                    digest=digest)
+        blob.retain()
+    _discard(file)
+    return blob
+
+
+def link_chunk(master_file, chunk_number, md5_checksum, blob):
+    """
+    Store chunk ``chunk_number`` of ``master_file`` as a reference to the
+    existing ``blob`` without receiving its bytes, or copy them into the
+    assembled file of ``master_file`` (see ``upload.assembly``). Returns
+    ``False`` if the blob cannot be that chunk (out of range chunk number
+    or wrong size) or was garbage collected in the meantime.
+    """
+    if chunk_number >= master_file.number_of_chunks or \
+            master_file.expected_chunk_size(chunk_number) not in (None,
+                                                                  blob.size):
+        return False
+    if master_file.assembly_file:
+        return _assemble_blob(master_file, chunk_number, md5_checksum, blob)
+    with transaction.atomic():
+        if not ChunkBlob.objects.select_for_update().filter(
+                pk=blob.pk).exists():
+            return False
+        try:
+            with transaction.atomic():
+                ChunkedFile(master_file=master_file,
+                            chunk_number=chunk_number,
+                            md5_checksum=md5_checksum, file=blob.file.name,
+                            blob=blob, size=blob.size).save()
+        except IntegrityError:
+            # The chunk was uploaded concurrently.
+            return True
+        blob.retain()
+    return True
+
+
+def _assemble_blob(master_file, chunk_number, md5_checksum, blob):
+    try:
+        raw = blob.file.open('rb')
+    except FileNotFoundError:
+        return False
+    with raw, compression.decompressor(blob.codec, raw) as source:
+        size = assembly.write_chunk(master_file, chunk_number, source)
+    try:
+        with transaction.atomic():
+            ChunkedFile(master_file=master_file, chunk_number=chunk_number,
+                        md5_checksum=md5_checksum, file='',
+                        size=size).save()
+    except IntegrityError:
+        pass  # The chunk was uploaded concurrently.
+    return True
+
+
+def register_blob(digest, name, size):
+    """
+    ``ChunkBlob`` for content already written to the store as ``name``,
+    e.g. by a client uploading straight to the storage. The blob has no
+    references until a chunk is linked to it.
+    """
+    try:
+        with transaction.atomic():
+            return ChunkBlob.objects.create(digest=digest, file=name,
+                                            size=size)
+    except IntegrityError:
+        return ChunkBlob.objects.get(digest=digest)
+
+
+def store_stream(stream, digest, buffer_size=None, max_size=None):
+    """
+    Write the bytes read from ``stream`` to the chunk store as the
+    content of ``digest`` and return their size. Raises
+    ``ChecksumMismatch``, storing nothing, if they hash to another digest,
+    and ``ChunkTooLarge`` if there are more than ``max_size`` of them.
+    """
+    storage = get_blob_storage()
+    name = blob_name(digest)
+    hasher = hashlib.new(ChunkBlob.DIGEST_ALGORITHM)
+    with _new_file(storage, name) as destination:
+        size = copy_stream(stream, destination, buffer_size, hasher,
+                           max_size)
+        _check_digest(hasher, digest)
+    return size
+
+
+@contextmanager
+def _new_file(storage, name):
+    """
+    Writable file that is saved to ``storage`` as ``name`` only if the
+    ``with`` block completes, so no partial file is ever visible there.
+    """
+    if not _is_local(storage):
+        with tempfile.TemporaryFile() as destination:
+            yield destination
+            if not storage.exists(name):
+                destination.seek(0)
+                storage.save(name, File(destination))
+        return
+    path = storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f'{path}.{get_random_string(8)}.part'
+    try:
+        with open(partial, 'xb') as destination:
+            yield destination
+        os.replace(partial, path)
+    except BaseException:
+        os.remove(partial)
+        raise
+
+
+def _check_digest(hasher, digest):
+    if hasher.hexdigest() != digest:
+        raise ChecksumMismatch(
+            f'Upload does not match its {hasher.name} checksum')
+
+
+def _store_content(file, digest):
+    storage = get_blob_storage()
+    codec = compression.get_codec()
+    for candidate in dict.fromkeys([codec, compression.NONE]):
+        name = blob_name(digest, candidate)
+        if storage.exists(name):
+            # Same digest, same bytes: left by a rolled back upload.
+            _discard(file)
+            return name, candidate, storage.size(name)
+    if codec != compression.NONE:
+        stored = _store_compressed(storage, file, digest, codec)
+        if stored is not None:
+            _discard(file)
+            return stored
+    name = blob_name(digest)
+    if isinstance(file, StoredUploadedFile) and _is_local(storage) \
+            and _is_local(file.storage):
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(file.storage.path(file.stored_name), path)
+        return name, compression.NONE, file.size
+    return storage.save(name, file), compression.NONE, file.size
+
+
+def _store_compressed(storage, file, digest, codec):
+    """
+    Store ``file`` compressed with ``codec`` and return its name, codec
+    and stored size, or ``None`` if its content does not compress well.
+    """
+    name = blob_name(digest, codec)
+    file.open('rb')
+    try:
+        if not compression.is_compressible(
+                file.read(compression.PROBE_SIZE)):
+            return None
+        file.seek(0)
+        with _new_file(storage, name) as destination:
+            with compression.compressor(codec, destination) as writer:
+                copy_stream(file, writer)
+            stored_size = destination.tell()
+    finally:
+        if isinstance(file, StoredUploadedFile):
+            file.close()
+    if stored_size > file.size * compression.MAX_RATIO:
+        storage.delete(name)
+        return None
+    return name, codec, stored_size
+
+
+def _discard(file):
+    if isinstance(file, StoredUploadedFile):
+        file.delete()
+
+
+def _is_local(storage):
+    return isinstance(storage, FileSystemStorage)
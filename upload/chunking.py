@@ -0,0 +1,119 @@
+"""
+Content-defined chunking in the style of FastCDC.
+
+A gear rolling hash runs over the bytes and a chunk ends where the hash
+matches a mask, so boundaries follow the content instead of fixed
+offsets: inserting or removing bytes only changes the chunks around the
+edit and the rest still deduplicate. Normalized chunking uses a stricter
+mask before ``avg_size`` and a looser one after it to keep chunk sizes
+close to the average, within ``[min_size, max_size]``.
+
+``web/static/cdc.js`` implements the same algorithm for the browser
+client; both must produce identical boundaries, so any change here has
+to be mirrored there.
+"""
+from itertools import accumulate
+
+from django.conf import settings
+
+MASK32 = 0xFFFFFFFF
+
+
+def _gear_table():
+    # xorshift32 from a fixed seed, so the client can rebuild the same
+    # table instead of shipping 256 constants.
+    state = 0x2545F491
+    table = []
+    for _ in range(256):
+        state ^= (state << 13) & MASK32
+        state ^= state >> 17
+        state ^= (state << 5) & MASK32
+        table.append(state)
+    return table
+
+
+GEAR = _gear_table()
+
+
+def _high_bits(count):
+    return ((1 << count) - 1) << (32 - count)
+
+
+def get_sizes(min_size=None, avg_size=None, max_size=None):
+    return (min_size or settings.CDC_MIN_SIZE,
+            avg_size or settings.CDC_AVG_SIZE,
+            max_size or settings.CDC_MAX_SIZE)
+
+
+def cut_point(data, min_size, avg_size, max_size):
+    """
+    Length of the chunk starting at the beginning of ``data``. ``data``
+    must hold at least ``max_size`` bytes unless it is the end of the
+    stream.
+    """
+    size = len(data)
+    if size <= min_size:
+        return size
+    end = min(size, max_size)
+    normal = min(end, avg_size)
+    bits = avg_size.bit_length() - 1
+    mask_small, mask_large = _high_bits(bits + 1), _high_bits(bits - 1)
+    gear = GEAR
+    fingerprint = 0
+    i = min_size
+    while i < normal:
+        fingerprint = ((fingerprint << 1) + gear[data[i]]) & MASK32
+        if not fingerprint & mask_small:
+            return i + 1
+        i += 1
+    while i < end:
+        fingerprint = ((fingerprint << 1) + gear[data[i]]) & MASK32
+        if not fingerprint & mask_large:
+            return i + 1
+        i += 1
+    return end
+
+
+def iter_chunks(stream, min_size=None, avg_size=None, max_size=None):
+    """
+    Split the binary ``stream`` into content-defined chunks, yielding
+    their bytes. At most about ``2 * max_size`` bytes are held at once.
+    """
+    min_size, avg_size, max_size = get_sizes(min_size, avg_size, max_size)
+    pending = bytearray()
+    eof = False
+    while True:
+        while not eof and len(pending) < max_size:
+            data = stream.read(max_size)
+            if data:
+                pending += data
+            else:
+                eof = True
+        if not pending:
+            return
+        cut = cut_point(pending, min_size, avg_size, max_size)
+        yield bytes(pending[:cut])
+        del pending[:cut]
+
+
+def chunk_boundaries(stream, min_size=None, avg_size=None, max_size=None):
+    """End offset of every content-defined chunk of ``stream``."""
+    return list(accumulate(
+        len(chunk)
+        for chunk in iter_chunks(stream, min_size, avg_size, max_size)))
+
+
+def validate_boundaries(boundaries, min_size=None, max_size=None):
+    """
+    Check that ``boundaries`` are increasing chunk end offsets whose
+    chunks respect the size limits (the last chunk may be shorter than
+    ``min_size``). Raises ``ValueError`` otherwise.
+    """
+    min_size, _, max_size = get_sizes(min_size, None, max_size)
+    previous = 0
+    for number, boundary in enumerate(boundaries):
+        size = boundary - previous
+        if size <= 0 or size > max_size or (
+                size < min_size and number != len(boundaries) - 1):
+            raise ValueError(f'Chunk {number} has an invalid size ({size})')
+        previous = boundary
@@ -0,0 +1,312 @@
+"""
+Garbage collection of abandoned uploads and unused storage.
+
+``Sweeper.run`` makes these passes, each in batches of
+``settings.GC_BATCH_SIZE`` rows (or files) with a
+``settings.GC_BATCH_PAUSE`` second pause between batches, so a sweep of
+a large store does not monopolise the database or the disks:
+
+* merges abandoned by their worker (see ``upload.tasks``) are marked
+  failed, so the upload can be merged again or expire;
+* uploads not touched for ``settings.GC_UPLOAD_MAX_AGE`` seconds are
+  deleted with their chunks;
+* chunks of files merged more than ``settings.GC_MERGED_CHUNK_AGE``
+  seconds ago are dropped once the merged file is verified against its
+  checksum, so a merged file does not keep a second copy of its bytes;
+* blobs no chunk uses any more are deleted from the chunk store;
+* storage files no row points to are deleted, and rows whose file is
+  gone are repaired: their chunks are forgotten so clients upload them
+  again, and merged files are marked failed, with their received-chunk
+  counters recounted from the chunks still stored.
+
+Blobs and files younger than ``settings.GC_GRACE_PERIOD`` seconds are
+never collected, since they may belong to an upload in progress.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef, Q
+from django.utils import timezone
+
+from . import sessions
+from .models import ChunkBlob, ChunkedFile, MasterFile
+from .tasks import abandoned_merges
+from .utils import file_digest
+
+logger = logging.getLogger(__name__)
+
+
+class Sweeper:
+
+    def __init__(self, batch_size=None, pause=None):
+        self.batch_size = batch_size or settings.GC_BATCH_SIZE
+        self.pause = settings.GC_BATCH_PAUSE if pause is None else pause
+        self.now = timezone.now()
+        self._paused = False
+
+    def run(self):
+        """Make every pass and return the number of items each removed."""
+        self.now = timezone.now()
+        return {
+            'abandoned_merges': self.fail_abandoned_merges(),
+            'expired_uploads': self.expire_stale_uploads(),
+            'released_chunks': self.release_merged_chunks(),
+            'missing_files': self.repair_missing_files(),
+            'collected_blobs': self.collect_blobs(),
+            'orphan_files': self.remove_orphan_files(),
+        }
+
+    def ago(self, seconds):
+        return self.now - timedelta(seconds=seconds)
+
+    def batches(self, queryset):
+        """
+        Lists of at most ``batch_size`` primary keys of ``queryset``,
+        walked in key order so rows deleted along the way do not shift
+        the next batch.
+        """
+        last = None
+        while True:
+            page = queryset.order_by('pk')
+            if last is not None:
+                page = page.filter(pk__gt=last)
+            keys = list(page.values_list('pk', flat=True)[:self.batch_size])
+            if not keys:
+                return
+            self.throttle()
+            yield keys
+            last = keys[-1]
+
+    def throttle(self):
+        if self._paused and self.pause:
+            time.sleep(self.pause)
+        self._paused = True
+
+    def fail_abandoned_merges(self):
+        abandoned = MasterFile.objects.filter(abandoned_merges(self.now))
+        failed = 0
+        for keys in self.batches(abandoned):
+            failed += abandoned.filter(pk__in=keys).update(
+                status=MasterFile.FAILED,
+                merge_error='Merge was abandoned by its worker')
+            sessions.forget(*keys)
+        return failed
+
+    def expire_stale_uploads(self):
+        cutoff = self.ago(settings.GC_UPLOAD_MAX_AGE)
+        stale = MasterFile.objects.filter(
+            status__in=[MasterFile.PENDING, MasterFile.IN_PROGRESS,
+                        MasterFile.FAILED],
+            uploaded_at__lt=cutoff,
+        ).annotate(
+            last_chunk=Max('chunkedfile__uploaded_at'),
+        ).filter(Q(last_chunk__isnull=True) | Q(last_chunk__lt=cutoff))
+        expired = 0
+        for keys in self.batches(stale):
+            with transaction.atomic():
+                files = MasterFile.objects.filter(pk__in=keys)
+                merged = list(files.exclude(file='').exclude(
+                    file__isnull=True).values_list('file', flat=True))
+                merged += files.exclude(assembly_file='').values_list(
+                    'assembly_file', flat=True)
+                chunk_files = self.release_chunks(
+                    ChunkedFile.objects.filter(master_file__in=keys))
+                expired += files.delete()[1].get(MasterFile._meta.label, 0)
+                sessions.forget(*keys)
+            _delete_files(MasterFile, merged)
+            _delete_files(ChunkedFile, chunk_files)
+        return expired
+
+    def release_merged_chunks(self):
+        merged = MasterFile.objects.filter(
+            status=MasterFile.COMPLETED,
+            merged_at__lt=self.ago(settings.GC_MERGED_CHUNK_AGE),
+        ).exclude(file='').exclude(file__isnull=True).filter(
+            Exists(ChunkedFile.objects.filter(master_file=OuterRef('pk'))))
+        released = 0
+        for keys in self.batches(merged):
+            for master_file in MasterFile.objects.filter(pk__in=keys):
+                if not self.verify_merge(master_file):
+                    continue
+                with transaction.atomic():
+                    # Skip files being merged again in the meantime.
+                    if not MasterFile.objects.select_for_update().filter(
+                            pk=master_file.pk,
+                            status=MasterFile.COMPLETED).exists():
+                        continue
+                    chunks = ChunkedFile.objects.filter(
+                        master_file=master_file)
+                    released += chunks.count()
+                    # The received-chunk counters are left as they are: they
+                    # record what was uploaded, not what is still stored.
+                    # repair_missing_files recounts them if the merged file
+                    # is lost.
+                    chunk_files = self.release_chunks(chunks)
+                _delete_files(ChunkedFile, chunk_files)
+        return released
+
+    def verify_merge(self, master_file):
+        """Check the merged file against its checksum if not done yet."""
+        if master_file.merge_verified:
+            return True
+        if not master_file.md5_checksum:
+            return False
+        try:
+            with master_file.file.open('rb') as f:
+                digest = file_digest(f, master_file.checksum_algorithm)
+        except OSError:
+            return False
+        if digest != master_file.md5_checksum.lower():
+            logger.warning('Merged file of master file %s does not match '
+                           'its checksum, keeping its chunks',
+                           master_file.pk)
+            return False
+        MasterFile.objects.filter(pk=master_file.pk).update(
+            merge_verified=True)
+        return True
+
+    def release_chunks(self, chunks):
+        """
+        Delete the ``chunks`` queryset, dropping the references it held
+        on blobs, and return the names of the files the chunks that
+        predate the chunk store owned, to delete once committed.
+        """
+        ChunkBlob.release_chunks(chunks)
+        owned = list(chunks.filter(blob__isnull=True).values_list(
+            'file', flat=True))
+        chunks.delete()
+        return owned
+
+    def collect_blobs(self):
+        unused = ChunkBlob.objects.filter(
+            ref_count=0,
+            created_at__lt=self.ago(settings.GC_GRACE_PERIOD),
+        ).exclude(Exists(ChunkedFile.objects.filter(blob=OuterRef('pk'))))
+        storage = ChunkBlob._meta.get_field('file').storage
+        collected = 0
+        for keys in self.batches(unused):
+            with transaction.atomic():
+                # The row locks keep acquire_blob and link_chunk waiting
+                # until the blob is gone, after which they store the bytes
+                # anew instead of using the file being deleted.
+                blobs = list(unused.select_for_update(skip_locked=True)
+                             .filter(pk__in=keys))
+                for blob in blobs:
+                    storage.delete(blob.file.name)
+                collected += ChunkBlob.objects.filter(
+                    pk__in=[blob.pk for blob in blobs]).delete()[0]
+        return collected
+
+    def repair_missing_files(self):
+        repaired = 0
+        blobs = ChunkBlob.objects.all()
+        for keys in self.batches(blobs):
+            for blob in blobs.filter(pk__in=keys):
+                if _exists(blob.file):
+                    continue
+                logger.warning('Blob %s has no file, dropping it', blob.digest)
+                with transaction.atomic():
+                    for chunk in ChunkedFile.objects.filter(blob=blob):
+                        chunk.delete()
+                    blob.delete()
+                repaired += 1
+
+        # Chunks written into an assembled file (upload.assembly) have none.
+        legacy = ChunkedFile.objects.filter(blob__isnull=True).exclude(
+            file='')
+        for keys in self.batches(legacy):
+            for chunk in legacy.filter(pk__in=keys):
+                if not _exists(chunk.file):
+                    chunk.delete()
+                    repaired += 1
+
+        merged = MasterFile.objects.exclude(file='').exclude(
+            file__isnull=True).filter(status=MasterFile.COMPLETED)
+        for keys in self.batches(merged):
+            for master_file in merged.filter(pk__in=keys):
+                if not _exists(master_file.file):
+                    logger.warning('Merged file of master file %s is '
+                                   'missing', master_file.pk)
+                    with transaction.atomic():
+                        MasterFile.objects.filter(pk=master_file.pk).update(
+                            file=None, status=MasterFile.FAILED,
+                            merge_verified=False,
+                            merge_error='Merged file is missing from '
+                                        'storage')
+                        # Its chunks may have been released, or written
+                        # into the lost file (upload.assembly): only those
+                        # still stored count as received.
+                        master_file.chunkedfile_set.filter(
+                            blob__isnull=True, file='').delete()
+                        master_file.recount_chunks()
+                    repaired += 1
+        return repaired
+
+    def remove_orphan_files(self):
+        cutoff = self.ago(settings.GC_GRACE_PERIOD)
+        removed = 0
+        for storage, directories in _storage_directories().items():
+            for directory in directories:
+                batch = []
+                for name in _walk(storage, directory):
+                    batch.append(name)
+                    if len(batch) >= self.batch_size:
+                        removed += self.remove_unreferenced(storage, batch,
+                                                            cutoff)
+                        batch = []
+                if batch:
+                    removed += self.remove_unreferenced(storage, batch,
+                                                        cutoff)
+        return removed
+
+    def remove_unreferenced(self, storage, names, cutoff):
+        self.throttle()
+        referenced = set()
+        for model in (ChunkBlob, ChunkedFile, MasterFile):
+            referenced.update(model.objects.filter(
+                file__in=names).values_list('file', flat=True))
+        referenced.update(MasterFile.objects.filter(
+            assembly_file__in=names).values_list('assembly_file', flat=True))
+        removed = 0
+        for name in names:
+            if name in referenced or \
+                    storage.get_modified_time(name) >= cutoff:
+                continue
+            storage.delete(name)
+            removed += 1
+        return removed
+
+
+def _storage_directories():
+    # Every directory uploads are written to, grouped by storage.
+    directories = {}
+    for model in (ChunkBlob, ChunkedFile, MasterFile):
+        field = model._meta.get_field('file')
+        directories.setdefault(field.storage, []).append(
+            field.upload_to.rstrip('/'))
+    return directories
+
+
+def _walk(storage, directory):
+    try:
+        subdirectories, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in files:
+        yield f'{directory}/{name}'
+    for subdirectory in subdirectories:
+        yield from _walk(storage, f'{directory}/{subdirectory}')
+
+
+def _exists(field_file):
+    return field_file.storage.exists(field_file.name)
+
+
+def _delete_files(model, names):
+    storage = model._meta.get_field('file').storage
+    for name in names:
+        if name:
+            storage.delete(name)
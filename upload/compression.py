@@ -0,0 +1,99 @@
+"""
+Optional compression of stored chunk content.
+
+``settings.CHUNK_COMPRESSION`` selects the codec new chunk blobs are
+stored with: ``''`` (off), ``'auto'`` (zstd when the ``zstandard``
+package is installed, zlib otherwise) or a codec name. A quick entropy
+probe of the first bytes skips data that is already compressed, and a
+chunk that does not shrink enough is stored raw anyway.
+"""
+import gzip
+import lzma
+import math
+from collections import Counter
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+NONE = 'none'
+ZLIB = 'zlib'
+LZMA = 'lzma'
+ZSTD = 'zstd'
+CODEC_CHOICES = [
+    (NONE, 'None'),
+    (ZLIB, 'zlib'),
+    (LZMA, 'LZMA'),
+    (ZSTD, 'Zstandard'),
+]
+# Appended to blob names so raw and compressed copies never collide.
+EXTENSIONS = {NONE: '', ZLIB: '.gz', LZMA: '.xz', ZSTD: '.zst'}
+
+PROBE_SIZE = 64 * 1024
+# Keep the compressed copy only if it is at most this share of the raw size.
+MAX_RATIO = 0.9
+
+
+def available_codecs():
+    codecs = [NONE, ZLIB, LZMA]
+    if zstandard is not None:
+        codecs.append(ZSTD)
+    return codecs
+
+
+def get_codec():
+    """Codec new chunks are compressed with, ``NONE`` if disabled."""
+    codec = settings.CHUNK_COMPRESSION or NONE
+    if codec == 'auto':
+        return ZSTD if zstandard is not None else ZLIB
+    if codec not in available_codecs():
+        raise ValueError(f'Unsupported chunk compression codec: {codec}')
+    return codec
+
+
+def entropy(data):
+    """Shannon entropy of ``data`` in bits per byte (0 to 8)."""
+    if not data:
+        return 0.0
+    size = len(data)
+    return -sum(count / size * math.log2(count / size)
+                for count in Counter(data).values())
+
+
+def is_compressible(sample):
+    return entropy(sample) <= settings.CHUNK_COMPRESSION_MAX_ENTROPY
+
+
+def compressor(codec, fileobj):
+    """Writable file compressing into ``fileobj``, which is left open."""
+    if codec == ZLIB:
+        # zlib's DEFLATE in a gzip container, so it can be read back with
+        # the seekable gzip.GzipFile.
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6,
+                             mtime=0)
+    if codec == LZMA:
+        return lzma.LZMAFile(fileobj, 'wb', preset=6)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=3).stream_writer(
+            fileobj, closefd=False)
+    raise ValueError(f'Unsupported chunk compression codec: {codec}')
+
+
+def decompressor(codec, fileobj):
+    """
+    Readable file decompressing ``fileobj``, which is left open. zstd
+    streams can only seek forwards.
+    """
+    if codec == NONE:
+        return fileobj
+    if codec == ZLIB:
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if codec == LZMA:
+        return lzma.LZMAFile(fileobj, 'rb')
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, closefd=False)
+    raise ValueError(f'Unsupported chunk compression codec: {codec}')
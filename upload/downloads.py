@@ -0,0 +1,225 @@
+import re
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import (FileResponse, HttpResponse,
+                         HttpResponseNotModified, StreamingHttpResponse)
+from django.utils.crypto import get_random_string
+from django.utils.http import (content_disposition_header, parse_etags,
+                               quote_etag)
+
+RANGE_SPEC_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(header, size):
+    """
+    Parse an HTTP ``Range`` header against a resource of ``size`` bytes.
+
+    Returns ``None`` when the header is absent, malformed or asks for more
+    than ``settings.DOWNLOAD_MAX_RANGES`` ranges (the whole resource should
+    be served), an empty list when no range is satisfiable, or a sorted
+    list of inclusive ``(start, end)`` pairs with overlaps coalesced.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return None
+    specs = specs.split(',')
+    if len(specs) > settings.DOWNLOAD_MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = RANGE_SPEC_RE.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range: the last ``last`` bytes.
+            length = int(last)
+            if length:
+                ranges.append((max(size - length, 0), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            end = int(last) if last else size - 1
+            ranges.append((start, min(end, size - 1)))
+    return _coalesce(ranges)
+
+
+def _coalesce(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def serve_file(request, open_file, size, filename, etag=None,
+               offload_name=None, offload_path=None,
+               content_type='application/octet-stream'):
+    """
+    Build a download response for a file of ``size`` bytes.
+
+    ``open_file`` is called (with no arguments) to obtain a seekable binary
+    file object only when Django has to send the bytes itself. Honours
+    ``If-None-Match``, ``Range`` and ``If-Range`` (against the strong
+    ``etag``), answers multi-range requests with ``multipart/byteranges``
+    and, when ``settings.DOWNLOAD_OFFLOAD`` is set, hands the transfer to
+    the front-end server through ``X-Accel-Redirect`` (``offload_name``)
+    or ``X-Sendfile`` (``offload_path``).
+    """
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': content_disposition_header(True, filename),
+    }
+    if etag:
+        headers['ETag'] = quote_etag(etag)
+        if _matches(request.headers.get('If-None-Match'), etag):
+            return HttpResponseNotModified(headers={'ETag': headers['ETag']})
+
+    response = _offload_response(offload_name, offload_path, content_type)
+    if response is None:
+        response = _content_response(request, open_file, size, etag,
+                                     content_type)
+
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def stream_async(response):
+    """
+    Make a streaming ``response`` produce its content from an asynchronous
+    iterator reading each part in a worker thread. Under ASGI this keeps
+    file reads off the event loop and avoids Django reading a synchronous
+    iterator to the end, holding the whole file in memory, before sending.
+    """
+    if response.streaming and not response.is_async:
+        response.streaming_content = _iterate_in_thread(
+            response.streaming_content)
+    return response
+
+
+async def _iterate_in_thread(parts):
+    parts = iter(parts)
+    read = sync_to_async(next, thread_sensitive=False)
+    try:
+        while (part := await read(parts, None)) is not None:
+            yield part
+    finally:
+        close = getattr(parts, 'close', None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=False)()
+
+
+def _content_response(request, open_file, size, etag, content_type):
+    ranges = None
+    if _if_range_allows(request.headers.get('If-Range'), etag):
+        ranges = parse_range_header(request.headers.get('Range'), size)
+
+    if ranges is None:
+        f = open_file()
+        if _has_fileno(f):
+            response = FileResponse(f, content_type=content_type)
+            response.block_size = settings.DOWNLOAD_BUFFER_SIZE
+        else:
+            response = StreamingHttpResponse(
+                _iter_ranges(f, [(0, size - 1)]), content_type=content_type)
+        response['Content-Length'] = size
+    elif not ranges:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            _iter_ranges(open_file(), ranges), status=206,
+            content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+    else:
+        boundary = get_random_string(32)
+        parts = [(_part_header(boundary, content_type, start, end, size),
+                  start, end) for start, end in ranges]
+        closing = f'\r\n--{boundary}--\r\n'.encode()
+        response = StreamingHttpResponse(
+            _iter_multipart(open_file(), parts, closing), status=206,
+            content_type=f'multipart/byteranges; boundary={boundary}')
+        response['Content-Length'] = len(closing) + sum(
+            len(header) + end - start + 1 for header, start, end in parts)
+    return response
+
+
+def _matches(header, etag):
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return '*' in etags or quote_etag(etag) in etags
+
+
+def _if_range_allows(header, etag):
+    # A date or weak validator in If-Range never matches a strong ETag.
+    if not header:
+        return True
+    return bool(etag) and header.strip() == quote_etag(etag)
+
+
+def _offload_response(offload_name, offload_path, content_type):
+    mode = settings.DOWNLOAD_OFFLOAD
+    if mode == 'x-accel-redirect' and offload_name:
+        location = settings.DOWNLOAD_OFFLOAD_PREFIX + quote(offload_name)
+        header = 'X-Accel-Redirect'
+    elif mode == 'x-sendfile' and offload_path:
+        location = offload_path
+        header = 'X-Sendfile'
+    else:
+        return None
+    response = HttpResponse(content_type=content_type)
+    response[header] = location
+    return response
+
+
+def _part_header(boundary, content_type, start, end, size):
+    return (f'\r\n--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode()
+
+
+def _has_fileno(f):
+    # wsgi.file_wrapper implementations call fileno() to use sendfile().
+    try:
+        f.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
+
+
+def _iter_multipart(f, parts, closing):
+    with f:
+        for header, start, end in parts:
+            yield header
+            yield from _read_range(f, start, end)
+    yield closing
+
+
+def _iter_ranges(f, ranges):
+    with f:
+        for start, end in ranges:
+            yield from _read_range(f, start, end)
+
+
+def _read_range(f, start, end):
+    f.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = f.read(min(settings.DOWNLOAD_BUFFER_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
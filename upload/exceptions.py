@@ -0,0 +1,47 @@
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class ChecksumMismatch(APIException):
+    """
+    The bytes received do not match the checksum the client announced.
+    The client should upload them again.
+    """
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'Checksum mismatch.'
+    default_code = 'checksum_mismatch'
+
+    def __init__(self, message=None):
+        self.message = message or self.default_detail
+        super().__init__({"error": self.message, "retryable": True})
+
+    def __str__(self):
+        return self.message
+
+
+class BatchTooLarge(APIException):
+    """A batch upload holds too many files or a file that is too large."""
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Batch too large.'
+    default_code = 'batch_too_large'
+
+    def __init__(self, message=None):
+        self.message = message or self.default_detail
+        super().__init__({"error": self.message})
+
+    def __str__(self):
+        return self.message
+
+
+class ChunkTooLarge(APIException):
+    """A chunk is larger than it may be."""
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Chunk is too large.'
+    default_code = 'chunk_too_large'
+
+    def __init__(self, message=None):
+        self.message = message or self.default_detail
+        super().__init__({"error": self.message})
+
+    def __str__(self):
+        return self.message
@@ -0,0 +1,28 @@
+import django_filters
+
+from .models import ChunkedFile, MasterFile
+
+
+class UploadedAtFilterSet(django_filters.FilterSet):
+    uploaded_after = django_filters.IsoDateTimeFilter(
+        field_name='uploaded_at', lookup_expr='gte')
+    uploaded_before = django_filters.IsoDateTimeFilter(
+        field_name='uploaded_at', lookup_expr='lt')
+
+
+class MasterFileFilter(UploadedAtFilterSet):
+    status = django_filters.MultipleChoiceFilter(
+        choices=MasterFile.STATUS_CHOICES)
+
+    class Meta:
+        model = MasterFile
+        fields = ['status']
+
+
+class ChunkedFileFilter(UploadedAtFilterSet):
+    # A plain number, so filtering does not first look the master file up.
+    master_file = django_filters.NumberFilter()
+
+    class Meta:
+        model = ChunkedFile
+        fields = ['master_file']
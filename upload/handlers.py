@@ -0,0 +1,126 @@
+import hashlib
+import os
+
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import (TemporaryUploadedFile,
+                                            UploadedFile)
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .models import ChunkBlob, ChunkedFile, MasterFile
+
+CHECKSUM_ALGORITHM_HEADER = 'X-Checksum-Algorithm'
+
+
+def get_requested_algorithm(request):
+    algorithm = request.headers.get(CHECKSUM_ALGORITHM_HEADER, 'md5').lower()
+    if algorithm not in dict(MasterFile.CHECKSUM_ALGORITHM_CHOICES):
+        return 'md5'
+    return algorithm
+
+
+class StoredUploadedFile(UploadedFile):
+    """
+    An upload whose bytes were written straight to ``storage`` as
+    ``stored_name`` while the request was parsed. Assign ``stored_name`` to
+    the model's ``FileField`` so the file is not saved a second time, or
+    ``delete()`` it when the upload is rejected.
+    """
+
+    def __init__(self, storage, stored_name, name, content_type, size,
+                 charset, content_type_extra=None):
+        super().__init__(None, name, content_type, size, charset,
+                         content_type_extra)
+        self.storage = storage
+        self.stored_name = stored_name
+
+    def open(self, mode='rb'):
+        self.close()
+        self.file = self.storage.open(self.stored_name, mode)
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def delete(self):
+        self.close()
+        self.storage.delete(self.stored_name)
+
+
+class ChunkUploadHandler(FileUploadHandler):
+    """
+    Hash uploaded files while their bytes stream in, so the checksum is
+    known without reading the file a second time. The algorithm comes from
+    the ``X-Checksum-Algorithm`` request header (MD5 by default); its hex
+    digest and the SHA-256 one used by the chunk store are left on the
+    uploaded file as ``file.digests``.
+
+    When chunks are kept on local ``FileSystemStorage`` the bytes are
+    written directly into their final ``chunked_files/`` file and a
+    ``StoredUploadedFile`` is returned, skipping the temporary file and the
+    second copy ``FileField`` would make from it. Other storages get a
+    ``TemporaryUploadedFile`` as with Django's default handler.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        # The content-addressed chunk store needs the SHA-256 digest too.
+        self.hashers = {
+            algorithm: hashlib.new(algorithm)
+            for algorithm in (get_requested_algorithm(self.request),
+                              ChunkBlob.DIGEST_ALGORITHM)}
+        field = ChunkedFile._meta.get_field('file')
+        self.storage = field.storage
+        if isinstance(self.storage, FileSystemStorage):
+            self.stored_name, self.file = self._create_stored_file(
+                field.generate_filename(None, self.file_name),
+                field.max_length)
+        else:
+            self.stored_name = None
+            self.file = TemporaryUploadedFile(
+                self.file_name, self.content_type, 0, self.charset,
+                self.content_type_extra)
+
+    def _create_stored_file(self, name, max_length):
+        # Same create-exclusively loop as FileSystemStorage._save, so two
+        # uploads never end up writing to the same file.
+        directory = os.path.dirname(self.storage.path(name))
+        os.makedirs(directory, exist_ok=True)
+        while True:
+            name = self.storage.get_available_name(name,
+                                                   max_length=max_length)
+            try:
+                destination = open(self.storage.path(name), 'xb')
+            except FileExistsError:
+                continue
+            if self.storage.file_permissions_mode is not None:
+                os.chmod(destination.fileno(),
+                         self.storage.file_permissions_mode)
+            return name, destination
+
+    def receive_data_chunk(self, raw_data, start):
+        for hasher in self.hashers.values():
+            hasher.update(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        if self.stored_name is None:
+            file = self.file
+            file.seek(0)
+            file.size = file_size
+        else:
+            self.file.close()
+            file = StoredUploadedFile(
+                self.storage, self.stored_name, self.file_name,
+                self.content_type, file_size, self.charset,
+                self.content_type_extra)
+        file.digests = {algorithm: hasher.hexdigest()
+                        for algorithm, hasher in self.hashers.items()}
+        return file
+
+    def upload_interrupted(self):
+        if getattr(self, 'file', None) is None:
+            return
+        self.file.close()
+        if self.stored_name is not None:
+            self.storage.delete(self.stored_name)
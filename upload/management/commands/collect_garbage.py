@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from upload.cleanup import Sweeper
+
+
+class Command(BaseCommand):
+    help = ('Delete abandoned uploads, the chunks of verified merged files '
+            'and storage nobody references (see upload/cleanup.py).')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Rows or files handled per batch (GC_BATCH_SIZE).')
+        parser.add_argument(
+            '--pause', type=float,
+            help='Seconds to wait between batches (GC_BATCH_PAUSE).')
+        parser.add_argument(
+            '--interval', type=float,
+            help='Keep sweeping, waiting this many seconds between sweeps.')
+
+    def handle(self, *args, batch_size=None, pause=None, interval=None,
+               **options):
+        while True:
+            counts = Sweeper(batch_size, pause).run()
+            self.stdout.write(', '.join(f'{name.replace("_", " ")}: {count}'
+                                        for name, count in counts.items()))
+            if not interval:
+                return
+            time.sleep(interval)
@@ -0,0 +1,150 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+from . import assembly
+from .backends import get_backend
+from .compression import NONE, decompressor
+from .exceptions import ChecksumMismatch
+from .streams import (ChunkStream, DigestStream, chunk_codec, chunk_size,
+                      copy_stream, get_buffer_size, kernel_copy)
+
+
+def merge_chunks(master_file, buffer_size=None, progress=None, verify=None):
+    """
+    Concatenate the chunks of ``master_file`` in ``chunk_number`` order
+    into ``master_file.file`` and return the number of bytes written.
+    ``progress``, if given, is called with the number of bytes merged so
+    far as the merge advances.
+
+    Bytes are copied through a fixed ``buffer_size`` buffer (defaults to
+    ``settings.MERGE_BUFFER_SIZE``), or entirely in kernel space when the
+    chunks and the merged file live on local ``FileSystemStorage``, so the
+    worker's memory use does not grow with the size of the file.
+
+    With ``verify`` (``settings.MERGE_VERIFY_CHECKSUM`` by default) the
+    whole-file digest is computed from the bytes as they are copied and a
+    mismatch with ``master_file.md5_checksum`` raises ``ChecksumMismatch``
+    after the merged file is removed; ``master_file.merge_verified``
+    records whether the check ran. Verifying needs the bytes in user
+    space, so it disables the kernel copy.
+
+    On storages that can compose objects (S3, see ``upload.backends``)
+    the merged file is assembled inside the store when
+    ``settings.MERGE_COMPOSE`` is on; the bytes never reach the worker,
+    so only the chunk checksums, checked on upload, are verified. Files
+    with chunks stored compressed (see ``upload.compression``) are always
+    streamed, decompressing the chunks as they are copied.
+
+    Uploads assembled in place (see ``upload.assembly``) are not copied:
+    once all their chunks are received their file becomes the merged
+    file, read back only to verify it.
+    """
+    if master_file.assembly_file:
+        size = assembly.finalize(
+            master_file, settings.MERGE_VERIFY_CHECKSUM if verify is None
+            else verify, buffer_size)
+        if progress is not None:
+            progress(size)
+        return size
+    buffer_size = get_buffer_size(buffer_size)
+    chunk_set = master_file.chunkedfile_set
+    chunks = chunk_set.select_related('blob').order_by(
+        'chunk_number').iterator()
+    field_file = master_file.file
+    storage = field_file.storage
+    previous_name = field_file.name
+    name = field_file.field.generate_filename(master_file,
+                                              master_file.file_name)
+    backend = get_backend(storage)
+    compose = backend.can_compose and settings.MERGE_COMPOSE and \
+        not chunk_set.filter(blob__isnull=False).exclude(
+            blob__codec=NONE).exists()
+
+    if verify is None:
+        verify = settings.MERGE_VERIFY_CHECKSUM and not compose
+    hasher = None
+    if verify and master_file.md5_checksum:
+        hasher = hashlib.new(master_file.checksum_algorithm)
+
+    if compose and hasher is None:
+        name = storage.get_available_name(
+            name, max_length=field_file.field.max_length)
+        size = backend.compose(
+            ((chunk.file.name, chunk_size(chunk)) for chunk in chunks), name,
+            progress)
+    elif _is_local(storage):
+        name, size = _merge_local(storage, name, chunks, buffer_size,
+                                  field_file.field.max_length, progress,
+                                  hasher)
+    else:
+        stream = ChunkStream(chunks)
+        if hasher is not None:
+            stream = DigestStream(stream, hasher)
+        content = File(stream, name=name)
+        content.DEFAULT_CHUNK_SIZE = buffer_size
+        try:
+            name = storage.save(name, content,
+                                max_length=field_file.field.max_length)
+        finally:
+            stream.close()
+        size = storage.size(name)
+        if progress is not None:
+            progress(size)
+
+    if master_file.file_size is not None and size != master_file.file_size:
+        storage.delete(name)
+        raise ChecksumMismatch(
+            f'Merged file is {size} bytes long, not {master_file.file_size}')
+    if hasher is not None and \
+            hasher.hexdigest() != master_file.md5_checksum.lower():
+        storage.delete(name)
+        raise ChecksumMismatch(
+            f'Merged file does not match its {master_file.checksum_algorithm}'
+            f' checksum')
+
+    master_file.file.name = name
+    master_file.merge_verified = hasher is not None
+    master_file.save(update_fields=['file', 'merge_verified'])
+    if previous_name and previous_name != name:
+        storage.delete(previous_name)
+    return size
+
+
+def _is_local(storage):
+    return isinstance(storage, FileSystemStorage)
+
+
+def _merge_local(storage, name, chunks, buffer_size, max_length, progress,
+                 hasher):
+    name = storage.get_available_name(name, max_length=max_length)
+    path = storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    size = 0
+    try:
+        with open(path, 'xb', buffering=0) as destination:
+            for chunk in chunks:
+                size += _append_chunk(chunk, destination, buffer_size,
+                                      hasher)
+                if progress is not None:
+                    progress(size)
+    except BaseException:
+        os.remove(path)
+        raise
+    return name, size
+
+
+def _append_chunk(chunk, destination, buffer_size, hasher):
+    codec = chunk_codec(chunk)
+    if hasher is None and codec == NONE and _is_local(chunk.file.storage):
+        with open(chunk.file.path, 'rb', buffering=0) as source:
+            copied = kernel_copy(source.fileno(), destination.fileno(),
+                                 buffer_size)
+            if copied is not None:
+                return copied
+            return copy_stream(source, destination, buffer_size)
+    with chunk.file.open('rb') as raw, decompressor(codec, raw) as source:
+        return copy_stream(source, destination, buffer_size, hasher)
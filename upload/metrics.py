@@ -0,0 +1,348 @@
+"""
+In-process metrics in the Prometheus text format, served at ``/metrics``.
+
+Counters, gauges and histograms are kept in memory by each server
+process, so every worker has to be scraped on its own (or run a single
+process). Recording a value takes a lock and a few additions, cheap
+enough to do on every request:
+
+* ``MetricsMiddleware`` times every request and counts its database
+  queries and their time;
+* ``track_upload`` and ``track_download`` wrap the upload and download
+  views to measure their latency, bytes and throughput, and the number
+  of uploads in flight;
+* ``upload.tasks.run_merge`` records merge durations and sizes.
+
+``settings.METRICS_ENABLED`` turns all of it, and the endpoint, off.
+"""
+import functools
+import math
+import threading
+import time
+
+from asgiref.sync import (iscoroutinefunction, markcoroutinefunction,
+                          sync_to_async)
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import FileResponse, Http404, HttpResponse
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+LONG_SECONDS_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600)
+BYTES_BUCKETS = tuple(1024 ** 2 * 4 ** n for n in range(8))  # 1 MB-16 GB
+BYTES_PER_SECOND_BUCKETS = tuple(1024 ** 2 * 2 ** n for n in range(12))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+_registry = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _label_text(self, key, extra=()):
+        pairs = [*zip(self.label_names, key), *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"'
+                              for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = sorted(self._values.items())
+            lines += [line for key, value in values
+                      for line in self._samples(key, value)]
+        return lines
+
+    def _samples(self, key, value):
+        yield f'{self.name}{self._label_text(key)} {_number(value)}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=SECONDS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # One count per bucket (not cumulative), then sum.
+                state = self._values[key] = [0] * (len(self.buckets) + 1) \
+                    + [0.0]
+            state[_bucket_index(self.buckets, value)] += 1
+            state[-1] += value
+
+    def _samples(self, key, state):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), state):
+            cumulative += count
+            yield (f'{self.name}_bucket'
+                   f'{self._label_text(key, [("le", _number(bound))])} '
+                   f'{cumulative}')
+        yield f'{self.name}_sum{self._label_text(key)} {_number(state[-1])}'
+        yield f'{self.name}_count{self._label_text(key)} {cumulative}'
+
+
+def _bucket_index(buckets, value):
+    for index, bound in enumerate(buckets):
+        if value <= bound:
+            return index
+    return len(buckets)
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n',
+                                                                  r'\n')
+
+
+def render():
+    return '\n'.join(line for metric in _registry
+                     for line in metric.render()) + '\n'
+
+
+REQUEST_SECONDS = Histogram(
+    'xdrive_request_duration_seconds',
+    'Time to build the response to a request.', ['view', 'method'])
+REQUEST_DB_QUERIES = Histogram(
+    'xdrive_request_db_queries', 'Database queries run per request.',
+    ['view'], buckets=QUERY_COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram(
+    'xdrive_request_db_seconds',
+    'Time spent in database queries per request.', ['view'])
+
+UPLOAD_SECONDS = Histogram(
+    'xdrive_upload_duration_seconds', 'Latency of upload requests.',
+    ['kind', 'status'])
+UPLOAD_THROUGHPUT = Histogram(
+    'xdrive_upload_bytes_per_second',
+    'Rate at which successful upload requests were received.', ['kind'],
+    buckets=BYTES_PER_SECOND_BUCKETS)
+INGESTED_BYTES = Counter(
+    'xdrive_ingested_bytes_total',
+    'Bytes received by successful upload requests.', ['kind'])
+UPLOADS_IN_FLIGHT = Gauge(
+    'xdrive_uploads_in_flight', 'Upload requests being processed.',
+    ['kind'])
+
+MERGE_SECONDS = Histogram(
+    'xdrive_merge_duration_seconds', 'Time to merge the chunks of a file.',
+    ['result'], buckets=LONG_SECONDS_BUCKETS)
+MERGE_BYTES = Histogram(
+    'xdrive_merge_bytes', 'Size of merged files.', buckets=BYTES_BUCKETS)
+
+DOWNLOAD_SECONDS = Histogram(
+    'xdrive_download_duration_seconds',
+    'Time to send a download, from request to last byte.', ['kind'],
+    buckets=LONG_SECONDS_BUCKETS)
+DOWNLOAD_THROUGHPUT = Histogram(
+    'xdrive_download_bytes_per_second', 'Rate at which downloads were sent.',
+    ['kind'], buckets=BYTES_PER_SECOND_BUCKETS)
+DOWNLOADED_BYTES = Counter(
+    'xdrive_downloaded_bytes_total', 'Bytes sent by downloads.', ['kind'])
+
+
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
+
+
+class MetricsMiddleware:
+    """Times every request and counts the database queries it runs."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = _QueryTimer()
+        started = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        self.observe(request, started, queries)
+        return response
+
+    async def __acall__(self, request):
+        queries = _QueryTimer()
+        started = time.perf_counter()
+        # A connection may only be used by the thread that created it, the
+        # one running the request's synchronous code, so fetch it there.
+        wrappers = await sync_to_async(
+            lambda: connection.execute_wrappers)()
+        wrappers.append(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            wrappers.remove(queries)
+        self.observe(request, started, queries)
+        return response
+
+    def observe(self, request, started, queries):
+        elapsed = time.perf_counter() - started
+        view = getattr(request.resolver_match, 'view_name', None) or \
+            'unmatched'
+        REQUEST_SECONDS.observe(elapsed, view=view, method=request.method)
+        REQUEST_DB_QUERIES.observe(queries.count, view=view)
+        REQUEST_DB_SECONDS.observe(queries.seconds, view=view)
+
+
+class _QueryTimer:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - started
+
+
+def track_upload(kind):
+    """
+    Decorate a view method receiving uploads: counts it in flight while
+    it runs and records its latency, and for successful requests the
+    bytes received (the request's ``Content-Length``) and their rate.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(self, request, *args, **kwargs):
+            if not settings.METRICS_ENABLED:
+                return view(self, request, *args, **kwargs)
+            UPLOADS_IN_FLIGHT.inc(kind=kind)
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = view(self, request, *args, **kwargs)
+                status = response.status_code
+                return response
+            except Exception as e:
+                status = getattr(e, 'status_code', 500)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                UPLOADS_IN_FLIGHT.dec(kind=kind)
+                UPLOAD_SECONDS.observe(elapsed, kind=kind, status=status)
+                size = int(request.META.get('CONTENT_LENGTH') or 0)
+                if 200 <= status < 300 and size:
+                    INGESTED_BYTES.inc(size, kind=kind)
+                    UPLOAD_THROUGHPUT.observe(size / max(elapsed, 1e-6),
+                                              kind=kind)
+        return wrapper
+    return decorator
+
+
+def track_download(kind):
+    """
+    Decorate a view method serving downloads: once the response has been
+    sent (when the server closes it), records how long it took from the
+    request, the bytes sent and their rate. Redirects and downloads
+    handed to the front-end server are not counted.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(self, request, *args, **kwargs):
+            started = time.perf_counter()
+            response = view(self, request, *args, **kwargs)
+            observe_download(response, kind, started)
+            return response
+        return wrapper
+    return decorator
+
+
+def observe_download(response, kind, started):
+    """
+    Record the download ``response`` once it has been sent, as
+    ``track_download`` does, for a request received at ``started``
+    (``time.perf_counter()``).
+    """
+    if not settings.METRICS_ENABLED or \
+            not 200 <= response.status_code < 300 or \
+            response.has_header('X-Accel-Redirect') or \
+            response.has_header('X-Sendfile'):
+        return
+    if not response.streaming:
+        sent = [len(response.content)]
+    elif response.has_header('Content-Length') or \
+            isinstance(response, FileResponse):
+        sent = [int(response.get('Content-Length') or 0)]
+    else:
+        sent = [0]
+        count = _acount if response.is_async else _count
+        response.streaming_content = count(response.streaming_content, sent)
+    close = response.close
+
+    def close_and_observe():
+        close()
+        elapsed = time.perf_counter() - started
+        DOWNLOAD_SECONDS.observe(elapsed, kind=kind)
+        DOWNLOADED_BYTES.inc(sent[0], kind=kind)
+        DOWNLOAD_THROUGHPUT.observe(sent[0] / max(elapsed, 1e-6), kind=kind)
+
+    response.close = close_and_observe
+
+
+def _count(parts, sent):
+    for part in parts:
+        sent[0] += len(part)
+        yield part
+
+
+async def _acount(parts, sent):
+    async for part in parts:
+        sent[0] += len(part)
+        yield part
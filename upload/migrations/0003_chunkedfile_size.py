@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0002_masterfile_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedfile',
+            name='size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0003_chunkedfile_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterfile',
+            name='merge_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='masterfile',
+            name='merged_bytes',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='masterfile',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In progress'), ('merging', 'Merging'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:14
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def delete_duplicate_chunks(apps, schema_editor):
+    # Retried uploads used to add a new row per attempt; keep the latest.
+    ChunkedFile = apps.get_model('upload', 'ChunkedFile')
+    duplicates = ChunkedFile.objects.values(
+        'master_file', 'chunk_number').annotate(
+        latest=Max('id'), count=models.Count('id')).filter(count__gt=1)
+    for duplicate in duplicates.iterator():
+        ChunkedFile.objects.filter(
+            master_file=duplicate['master_file'],
+            chunk_number=duplicate['chunk_number'],
+            id__lt=duplicate['latest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0004_masterfile_merge_progress'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_chunks,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chunkedfile',
+            constraint=models.UniqueConstraint(fields=('master_file', 'chunk_number'), name='unique_master_file_chunk_number'),
+        ),
+    ]
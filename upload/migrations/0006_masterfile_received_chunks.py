@@ -0,0 +1,48 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:15
+
+from django.db import migrations, models
+
+
+def count_received_chunks(apps, schema_editor):
+    MasterFile = apps.get_model('upload', 'MasterFile')
+    ChunkedFile = apps.get_model('upload', 'ChunkedFile')
+    for master_file in MasterFile.objects.iterator():
+        bitmap, count, size = bytearray(), 0, 0
+        for chunk_number, chunk_size in ChunkedFile.objects.filter(
+                master_file=master_file).values_list('chunk_number', 'size'):
+            index, mask = divmod(chunk_number, 8)
+            if len(bitmap) <= index:
+                bitmap.extend(bytes(index + 1 - len(bitmap)))
+            bitmap[index] |= 1 << mask
+            count += 1
+            size += chunk_size or 0
+        MasterFile.objects.filter(pk=master_file.pk).update(
+            received_bitmap=bytes(bitmap), received_chunks=count,
+            received_bytes=size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0005_chunkedfile_unique_chunk_number'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterfile',
+            name='received_bitmap',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AddField(
+            model_name='masterfile',
+            name='received_bytes',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='masterfile',
+            name='received_chunks',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_received_chunks,
+                             migrations.RunPython.noop),
+    ]
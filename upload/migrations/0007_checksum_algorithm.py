@@ -0,0 +1,28 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0006_masterfile_received_chunks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterfile',
+            name='checksum_algorithm',
+            field=models.CharField(choices=[('md5', 'MD5'), ('sha256', 'SHA-256'), ('blake2b', 'BLAKE2b'), ('blake2s', 'BLAKE2s')], default='md5', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='chunkedfile',
+            name='md5_checksum',
+            field=models.CharField(max_length=128),
+        ),
+        migrations.AlterField(
+            model_name='masterfile',
+            name='md5_checksum',
+            field=models.CharField(max_length=128),
+        ),
+    ]
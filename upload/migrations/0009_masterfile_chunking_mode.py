@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0008_chunkblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterfile',
+            name='chunk_boundaries',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='masterfile',
+            name='chunking_mode',
+            field=models.CharField(choices=[('fixed', 'Fixed size'), ('cdc', 'Content-defined')], default='fixed', max_length=8),
+        ),
+    ]
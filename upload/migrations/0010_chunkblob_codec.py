@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0009_masterfile_chunking_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkblob',
+            name='codec',
+            field=models.CharField(choices=[('none', 'None'), ('zlib', 'zlib'), ('lzma', 'LZMA'), ('zstd', 'Zstandard')], default='none', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='chunkblob',
+            name='stored_size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+    ]
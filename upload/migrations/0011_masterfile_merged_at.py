@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0010_chunkblob_codec'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterfile',
+            name='merge_verified',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='masterfile',
+            name='merged_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
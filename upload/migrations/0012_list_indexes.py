@@ -0,0 +1,25 @@
+# Generated by Django 5.0.2 on 2026-10-18 20:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0011_masterfile_merged_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chunkedfile',
+            index=models.Index(fields=['uploaded_at', 'id'], name='chunkedfile_uploaded_at_id'),
+        ),
+        migrations.AddIndex(
+            model_name='chunkedfile',
+            index=models.Index(fields=['master_file', 'uploaded_at', 'id'], name='chunkedfile_master_uploaded_id'),
+        ),
+        migrations.AddIndex(
+            model_name='masterfile',
+            index=models.Index(fields=['uploaded_at', 'id'], name='masterfile_uploaded_at_id'),
+        ),
+    ]
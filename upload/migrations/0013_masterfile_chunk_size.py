@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 21:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0012_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterfile',
+            name='chunk_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='masterfile',
+            name='file_size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 21:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0013_masterfile_chunk_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterfile',
+            name='assembly_file',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 21:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upload', '0014_masterfile_assembly_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='masterfile',
+            name='merge_heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,21 +1,283 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+
+from . import sessions
+from .compression import CODEC_CHOICES, NONE
+from .utils import (has_all_chunks, has_chunk, iter_missing_chunks,
+                    set_chunk_bit)
+
+
+class MasterFileManager(models.Manager):
+
+    def get_session(self, pk):
+        """
+        Master file ``pk`` with the fields of its upload session (see
+        ``upload.sessions``) taken from the session cache, or loaded and
+        cached, and its other fields deferred. Raises ``DoesNotExist``, or
+        ``ValueError`` for a malformed ``pk``.
+        """
+        values = sessions.get(pk)
+        if values is None:
+            values = self.filter(pk=pk).values_list(*sessions.FIELDS).first()
+            if values is None:
+                raise self.model.DoesNotExist(f'No master file {pk}')
+            values = sessions.put(pk, values)
+        return self.model.from_db(self.db, sessions.FIELDS, values)
 
 
 class MasterFile(models.Model):
+    PENDING = 'pending'
+    IN_PROGRESS = 'in_progress'
+    MERGING = 'merging'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (IN_PROGRESS, 'In progress'),
+        (MERGING, 'Merging'),
+        (COMPLETED, 'Completed'),
+        (FAILED, 'Failed'),
+    ]
+
+    FIXED = 'fixed'
+    CONTENT_DEFINED = 'cdc'
+    CHUNKING_MODE_CHOICES = [
+        (FIXED, 'Fixed size'),
+        (CONTENT_DEFINED, 'Content-defined'),
+    ]
+
+    CHECKSUM_ALGORITHM_CHOICES = [
+        ('md5', 'MD5'),
+        ('sha256', 'SHA-256'),
+        ('blake2b', 'BLAKE2b'),
+        ('blake2s', 'BLAKE2s'),
+    ]
+
     file = models.FileField(upload_to='master_files/', null=True, blank=True)
     file_name = models.CharField(max_length=255)
-    md5_checksum = models.CharField(max_length=32)
+    # Hex digest of the whole file (and, on ChunkedFile, of the chunk)
+    # computed with checksum_algorithm, which need not be MD5.
+    md5_checksum = models.CharField(max_length=128)
+    checksum_algorithm = models.CharField(
+        max_length=16, choices=CHECKSUM_ALGORITHM_CHOICES, default='md5')
     number_of_chunks = models.PositiveIntegerField()
+    chunking_mode = models.CharField(max_length=8,
+                                     choices=CHUNKING_MODE_CHOICES,
+                                     default=FIXED)
+    # End offset of every chunk, for content-defined chunking.
+    chunk_boundaries = models.JSONField(default=list, blank=True)
+    # Size of the file, and of all of its fixed-size chunks but the last,
+    # when negotiated on creation (see MasterFileSerializer).
+    file_size = models.PositiveBigIntegerField(null=True, blank=True)
+    chunk_size = models.PositiveIntegerField(null=True, blank=True)
+    # Preallocated file the chunks are written into until it becomes
+    # ``file``, see upload.assembly.
+    assembly_file = models.CharField(max_length=100, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=20, default='pending')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+                              default=PENDING)
+    merged_bytes = models.PositiveBigIntegerField(default=0)
+    merge_error = models.TextField(blank=True)
+    merged_at = models.DateTimeField(null=True, blank=True)
+    # Last sign of life of the worker merging the file, see upload.tasks.
+    merge_heartbeat = models.DateTimeField(null=True, blank=True)
+    # Whether the merged file was checked against md5_checksum, which lets
+    # garbage collection drop the chunks.
+    merge_verified = models.BooleanField(default=False)
+
+    received_chunks = models.PositiveIntegerField(default=0)
+    received_bytes = models.PositiveBigIntegerField(default=0)
+    received_bitmap = models.BinaryField(default=b'', editable=False)
+
+    objects = MasterFileManager()
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the list endpoint, see upload.pagination.
+            models.Index(fields=['uploaded_at', 'id'],
+                         name='masterfile_uploaded_at_id'),
+        ]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        sessions.forget(self.pk)
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        with transaction.atomic():
+            # The cascade deletes the chunks without ChunkedFile.delete(), so
+            # their references on blobs are dropped here.
+            ChunkBlob.release_chunks(self.chunkedfile_set.all())
+            result = super().delete(*args, **kwargs)
+        sessions.forget(pk)
+        return result
 
     def is_complete(self):
-        return self.chunkedfile_set.count() == self.number_of_chunks
+        # The bitmap, not received_chunks: a chunk counted outside
+        # 0..number_of_chunks - 1 must not make up for a missing one.
+        return has_all_chunks(self.received_bitmap, self.number_of_chunks)
+
+    @property
+    def progress(self):
+        if not self.number_of_chunks:
+            return 0.0
+        return min(self.received_chunks / self.number_of_chunks, 1.0)
+
+    def has_chunk_layout(self):
+        """Whether the size of every chunk is known in advance."""
+        return self.chunking_mode == self.CONTENT_DEFINED or \
+            self.chunk_size is not None
+
+    def expected_chunk_size(self, chunk_number):
+        """
+        Size chunk ``chunk_number`` must have, or ``None`` when it is not
+        known in advance (fixed-size chunking without a negotiated chunk
+        size).
+        """
+        if self.chunking_mode != self.CONTENT_DEFINED:
+            if self.chunk_size is None:
+                return None
+            return max(min(self.chunk_size,
+                           self.file_size - chunk_number * self.chunk_size),
+                       0)
+        start = self.chunk_boundaries[chunk_number - 1] if chunk_number \
+            else 0
+        return self.chunk_boundaries[chunk_number] - start
+
+    def missing_chunks(self):
+        return list(iter_missing_chunks(self.received_bitmap,
+                                        self.number_of_chunks))
+
+    def mark_chunk_received(self, chunk_number, size_delta):
+        """
+        Record that ``chunk_number`` is stored and that the stored bytes
+        changed by ``size_delta``, under a row lock so concurrent chunk
+        uploads don't lose updates.
+        """
+        self._update_received(chunk_number, True, size_delta)
+
+    def mark_chunk_removed(self, chunk_number, size):
+        self._update_received(chunk_number, False, -size)
+
+    def _update_received(self, chunk_number, received, size_delta):
+        with transaction.atomic():
+            locked = MasterFile.objects.select_for_update().only(
+                'received_bitmap').get(pk=self.pk)
+            bitmap = bytes(locked.received_bitmap)
+            changed = has_chunk(bitmap, chunk_number) != received
+            count_delta = (1 if received else -1) if changed else 0
+            MasterFile.objects.filter(pk=self.pk).update(
+                received_bitmap=set_chunk_bit(bitmap, chunk_number,
+                                              received),
+                received_chunks=F('received_chunks') + count_delta,
+                received_bytes=F('received_bytes') + size_delta)
+            self.refresh_from_db(fields=['received_bitmap',
+                                         'received_chunks',
+                                         'received_bytes', 'status'])
+            sessions.store(self)
+
+    def recount_chunks(self):
+        """Rebuild the received-chunk counters from the chunk rows."""
+        bitmap, count, size = b'', 0, 0
+        for chunk_number, chunk_size in self.chunkedfile_set.values_list(
+                'chunk_number', 'size').iterator():
+            bitmap = set_chunk_bit(bitmap, chunk_number)
+            count += 1
+            size += chunk_size or 0
+        MasterFile.objects.filter(pk=self.pk).update(
+            received_bitmap=bitmap, received_chunks=count,
+            received_bytes=size)
+        sessions.forget(self.pk)
+        self.refresh_from_db(fields=['received_bitmap', 'received_chunks',
+                                     'received_bytes'])
+
+
+class ChunkBlob(models.Model):
+    """
+    Chunk content stored once under ``chunk_store/`` and keyed by its
+    SHA-256 digest, shared by every ``ChunkedFile`` with the same bytes.
+    ``ref_count`` is the number of chunks using it; blobs left at zero are
+    kept until garbage collection so a concurrent upload of the same
+    bytes can still reuse them.
+    """
+    DIGEST_ALGORITHM = 'sha256'
+
+    digest = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='chunk_store/')
+    # Size of the chunk content; stored_size is the size of the file, which
+    # differs when the content is stored compressed with codec.
+    size = models.PositiveBigIntegerField()
+    codec = models.CharField(max_length=8, choices=CODEC_CHOICES,
+                             default=NONE)
+    stored_size = models.PositiveBigIntegerField(null=True, blank=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def retain(self):
+        ChunkBlob.objects.filter(pk=self.pk).update(
+            ref_count=F('ref_count') + 1)
+
+    def release(self):
+        ChunkBlob.objects.filter(pk=self.pk, ref_count__gt=0).update(
+            ref_count=F('ref_count') - 1)
+
+    @staticmethod
+    def release_chunks(chunks):
+        """Drop the references the ``chunks`` queryset holds on blobs."""
+        references = chunks.filter(blob__isnull=False).values(
+            'blob').annotate(count=Count('pk')).order_by()
+        for row in references:
+            ChunkBlob.objects.filter(pk=row['blob']).update(
+                ref_count=Greatest(F('ref_count') - row['count'], 0))
 
 
 class ChunkedFile(models.Model):
     master_file = models.ForeignKey(MasterFile, on_delete=models.CASCADE)
     file = models.FileField(upload_to='chunked_files/')
+    # Chunks uploaded before the content-addressed store have no blob and
+    # own their file.
+    blob = models.ForeignKey(ChunkBlob, null=True, blank=True,
+                             on_delete=models.PROTECT)
     chunk_number = models.PositiveIntegerField()
-    md5_checksum = models.CharField(max_length=32)
+    md5_checksum = models.CharField(max_length=128)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    size = models.PositiveBigIntegerField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['master_file', 'chunk_number'],
+                                    name='unique_master_file_chunk_number'),
+        ]
+        indexes = [
+            # Keyset pagination of the list endpoint, over all chunks or
+            # those of one master file, see upload.pagination.
+            models.Index(fields=['uploaded_at', 'id'],
+                         name='chunkedfile_uploaded_at_id'),
+            models.Index(fields=['master_file', 'uploaded_at', 'id'],
+                         name='chunkedfile_master_uploaded_id'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.file and (self.size is None or not self.file._committed):
+            self.size = self.file.size
+        with transaction.atomic():
+            previous_size = 0
+            if not self._state.adding:
+                previous_size = ChunkedFile.objects.filter(
+                    pk=self.pk).values_list('size', flat=True).first() or 0
+            super().save(*args, **kwargs)
+            self.master_file.mark_chunk_received(
+                self.chunk_number, (self.size or 0) - previous_size)
+
+    def delete(self, *args, **kwargs):
+        # QuerySet and cascade deletes skip this: they must release the
+        # blobs with ChunkBlob.release_chunks() first, and
+        # MasterFile.recount_chunks() repairs the counters afterwards.
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            self.master_file.mark_chunk_removed(self.chunk_number,
+                                                self.size or 0)
+            if self.blob_id is not None:
+                self.blob.release()
+        return result
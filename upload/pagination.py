@@ -0,0 +1,104 @@
+"""
+Keyset ("seek") pagination on ``(uploaded_at, id)``, newest first.
+
+Each page continues strictly after the last row of the previous one, so
+the database walks the ``(uploaded_at, id)`` index from that point
+instead of skipping ``OFFSET`` rows, and no ``COUNT(*)`` is run: the cost
+of a page does not depend on its depth or on the size of the table.
+"""
+import base64
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+ORDERING = ('-uploaded_at', '-id')
+
+
+def encode_cursor(row):
+    position = f'{row.uploaded_at.isoformat()}|{row.pk}'
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """``(uploaded_at, id)`` of a cursor; ``ValueError`` if malformed."""
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, UnicodeError):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    uploaded_at, _, pk = position.partition('|')
+    uploaded_at = parse_datetime(uploaded_at)
+    if uploaded_at is None or not pk.isdigit():
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return uploaded_at, int(pk)
+
+
+def keyset_page(queryset, cursor=None, page_size=None):
+    """
+    Rows of ``queryset`` on the page after ``cursor`` (the first page
+    when it is empty) and the cursor of the next page, ``None`` on the
+    last one.
+    """
+    page_size = page_size or settings.LIST_PAGE_SIZE
+    queryset = queryset.order_by(*ORDERING)
+    if cursor:
+        uploaded_at, pk = decode_cursor(cursor)
+        # (uploaded_at, id) < (t, pk), with a plain range on uploaded_at
+        # the index scan can start from.
+        queryset = queryset.filter(uploaded_at__lte=uploaded_at).filter(
+            Q(uploaded_at__lt=uploaded_at) | Q(id__lt=pk))
+    # One extra row tells whether there is a next page.
+    rows = list(queryset[:page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    return rows[:page_size], encode_cursor(rows[page_size - 1])
+
+
+class KeysetPagination(BasePagination):
+    """
+    DRF pagination over ``keyset_page``, answering with ``{"next",
+    "results"}``. ``?page_size=`` picks the page size, up to
+    ``settings.LIST_MAX_PAGE_SIZE``.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        try:
+            rows, self.next_cursor = keyset_page(
+                queryset, request.query_params.get(self.cursor_query_param),
+                self.get_page_size(request))
+        except ValueError as e:
+            raise NotFound(str(e))
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.LIST_PAGE_SIZE
+        return min(max(page_size, 1), settings.LIST_MAX_PAGE_SIZE)
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True,
+                         'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -1,15 +1,283 @@
 from rest_framework import serializers
-from .models import ChunkedFile, MasterFile
+from . import assembly, sessions
+from .archives import COMPRESSION_CHOICES, DEFLATE, FORMAT_CHOICES, ZIP
+from .blobs import acquire_blob
+from .chunking import validate_boundaries
+from .exceptions import ChecksumMismatch
+from .models import ChunkBlob, ChunkedFile, MasterFile
+from .utils import (get_number_of_chunks, negotiate_chunk_size,
+                    uploaded_file_digest)
 
 
 class MasterFileSerializer(serializers.ModelSerializer):
+    """
+    A master file. Fixed-size uploads created with their ``file_size`` get
+    a ``chunk_size`` chosen by the server, from the file size and the
+    ``throughput`` (bytes per second) the client measured, if it sends it,
+    and the matching ``number_of_chunks``.
+    """
+    chunk_boundaries = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False)
+    throughput = serializers.FloatField(min_value=1, required=False,
+                                        write_only=True)
+    upload_session = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MasterFile
+        fields = ['id', 'file_name', 'md5_checksum', 'checksum_algorithm',
+                  'number_of_chunks', 'chunking_mode', 'chunk_boundaries',
+                  'file_size', 'chunk_size', 'throughput', 'status',
+                  'received_chunks', 'received_bytes', 'progress',
+                  'upload_session']
+        read_only_fields = ['chunk_size', 'received_chunks',
+                            'received_bytes', 'progress']
+        extra_kwargs = {'number_of_chunks': {'required': False}}
+
+    def get_upload_session(self, master_file):
+        return sessions.make_token(master_file.pk)
+
+    def validate(self, attrs):
+        def current(name, default):
+            return attrs.get(name, getattr(self.instance, name, default))
+
+        throughput = attrs.pop('throughput', None)
+        fixed = current('chunking_mode', MasterFile.FIXED) != \
+            MasterFile.CONTENT_DEFINED
+        if fixed:
+            self.negotiate_chunk_size(attrs, throughput)
+        if current('number_of_chunks', None) is None:
+            raise serializers.ValidationError(
+                {'number_of_chunks': 'This field is required without '
+                                     'file_size.'})
+        if fixed:
+            return attrs
+        boundaries = current('chunk_boundaries', [])
+        if len(boundaries) != current('number_of_chunks', 0):
+            raise serializers.ValidationError(
+                {'chunk_boundaries': 'Expected one boundary per chunk'})
+        try:
+            validate_boundaries(boundaries)
+        except ValueError as e:
+            raise serializers.ValidationError({'chunk_boundaries': str(e)})
+        return attrs
+
+    def negotiate_chunk_size(self, attrs, throughput):
+        if self.instance is not None:
+            if self.instance.chunk_size is not None and any(
+                    name in attrs and attrs[name] != getattr(self.instance,
+                                                             name)
+                    for name in ('file_size', 'number_of_chunks')):
+                raise serializers.ValidationError(
+                    'The chunks of this upload cannot change')
+            return
+        if attrs.get('file_size') is None:
+            return
+        chunk_size = negotiate_chunk_size(attrs['file_size'], throughput)
+        number_of_chunks = max(
+            get_number_of_chunks(attrs['file_size'], chunk_size), 1)
+        if attrs.get('number_of_chunks', number_of_chunks) != \
+                number_of_chunks:
+            raise serializers.ValidationError(
+                {'number_of_chunks': f'Expected {number_of_chunks} chunks '
+                                     f'of {chunk_size} bytes'})
+        attrs.update(chunk_size=chunk_size,
+                     number_of_chunks=number_of_chunks)
+
+    def create(self, validated_data):
+        master_file = super().create(validated_data)
+        if assembly.can_assemble(master_file):
+            assembly.preallocate(master_file)
+        return master_file
+
+
+class MasterFileListSerializer(serializers.ModelSerializer):
+    """Lean representation of master files on list pages."""
+
     class Meta:
         model = MasterFile
-        fields = ['id', 'file_name', 'md5_checksum',
-                  'number_of_chunks', 'status']
+        fields = ['id', 'file_name', 'status', 'number_of_chunks',
+                  'received_chunks', 'received_bytes', 'progress',
+                  'uploaded_at']
+        read_only_fields = fields
+
+
+def validate_chunk_number(master_file, chunk_number):
+    if not 0 <= chunk_number < master_file.number_of_chunks:
+        raise serializers.ValidationError(
+            {'chunk_number': 'Chunk number out of range'})
+
+
+class SessionMasterFileField(serializers.PrimaryKeyRelatedField):
+    """Master file looked up through its cached upload session."""
+
+    def to_internal_value(self, data):
+        try:
+            return MasterFile.objects.get_session(data)
+        except MasterFile.DoesNotExist:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
 
 
 class ChunkedFileSerializer(serializers.ModelSerializer):
+    """
+    A chunk of ``master_file``, or of the master file of the upload session
+    given as the ``upload_session`` context (see ``upload.sessions``).
+    """
+    master_file = SessionMasterFileField(queryset=MasterFile.objects.all(),
+                                         required=False)
+
     class Meta:
         model = ChunkedFile
         fields = '__all__'
+        read_only_fields = ['size', 'blob']
+        # Re-uploading a chunk number replaces it, see
+        # ChunkedFileModelViewSet.create.
+        validators = []
+
+    def validate(self, attrs):
+        self.validate_session(attrs)
+        master_file = attrs.get('master_file') or \
+            getattr(self.instance, 'master_file', None)
+        chunk_number = attrs.get('chunk_number',
+                                 getattr(self.instance, 'chunk_number', 0))
+        if master_file is not None:
+            validate_chunk_number(master_file, chunk_number)
+        file = attrs.get('file')
+        if file is None:
+            return attrs
+        if master_file.has_chunk_layout():
+            expected = master_file.expected_chunk_size(chunk_number)
+            if file.size != expected:
+                raise serializers.ValidationError(
+                    {'file': f'Chunk {chunk_number} must be {expected} '
+                             f'bytes long'})
+        checksum = attrs.get('md5_checksum') or self.instance.md5_checksum
+        digest = uploaded_file_digest(file, master_file.checksum_algorithm)
+        if digest != checksum.lower():
+            raise ChecksumMismatch(
+                f'Chunk {attrs.get("chunk_number")} does not match its '
+                f'{master_file.checksum_algorithm} checksum')
+        return attrs
+
+    def validate_session(self, attrs):
+        session = self.context.get('upload_session')
+        if session is None:
+            if 'master_file' not in attrs and not self.partial:
+                raise serializers.ValidationError(
+                    {'master_file': self.fields['master_file'].error_messages[
+                        'required']})
+            return
+        if 'master_file' in attrs and attrs['master_file'].pk != session:
+            raise serializers.ValidationError(
+                {'master_file': 'Does not match the upload session'})
+        try:
+            attrs['master_file'] = MasterFile.objects.get_session(session)
+        except MasterFile.DoesNotExist:
+            raise serializers.ValidationError(
+                {'master_file': 'The upload session no longer exists'})
+
+    def create(self, validated_data):
+        self.store_blob(validated_data)
+        return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        previous_blob, previous_name = instance.blob, instance.file.name
+        self.store_blob(validated_data)
+        instance = super().update(instance, validated_data)
+        if 'file' in validated_data:
+            if previous_blob is not None:
+                previous_blob.release()
+            elif previous_name != instance.file.name:
+                instance.file.storage.delete(previous_name)
+        return instance
+
+    def store_blob(self, validated_data):
+        """
+        Point the chunk at the shared blob holding the uploaded bytes, or
+        write them into the assembled file of its master file (see
+        ``upload.assembly``).
+        """
+        file = validated_data.get('file')
+        if file is None:
+            return
+        master_file = validated_data.get('master_file') or \
+            self.instance.master_file
+        if master_file.assembly_file:
+            chunk_number = validated_data.get('chunk_number',
+                                              getattr(self.instance,
+                                                      'chunk_number', 0))
+            size = assembly.write_upload(master_file, chunk_number, file)
+            validated_data.update(file='', blob=None, size=size)
+            return
+        blob = acquire_blob(file, uploaded_file_digest(
+            file, ChunkBlob.DIGEST_ALGORITHM))
+        validated_data.update(file=blob.file.name, blob=blob, size=blob.size)
+
+
+class ChunkedFileListSerializer(serializers.ModelSerializer):
+    """
+    Lean representation of chunks on list pages, without the file URL,
+    which may cost a storage call per chunk.
+    """
+
+    class Meta:
+        model = ChunkedFile
+        fields = ['id', 'master_file', 'chunk_number', 'md5_checksum',
+                  'size', 'uploaded_at']
+        read_only_fields = fields
+
+
+class ChunkDigestSerializer(serializers.Serializer):
+    chunk_number = serializers.IntegerField(min_value=0)
+    # SHA-256, the digest the chunk store is keyed by.
+    digest = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+
+
+class ChunkReferenceSerializer(ChunkDigestSerializer):
+    md5_checksum = serializers.CharField(max_length=128)
+
+
+class ChunkDigestListSerializer(serializers.Serializer):
+    """Chunks of the ``master_file`` given as context."""
+    chunks = ChunkDigestSerializer(many=True)
+
+    def validate_chunks(self, chunks):
+        for chunk in chunks:
+            validate_chunk_number(self.context['master_file'],
+                                  chunk['chunk_number'])
+        return chunks
+
+
+class ChunkReferenceListSerializer(ChunkDigestListSerializer):
+    chunks = ChunkReferenceSerializer(many=True)
+
+
+class ArchiveRequestSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(),
+                                required=False)
+    prefix = serializers.CharField(required=False)
+    # Not "format", which DRF reads to pick a renderer.
+    archive_format = serializers.ChoiceField(choices=FORMAT_CHOICES,
+                                             default=ZIP)
+    compression = serializers.ChoiceField(choices=COMPRESSION_CHOICES,
+                                          default=DEFLATE)
+
+
+class MergeStatusSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MasterFile
+        fields = ['id', 'status', 'merged_bytes', 'merge_error']
+
+    def to_representation(self, master_file):
+        data = super().to_representation(master_file)
+        total_bytes = master_file.received_bytes
+        if master_file.status == MasterFile.COMPLETED:
+            progress = 1.0
+        elif total_bytes:
+            progress = min(master_file.merged_bytes / total_bytes, 1.0)
+        else:
+            progress = 0.0
+        data['total_bytes'] = total_bytes
+        data['progress'] = progress
+        return data
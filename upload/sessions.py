@@ -0,0 +1,163 @@
+"""
+Upload sessions: the metadata of a master file that chunk uploads and the
+endpoints polled during an upload read (chunk count and layout, checksum
+algorithm, status, merged file and received-chunk bitmap), cached so
+steady-state chunk ingestion runs almost no metadata queries. See
+``MasterFile.objects.get_session``.
+
+Sessions are looked up in a process-local LRU of
+``settings.UPLOAD_SESSION_LRU_SIZE`` entries, each trusted for
+``settings.UPLOAD_SESSION_LOCAL_TTL`` seconds since other processes cannot
+invalidate it, then in the shared cache ``settings.UPLOAD_SESSION_CACHE``
+names, if any, then in the database. Recording a received chunk replaces
+the cached session once committed; other writes to a master file drop it.
+
+Every master file also has a signed session token naming it, which chunk
+uploads can send in the ``X-Upload-Session`` header instead of the
+``master_file`` field.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.db import transaction
+
+SESSION_HEADER = 'X-Upload-Session'
+TOKEN_SALT = 'upload.session'
+FIELDS = ('id', 'file', 'file_name', 'md5_checksum', 'checksum_algorithm',
+          'number_of_chunks', 'chunking_mode', 'chunk_boundaries',
+          'file_size', 'chunk_size', 'assembly_file', 'status',
+          'received_chunks', 'received_bytes', 'received_bitmap')
+# Version of the shared cache entries, to bump whenever FIELDS change.
+VERSION = 3
+
+
+class LRUCache:
+    """Thread-safe LRU cache whose entries expire ``ttl`` seconds after set."""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size():
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local = LRUCache(lambda: settings.UPLOAD_SESSION_LRU_SIZE,
+                  lambda: settings.UPLOAD_SESSION_LOCAL_TTL)
+
+
+def make_token(master_file_id):
+    return signing.dumps(master_file_id, salt=TOKEN_SALT)
+
+
+def read_token(token):
+    """Master file id of a session token; raises ``BadSignature``."""
+    return signing.loads(token, salt=TOKEN_SALT,
+                         max_age=settings.UPLOAD_SESSION_MAX_AGE)
+
+
+def get(master_file_id):
+    """Cached values of ``FIELDS`` for ``master_file_id``, or ``None``."""
+    key = _key(master_file_id)
+    values = _local.get(key)
+    shared = _shared_cache()
+    if values is None and shared is not None:
+        values = shared.get(key, version=VERSION)
+        if values is not None:
+            _local.set(key, values)
+    return values
+
+
+def put(master_file_id, values):
+    """Cache the values of ``FIELDS`` for ``master_file_id``."""
+    values = _normalize(values)
+    key = _key(master_file_id)
+    _local.set(key, values)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(key, values, settings.UPLOAD_SESSION_CACHE_TIMEOUT,
+                   version=VERSION)
+    return values
+
+
+def store(master_file):
+    """
+    Cache the session of ``master_file`` once the current transaction
+    commits, or drop it if some of its fields were not loaded.
+    """
+    if master_file.get_deferred_fields() & set(FIELDS):
+        forget(master_file.pk)
+        return
+    values = [getattr(master_file, name) for name in FIELDS]
+    transaction.on_commit(partial(put, master_file.pk, values))
+
+
+def forget(*master_file_ids):
+    """
+    Drop the cached sessions of ``master_file_ids`` now and again once the
+    current transaction commits, when readers see the new row.
+    """
+    _delete(master_file_ids)
+    transaction.on_commit(partial(_delete, master_file_ids))
+
+
+def clear():
+    _local.clear()
+
+
+def _delete(master_file_ids):
+    keys = [_key(master_file_id) for master_file_id in master_file_ids]
+    for key in keys:
+        _local.delete(key)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete_many(keys, version=VERSION)
+
+
+def _key(master_file_id):
+    return f'upload-session:{int(master_file_id)}'
+
+
+def _normalize(values):
+    values = dict(zip(FIELDS, values))
+    # A FieldFile when taken from a model, and memoryview from PostgreSQL.
+    values['file'] = getattr(values['file'], 'name', values['file'])
+    values['received_bitmap'] = bytes(values['received_bitmap'])
+    return tuple(values[name] for name in FIELDS)
+
+
+def _shared_cache():
+    if not settings.UPLOAD_SESSION_CACHE:
+        return None
+    return caches[settings.UPLOAD_SESSION_CACHE]
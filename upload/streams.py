@@ -0,0 +1,210 @@
+import errno
+import io
+import os
+from bisect import bisect_right
+from itertools import accumulate
+
+from django.conf import settings
+
+from .compression import NONE, decompressor
+from .exceptions import ChunkTooLarge
+
+# Errors meaning "this kernel/filesystem cannot do it", not "the copy failed".
+_KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def get_buffer_size(buffer_size=None):
+    return buffer_size or settings.MERGE_BUFFER_SIZE
+
+
+def copy_stream(source, destination, buffer_size=None, hasher=None,
+                max_size=None):
+    """
+    Copy ``source`` into ``destination`` through a single reusable buffer,
+    so memory use is bounded by ``buffer_size`` whatever the stream length.
+    Copied bytes are fed to ``hasher`` if one is given. Returns the number
+    of bytes copied, or raises ``ChunkTooLarge`` before writing more than
+    ``max_size`` of them.
+    """
+    buffer = bytearray(get_buffer_size(buffer_size))
+    view = memoryview(buffer)
+    readinto = getattr(source, 'readinto', None)
+    copied = 0
+    while True:
+        if readinto is not None:
+            read = readinto(buffer)
+            data = view[:read]
+        else:
+            data = source.read(len(buffer))
+            read = len(data)
+        if not read:
+            break
+        if max_size is not None and copied + read > max_size:
+            raise ChunkTooLarge(f'Chunk is larger than {max_size} bytes')
+        if hasher is not None:
+            hasher.update(data)
+        _write_all(destination, data)
+        copied += read
+    return copied
+
+
+def _write_all(destination, data):
+    # Unbuffered (raw) files may accept only part of the data per call.
+    data = memoryview(data)
+    while data:
+        written = destination.write(data)
+        if written is None or written == len(data):
+            return
+        data = data[written:]
+
+
+def kernel_copy(source_fd, destination_fd, buffer_size=None):
+    """
+    Append the remaining content of ``source_fd`` to ``destination_fd``
+    without moving the bytes through user space, using
+    ``os.copy_file_range`` or ``os.sendfile`` when the platform supports
+    them. Returns the number of bytes copied, or ``None`` when neither
+    call is usable and the caller should fall back to ``copy_stream``.
+    """
+    step = get_buffer_size(buffer_size)
+    remaining = os.fstat(source_fd).st_size - os.lseek(source_fd, 0,
+                                                       os.SEEK_CUR)
+    for syscall in _kernel_copy_calls():
+        copied = 0
+        try:
+            while copied < remaining:
+                sent = syscall(source_fd, destination_fd,
+                               min(step, remaining - copied))
+                if not sent:
+                    break
+                copied += sent
+            return copied
+        except OSError as e:
+            if copied or e.errno not in _KERNEL_COPY_FALLBACK_ERRNOS:
+                raise
+    return None
+
+
+def _kernel_copy_calls():
+    if hasattr(os, 'copy_file_range'):
+        yield lambda src, dst, count: os.copy_file_range(src, dst, count)
+    if hasattr(os, 'sendfile'):
+        yield lambda src, dst, count: os.sendfile(dst, src, None, count)
+
+
+def chunk_size(chunk):
+    if chunk.size is None:
+        return chunk.file.size
+    return chunk.size
+
+
+def chunk_codec(chunk):
+    """Codec the content of ``chunk`` is stored with."""
+    if chunk.blob_id is None:
+        return NONE
+    return chunk.blob.codec
+
+
+class ChunkStream(io.RawIOBase):
+    """
+    Seekable read-only stream over the given ``ChunkedFile`` objects laid
+    back to back, as if they were the merged file. Only the chunk covering
+    the current position is open at any time; seeking finds it by bisecting
+    the cumulative chunk offsets.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = list(chunks)
+        self._offsets = list(accumulate(map(chunk_size, self._chunks),
+                                        initial=0))
+        self._position = 0
+        self._index = None
+        self._raw = None
+        self._current = None
+
+    @property
+    def size(self):
+        return self._offsets[-1]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f'Invalid whence ({whence})')
+        if offset < 0:
+            raise ValueError(f'Negative seek position {offset}')
+        self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        index = bisect_right(self._offsets, self._position) - 1
+        start, end = self._offsets[index], self._offsets[index + 1]
+        current = self._open(index)
+        offset = self._position - start
+        if current.tell() != offset:
+            if current.tell() > offset and current is not self._raw:
+                # Decompressors cannot seek backwards cheaply, if at all.
+                self._close_current()
+                current = self._open(index)
+            current.seek(offset)
+        view = memoryview(buffer)[:end - self._position]
+        read = current.readinto(view)
+        if not read:
+            raise IOError(f'Chunk {self._chunks[index].chunk_number} is '
+                          f'shorter than its recorded size')
+        self._position += read
+        return read
+
+    def _open(self, index):
+        if self._index != index:
+            self._close_current()
+            chunk = self._chunks[index]
+            self._raw = chunk.file.open('rb')
+            self._current = decompressor(chunk_codec(chunk), self._raw)
+            self._index = index
+        return self._current
+
+    def _close_current(self):
+        if self._current is not None:
+            self._current.close()
+            self._raw.close()
+            self._current = self._raw = None
+            self._index = None
+
+    def close(self):
+        self._close_current()
+        super().close()
+
+
+class DigestStream(io.RawIOBase):
+    """Pass-through reader feeding every byte read to ``hasher``."""
+
+    def __init__(self, raw, hasher):
+        self._raw = raw
+        self.hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        read = self._raw.readinto(buffer)
+        self.hasher.update(memoryview(buffer)[:read])
+        return read
+
+    def close(self):
+        self._raw.close()
+        super().close()
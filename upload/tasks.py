@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import metrics, sessions
+from .merge import merge_chunks
+from .models import MasterFile
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.MERGE_WORKERS,
+                thread_name_prefix='merge')
+        return _executor
+
+
+def schedule_merge(master_file_id):
+    """
+    Queue a merge of ``master_file_id`` on the local worker pool once the
+    current transaction commits, or run it right away when
+    ``settings.MERGE_ASYNC`` is off.
+    """
+    if not settings.MERGE_ASYNC:
+        run_merge(master_file_id)
+        return
+    transaction.on_commit(
+        lambda: get_executor().submit(_run_in_worker, master_file_id))
+
+
+def _run_in_worker(master_file_id):
+    try:
+        run_merge(master_file_id)
+    except Exception:
+        logger.exception('Merge of master file %s crashed', master_file_id)
+    finally:
+        connections.close_all()
+
+
+def abandoned_merges(now=None):
+    """
+    Condition on master files left ``merging`` by a worker that gave no
+    sign of life for ``settings.MERGE_CLAIM_TIMEOUT`` seconds.
+    """
+    cutoff = (now or timezone.now()) - timedelta(
+        seconds=settings.MERGE_CLAIM_TIMEOUT)
+    return Q(status=MasterFile.MERGING) & (
+        Q(merge_heartbeat__lt=cutoff) | Q(merge_heartbeat__isnull=True))
+
+
+def run_merge(master_file_id):
+    """
+    Merge the chunks of ``master_file_id``, moving it through
+    ``merging`` to ``completed`` or ``failed``. Returns ``False`` without
+    doing anything when the file is already being merged or is merged.
+
+    The worker refreshes ``merge_heartbeat`` as the merge advances; a
+    merge whose heartbeat stopped (see ``abandoned_merges``) is claimed
+    again, so a worker restarted mid-merge does not leave the file
+    ``merging`` forever.
+    """
+    files = MasterFile.objects.filter(pk=master_file_id)
+    claimed = files.filter(
+        ~Q(status__in=[MasterFile.MERGING, MasterFile.COMPLETED]) |
+        abandoned_merges()
+    ).update(status=MasterFile.MERGING, merged_bytes=0, merge_error='',
+             merge_heartbeat=timezone.now())
+    if not claimed:
+        return False
+    sessions.forget(master_file_id)
+
+    reported = 0
+    beat = time.monotonic()
+
+    def progress(merged_bytes):
+        nonlocal reported, beat
+        if merged_bytes - reported >= settings.MERGE_PROGRESS_STEP or \
+                time.monotonic() - beat >= settings.MERGE_CLAIM_TIMEOUT / 4:
+            files.update(merged_bytes=merged_bytes,
+                         merge_heartbeat=timezone.now())
+            reported = merged_bytes
+            beat = time.monotonic()
+
+    started = time.perf_counter()
+    try:
+        merged_bytes = merge_chunks(files.get(), progress=progress)
+    except Exception as e:
+        logger.exception('Merge of master file %s failed', master_file_id)
+        files.update(status=MasterFile.FAILED, merge_error=str(e))
+        sessions.forget(master_file_id)
+        metrics.MERGE_SECONDS.observe(time.perf_counter() - started,
+                                      result='failed')
+    else:
+        files.update(status=MasterFile.COMPLETED, merged_bytes=merged_bytes,
+                     merged_at=timezone.now())
+        sessions.forget(master_file_id)
+        metrics.MERGE_SECONDS.observe(time.perf_counter() - started,
+                                      result='completed')
+        metrics.MERGE_BYTES.observe(merged_bytes)
+    return True
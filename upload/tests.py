@@ -1,13 +1,39 @@
-from django.test import TestCase
+from django.test import AsyncClient, TestCase
 from rest_framework.test import APIClient
 from rest_framework import status
 from django.urls import reverse
-from .models import (MasterFile, ChunkedFile)
-from .utils import get_number_of_chunks
+from .models import (MasterFile, ChunkBlob, ChunkedFile)
+from .utils import (get_number_of_chunks, missing_chunk_ranges,
+                    negotiate_chunk_size, set_chunk_bit)
+from . import (archives, backends, chunking, compression, downloads, merge,
+               metrics, sessions, streams, tasks)
+from .blobs import acquire_blob, blob_name, get_blob_storage, store_stream
+from .cleanup import Sweeper
+from .exceptions import ChecksumMismatch, ChunkTooLarge
 import hashlib
+import importlib
+import io
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import threading
+import tracemalloc
+from datetime import timedelta
+import zipfile
+from unittest import mock
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management import call_command
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+import XDrive.asgi
 
 
 class Creator:
@@ -41,9 +67,21 @@ class Creator:
         return response
 
 
+def metric_sample(name, **labels):
+    """Current value of the metric sample ``name{labels}``, 0 if absent."""
+    label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+    prefix = f'{name}{{{label_text}}} ' if labels else f'{name} '
+    for line in metrics.render().splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return 0
+
+
+@override_settings(MERGE_ASYNC=False)
 class FileUploadTests(TestCase):
 
     def setUp(self):
+        sessions.clear()
         self.client = APIClient()
         self.master_file_url = reverse('masterfile-list')
         self.chunked_file_url = reverse('chunkedfile-list')
@@ -314,3 +352,2154 @@ class FileUploadTests(TestCase):
         self.test_file_content = b"Master file content" * self.chunk_size * 2
         MasterFile.objects.all().delete()
         ChunkedFile.objects.all().delete()
+
+
+class MediaRootMixin:
+    """Run each test against a throwaway MEDIA_ROOT."""
+
+    def setUp(self):
+        super().setUp()
+        # Test databases reuse ids, which cached sessions would outlive.
+        sessions.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.media_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_override.enable()
+
+    def tearDown(self):
+        self.media_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+        super().tearDown()
+
+    def create_master_file(self, chunks, file_name='merged.bin'):
+        content = b''.join(chunks)
+        master_file = MasterFile.objects.create(
+            file_name=file_name,
+            md5_checksum=hashlib.md5(content).hexdigest(),
+            number_of_chunks=len(chunks))
+        for number, chunk in enumerate(chunks):
+            self.create_chunk(master_file, number, chunk)
+        return master_file, content
+
+    def create_chunk(self, master_file, chunk_number, chunk):
+        chunked_file = ChunkedFile(
+            master_file=master_file, chunk_number=chunk_number,
+            md5_checksum=hashlib.md5(chunk).hexdigest())
+        chunked_file.file.save(f'chunk-{chunk_number}', ContentFile(chunk),
+                               save=False)
+        chunked_file.save()
+        return chunked_file
+
+
+class MergeEngineTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.chunks = [bytes([i]) * (64 * 1024 + i) for i in range(5)]
+
+    def test_merge_concatenates_chunks_in_order(self):
+        master_file, _ = self.create_master_file([])
+        master_file.md5_checksum = hashlib.md5(
+            b''.join(self.chunks)).hexdigest()
+        master_file.save()
+        for number in reversed(range(len(self.chunks))):
+            self.create_chunk(master_file, number, self.chunks[number])
+
+        size = merge.merge_chunks(master_file, buffer_size=4096)
+
+        master_file.refresh_from_db()
+        with master_file.file.open('rb') as f:
+            self.assertEqual(f.read(), b''.join(self.chunks))
+        self.assertEqual(size, sum(map(len, self.chunks)))
+
+    def test_merge_without_kernel_copy_matches(self):
+        master_file, content = self.create_master_file(self.chunks)
+
+        with mock.patch.object(merge, 'kernel_copy', return_value=None):
+            merge.merge_chunks(master_file, buffer_size=4096)
+
+        with master_file.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_remerge_replaces_previous_file(self):
+        master_file, content = self.create_master_file(self.chunks)
+        merge.merge_chunks(master_file)
+        first_path = master_file.file.path
+
+        merge.merge_chunks(master_file)
+
+        self.assertNotEqual(master_file.file.path, first_path)
+        self.assertFalse(master_file.file.storage.exists(first_path))
+
+    def test_copy_stream_memory_is_bounded_by_buffer(self):
+        master_file, content = self.create_master_file(self.chunks)
+        chunks = master_file.chunkedfile_set.order_by('chunk_number')
+        destination = tempfile.TemporaryFile(dir=self.media_root)
+        buffer_size = 8 * 1024
+
+        tracemalloc.start()
+        with streams.ChunkStream(chunks) as source, destination:
+            copied = streams.copy_stream(source, destination, buffer_size)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        self.assertEqual(copied, len(content))
+        self.assertLess(peak, len(content) // 4)
+
+
+class DownloadTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.download_url = reverse('chunkedfile-download-file')
+        self.master_file, self.content = self.create_master_file(
+            [bytes(range(256)) * 40, b'tail' * 100])
+        merge.merge_chunks(self.master_file)
+
+    def download(self, **headers):
+        return self.client.get(
+            f'{self.download_url}?master_file_id={self.master_file.id}',
+            **headers)
+
+    def test_parse_range_header(self):
+        parse = downloads.parse_range_header
+        self.assertIsNone(parse(None, 100))
+        self.assertIsNone(parse('items=0-1', 100))
+        self.assertIsNone(parse('bytes=5-1', 100))
+        self.assertEqual(parse('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(parse('bytes=90-', 100), [(90, 99)])
+        self.assertEqual(parse('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(parse('bytes=0-9,5-20,50-60', 100),
+                         [(0, 20), (50, 60)])
+        self.assertEqual(parse('bytes=200-300', 100), [])
+
+    def test_full_download_streams_file(self):
+        response = self.download()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['ETag'],
+                         f'"{self.master_file.md5_checksum}"')
+        self.assertEqual(int(response['Content-Length']), len(self.content))
+
+    def test_single_range(self):
+        response = self.download(HTTP_RANGE='bytes=100-199')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[100:200])
+        self.assertEqual(response['Content-Range'],
+                         f'bytes 100-199/{len(self.content)}')
+
+    def test_multiple_ranges(self):
+        response = self.download(HTTP_RANGE='bytes=0-9,-4')
+
+        body = b''.join(response.streaming_content)
+        self.assertEqual(response.status_code,
+                         status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response['Content-Type'].startswith(
+            'multipart/byteranges; boundary='))
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(self.content[:10], body)
+        self.assertIn(b'Content-Range: bytes %d-%d/%d' % (
+            len(self.content) - 4, len(self.content) - 1, len(self.content)),
+            body)
+
+    def test_if_range_mismatch_serves_whole_file(self):
+        response = self.download(HTTP_RANGE='bytes=0-9',
+                                 HTTP_IF_RANGE='"stale"')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_unsatisfiable_range(self):
+        response = self.download(HTTP_RANGE='bytes=999999-')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'],
+                         f'bytes */{len(self.content)}')
+
+    def test_if_none_match_returns_not_modified(self):
+        response = self.download(
+            HTTP_IF_NONE_MATCH=f'"{self.master_file.md5_checksum}"')
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @override_settings(DOWNLOAD_OFFLOAD='x-accel-redirect')
+    def test_accel_redirect_offload(self):
+        response = self.download()
+
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/media/' + self.master_file.file.name)
+        self.assertEqual(response.content, b'')
+
+
+class VirtualDownloadTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.download_url = reverse('chunkedfile-download-file')
+        self.master_file, self.content = self.create_master_file(
+            [b'a' * 1000, b'', b'b' * 10, b'c' * 500])
+
+    def download(self, **headers):
+        return self.client.get(
+            f'{self.download_url}?master_file_id={self.master_file.id}',
+            **headers)
+
+    def test_chunk_size_is_recorded(self):
+        sizes = self.master_file.chunkedfile_set.order_by(
+            'chunk_number').values_list('size', flat=True)
+        self.assertEqual(list(sizes), [1000, 0, 10, 500])
+
+    def test_chunk_stream_seeks_across_chunks(self):
+        stream = streams.ChunkStream(
+            self.master_file.chunkedfile_set.order_by('chunk_number'))
+
+        self.assertEqual(stream.size, len(self.content))
+        with io.BufferedReader(stream) as reader:
+            reader.seek(995)
+            self.assertEqual(reader.read(20), self.content[995:1015])
+            reader.seek(-3, io.SEEK_END)
+            self.assertEqual(reader.read(), b'ccc')
+            reader.seek(0)
+            self.assertEqual(reader.read(), self.content)
+
+    def test_download_without_merged_file(self):
+        response = self.download()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertFalse(MasterFile.objects.get(
+            id=self.master_file.id).file)
+
+    def test_range_spanning_chunk_boundary(self):
+        response = self.download(HTTP_RANGE='bytes=998-1011')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[998:1012])
+
+    def test_incomplete_upload_is_not_downloadable(self):
+        self.master_file.number_of_chunks += 1
+        self.master_file.save()
+
+        response = self.download()
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BackgroundMergeTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunked_file_url = reverse('chunkedfile-list')
+        self.merge_chunks_url = reverse('chunkedfile-merge-chunks')
+        self.merge_status_url = reverse('chunkedfile-merge-status')
+        self.chunks = [b'first chunk ', b'second chunk ', b'last chunk']
+
+    def upload_chunks(self, master_file, numbers):
+        for number in numbers:
+            Creator.post_chunked_file(
+                self.client, self.chunked_file_url, master_file.id,
+                f'chunk-{number}', self.chunks[number], number,
+                hashlib.md5(self.chunks[number]).hexdigest(), timezone.now())
+
+    @override_settings(MERGE_ASYNC=False)
+    def test_last_chunk_triggers_merge(self):
+        master_file, content = self.create_master_file([])
+        master_file.number_of_chunks = len(self.chunks)
+        master_file.md5_checksum = hashlib.md5(
+            b''.join(self.chunks)).hexdigest()
+        master_file.save()
+
+        self.upload_chunks(master_file, [0, 1])
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.PENDING)
+
+        self.upload_chunks(master_file, [2])
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.COMPLETED)
+        self.assertEqual(master_file.merged_bytes,
+                         sum(map(len, self.chunks)))
+        with master_file.file.open('rb') as f:
+            self.assertEqual(f.read(), b''.join(self.chunks))
+
+    @override_settings(MERGE_ASYNC=True, MERGE_ON_COMPLETE=False)
+    def test_merge_is_queued_on_worker_pool(self):
+        master_file, _ = self.create_master_file(self.chunks)
+        executor = mock.Mock()
+
+        with mock.patch.object(tasks, 'get_executor', return_value=executor):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(
+                    f'{self.merge_chunks_url}?master_file_id='
+                    f'{master_file.id}')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], MasterFile.PENDING)
+        executor.submit.assert_called_once_with(tasks._run_in_worker,
+                                                master_file.id)
+
+    def test_merge_status_reports_progress(self):
+        master_file, content = self.create_master_file(self.chunks)
+        tasks.run_merge(master_file.id)
+
+        response = self.client.get(
+            f'{self.merge_status_url}?master_file_id={master_file.id}')
+
+        self.assertEqual(response.data['status'], MasterFile.COMPLETED)
+        self.assertEqual(response.data['merged_bytes'], len(content))
+        self.assertEqual(response.data['total_bytes'], len(content))
+        self.assertEqual(response.data['progress'], 1.0)
+
+    def test_merge_runs_only_once(self):
+        master_file, _ = self.create_master_file(self.chunks)
+
+        self.assertTrue(tasks.run_merge(master_file.id))
+        self.assertFalse(tasks.run_merge(master_file.id))
+
+    def test_abandoned_merge_is_claimed_again(self):
+        master_file, content = self.create_master_file(self.chunks)
+        # Left merging by a worker that died an hour ago.
+        MasterFile.objects.filter(pk=master_file.pk).update(
+            status=MasterFile.MERGING,
+            merge_heartbeat=timezone.now() - timedelta(hours=1))
+
+        self.assertTrue(tasks.run_merge(master_file.id))
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.COMPLETED)
+        with master_file.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_live_merge_is_not_claimed_again(self):
+        master_file, _ = self.create_master_file(self.chunks)
+        MasterFile.objects.filter(pk=master_file.pk).update(
+            status=MasterFile.MERGING, merge_heartbeat=timezone.now())
+
+        self.assertFalse(tasks.run_merge(master_file.id))
+
+    def test_sweeper_fails_abandoned_merges(self):
+        master_file, _ = self.create_master_file(self.chunks)
+        MasterFile.objects.filter(pk=master_file.pk).update(
+            status=MasterFile.MERGING,
+            merge_heartbeat=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(Sweeper().fail_abandoned_merges(), 1)
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.FAILED)
+        self.assertTrue(master_file.merge_error)
+
+    def test_failed_merge_is_recorded(self):
+        master_file, _ = self.create_master_file(self.chunks)
+        chunk = master_file.chunkedfile_set.first()
+        chunk.file.storage.delete(chunk.file.name)
+
+        with self.assertLogs('upload.tasks', level='ERROR'):
+            tasks.run_merge(master_file.id)
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.FAILED)
+        self.assertTrue(master_file.merge_error)
+        self.assertFalse(master_file.file)
+
+
+class ChunkUpsertTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunked_file_url = reverse('chunkedfile-list')
+        self.last_chunk_url = reverse('chunkedfile-last-chunk')
+        self.master_file, _ = self.create_master_file([])
+        self.master_file.number_of_chunks = 3
+        self.master_file.save()
+
+    def post_chunk(self, number, chunk):
+        return Creator.post_chunked_file(
+            self.client, self.chunked_file_url, self.master_file.id,
+            f'chunk-{number}', chunk, number,
+            hashlib.md5(chunk).hexdigest(), timezone.now())
+
+    def test_reupload_replaces_chunk(self):
+        first = self.post_chunk(0, b'first attempt')
+        old_name = ChunkedFile.objects.get().file.name
+
+        second = self.post_chunk(0, b'retry')
+
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        chunk = ChunkedFile.objects.get()
+        self.assertEqual(chunk.id, first.data['id'])
+        self.assertEqual(chunk.file.read(), b'retry')
+        self.assertEqual(chunk.size, len(b'retry'))
+        # The old content stays in the store, unreferenced, until collected.
+        self.assertEqual(ChunkBlob.objects.get(file=old_name).ref_count, 0)
+
+    def test_merged_chunks_cannot_be_replaced(self):
+        self.post_chunk(0, b'data')
+        MasterFile.objects.filter(id=self.master_file.id).update(
+            status=MasterFile.COMPLETED)
+
+        response = self.post_chunk(0, b'other data')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_chunk_number_out_of_range_is_rejected(self):
+        for number in (3, 7, -1):
+            response = self.post_chunk(number, b'data')
+
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(ChunkedFile.objects.exists())
+
+    def test_last_chunk_is_highest_number(self):
+        for number in (2, 0, 1):
+            self.post_chunk(number, b'x')
+
+        response = self.client.get(
+            f'{self.last_chunk_url}?master_file_id={self.master_file.id}')
+
+        self.assertEqual(response.data['chunk_number'], 2)
+
+
+class ReceivedChunksTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.master_file, _ = self.create_master_file([])
+        self.master_file.number_of_chunks = 4
+        self.master_file.save()
+
+    def test_counters_follow_chunk_uploads(self):
+        self.create_chunk(self.master_file, 3, b'abc')
+        self.create_chunk(self.master_file, 0, b'defg')
+
+        master_file = MasterFile.objects.get(id=self.master_file.id)
+        self.assertEqual(master_file.received_chunks, 2)
+        self.assertEqual(master_file.received_bytes, 7)
+        self.assertEqual(master_file.progress, 0.5)
+        self.assertEqual(master_file.missing_chunks(), [1, 2])
+        self.assertFalse(master_file.is_complete())
+
+    def test_replacing_a_chunk_adjusts_bytes_only(self):
+        chunk = self.create_chunk(self.master_file, 1, b'abc')
+        chunk.file = SimpleUploadedFile('retry', b'abcdef')
+        chunk.save()
+
+        self.master_file.refresh_from_db()
+        self.assertEqual(self.master_file.received_chunks, 1)
+        self.assertEqual(self.master_file.received_bytes, 6)
+
+    def test_deleting_a_chunk_clears_it(self):
+        chunk = self.create_chunk(self.master_file, 2, b'abc')
+
+        chunk.delete()
+
+        self.master_file.refresh_from_db()
+        self.assertEqual(self.master_file.received_chunks, 0)
+        self.assertEqual(self.master_file.received_bytes, 0)
+        self.assertEqual(self.master_file.missing_chunks(), [0, 1, 2, 3])
+
+    def test_is_complete_reads_one_row(self):
+        for number in range(4):
+            self.create_chunk(self.master_file, number, b'x')
+        master_file = MasterFile.objects.get(id=self.master_file.id)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(master_file.is_complete())
+            self.assertEqual(master_file.missing_chunks(), [])
+
+    def test_is_complete_needs_every_chunk_number(self):
+        # Counted chunks beyond number_of_chunks do not fill a gap.
+        MasterFile.objects.filter(id=self.master_file.id).update(
+            received_chunks=4,
+            received_bitmap=bytes([0b10001011]))
+
+        master_file = MasterFile.objects.get(id=self.master_file.id)
+
+        self.assertFalse(master_file.is_complete())
+        self.assertEqual(master_file.missing_chunks(), [2])
+
+    def test_recount_rebuilds_counters(self):
+        self.create_chunk(self.master_file, 1, b'abc')
+        MasterFile.objects.filter(id=self.master_file.id).update(
+            received_chunks=0, received_bytes=0, received_bitmap=b'')
+
+        self.master_file.recount_chunks()
+
+        self.assertEqual(self.master_file.received_chunks, 1)
+        self.assertEqual(self.master_file.received_bytes, 3)
+        self.assertEqual(self.master_file.missing_chunks(), [0, 2, 3])
+
+
+class MissingChunksTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.missing_chunks_url = reverse('chunkedfile-missing-chunks')
+
+    def test_missing_chunk_ranges(self):
+        bitmap = b''
+        for chunk_number in [0, 1, 2, 5, 8, 9, 10, 11, 12, 13, 14, 15, 19]:
+            bitmap = set_chunk_bit(bitmap, chunk_number)
+
+        self.assertEqual(missing_chunk_ranges(bitmap, 22),
+                         [[3, 4], [6, 7], [16, 18], [20, 21]])
+        self.assertEqual(missing_chunk_ranges(b'', 100000), [[0, 99999]])
+        self.assertEqual(missing_chunk_ranges(b'\xff\x03', 10), [])
+
+    def test_endpoint_lists_gaps_of_parallel_upload(self):
+        master_file, _ = self.create_master_file([])
+        master_file.number_of_chunks = 6
+        master_file.save()
+        for number in (0, 3, 5):
+            self.create_chunk(master_file, number, b'x')
+
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                f'{self.missing_chunks_url}?master_file_id={master_file.id}')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['received_chunks'], 3)
+        self.assertEqual(response.data['missing'], [[1, 2], [4, 4]])
+
+
+class ChecksumVerificationTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunked_file_url = reverse('chunkedfile-list')
+        self.master_file, _ = self.create_master_file([])
+        self.master_file.number_of_chunks = 2
+        self.master_file.save()
+
+    def post_chunk(self, chunk, checksum, **headers):
+        return self.client.post(self.chunked_file_url, {
+            'master_file': self.master_file.id,
+            'file': SimpleUploadedFile('chunk', chunk),
+            'chunk_number': 0,
+            'md5_checksum': checksum,
+        }, format='multipart', **headers)
+
+    def test_corrupted_chunk_is_rejected(self):
+        response = self.post_chunk(b'payload',
+                                   hashlib.md5(b'other').hexdigest())
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertTrue(response.data['retryable'])
+        self.assertEqual(ChunkedFile.objects.count(), 0)
+
+    def test_digest_is_computed_while_receiving(self):
+        with mock.patch('upload.utils.file_digest') as file_digest:
+            response = self.post_chunk(b'payload',
+                                       hashlib.md5(b'payload').hexdigest())
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        file_digest.assert_not_called()
+
+    def test_upload_with_selected_algorithm(self):
+        self.master_file.checksum_algorithm = 'blake2b'
+        self.master_file.save()
+
+        response = self.post_chunk(
+            b'payload', hashlib.blake2b(b'payload').hexdigest(),
+            HTTP_X_CHECKSUM_ALGORITHM='blake2b')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_merge_rejects_wrong_file_checksum(self):
+        master_file, _ = self.create_master_file([b'abc', b'def'])
+        master_file.md5_checksum = hashlib.md5(b'abcdeX').hexdigest()
+        master_file.save()
+
+        with self.assertRaises(ChecksumMismatch):
+            merge.merge_chunks(master_file)
+
+        master_file.refresh_from_db()
+        self.assertFalse(master_file.file)
+        self.assertEqual(os.listdir(os.path.join(self.media_root,
+                                                 'master_files')), [])
+
+
+class StreamingUploadHandlerTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunked_file_url = reverse('chunkedfile-list')
+        self.master_file, _ = self.create_master_file([])
+        self.master_file.number_of_chunks = 2
+        self.master_file.save()
+
+    def post_chunk(self, chunk, checksum=None):
+        return self.client.post(self.chunked_file_url, {
+            'master_file': self.master_file.id,
+            'file': SimpleUploadedFile('chunk', chunk),
+            'chunk_number': 0,
+            'md5_checksum': checksum or hashlib.md5(chunk).hexdigest(),
+        }, format='multipart')
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(directory, name), self.media_root)
+            for directory, _, names in os.walk(self.media_root)
+            for name in names)
+
+    def test_chunk_is_written_without_temporary_file(self):
+        with mock.patch('upload.handlers.TemporaryUploadedFile') as temp:
+            response = self.post_chunk(b'payload')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        temp.assert_not_called()
+        chunk = ChunkedFile.objects.get()
+        self.assertEqual(chunk.size, len(b'payload'))
+        with chunk.file.open('rb') as f:
+            self.assertEqual(f.read(), b'payload')
+        self.assertEqual(self.stored_files(), [chunk.file.name])
+
+    def test_rejected_chunk_leaves_no_file(self):
+        response = self.post_chunk(b'payload',
+                                   hashlib.md5(b'other').hexdigest())
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_refused_replacement_leaves_no_file(self):
+        self.post_chunk(b'payload')
+        self.master_file.status = MasterFile.COMPLETED
+        self.master_file.save(update_fields=['status'])
+
+        response = self.post_chunk(b'another payload')
+
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(len(self.stored_files()), 1)
+
+
+@override_settings(MERGE_ASYNC=False)
+class DeduplicationTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunked_file_url = reverse('chunkedfile-list')
+        self.preflight_url = reverse('chunkedfile-preflight')
+
+    def create_upload(self, chunks):
+        master_file = MasterFile.objects.create(
+            file_name='data.bin',
+            md5_checksum=hashlib.md5(b''.join(chunks)).hexdigest(),
+            number_of_chunks=len(chunks))
+        return master_file
+
+    def post_chunk(self, master_file, number, chunk):
+        return Creator.post_chunked_file(
+            self.client, self.chunked_file_url, master_file.id,
+            f'chunk-{number}', chunk, number,
+            hashlib.md5(chunk).hexdigest(), timezone.now())
+
+    def preflight(self, master_file, chunks):
+        return self.client.post(
+            f'{self.preflight_url}?master_file_id={master_file.id}',
+            {'chunks': [{'chunk_number': number,
+                         'digest': hashlib.sha256(chunk).hexdigest(),
+                         'md5_checksum': hashlib.md5(chunk).hexdigest()}
+                        for number, chunk in enumerate(chunks)]},
+            format='json')
+
+    def test_identical_chunks_share_one_blob(self):
+        first = self.create_upload([b'shared bytes', b'a'])
+        second = self.create_upload([b'shared bytes', b'b'])
+
+        self.post_chunk(first, 0, b'shared bytes')
+        self.post_chunk(second, 0, b'shared bytes')
+
+        blob = ChunkBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(blob.digest,
+                         hashlib.sha256(b'shared bytes').hexdigest())
+        names = {chunk.file.name for chunk in ChunkedFile.objects.all()}
+        self.assertEqual(names, {blob.file.name})
+        self.assertEqual(os.listdir(os.path.dirname(blob.file.path)),
+                         [blob.digest])
+
+    def test_preflight_links_known_chunks(self):
+        chunks = [b'known chunk', b'new chunk']
+        self.post_chunk(self.create_upload([b'known chunk']), 0,
+                        b'known chunk')
+        master_file = self.create_upload(chunks)
+
+        response = self.preflight(master_file, chunks)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['stored'], [0])
+        self.assertEqual(response.data['missing'], [1])
+        chunk = master_file.chunkedfile_set.get()
+        self.assertEqual(chunk.chunk_number, 0)
+        self.assertEqual(chunk.blob.ref_count, 2)
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.received_chunks, 1)
+
+    def test_preflight_of_known_file_completes_it(self):
+        chunks = [b'first', b'second']
+        original = self.create_upload(chunks)
+        for number, chunk in enumerate(chunks):
+            self.post_chunk(original, number, chunk)
+        copy = self.create_upload(chunks)
+
+        response = self.preflight(copy, chunks)
+
+        self.assertEqual(response.data['missing'], [])
+        copy.refresh_from_db()
+        self.assertEqual(copy.status, MasterFile.COMPLETED)
+        with copy.file.open('rb') as f:
+            self.assertEqual(f.read(), b'firstsecond')
+
+    def test_preflight_rejects_chunk_numbers_out_of_range(self):
+        master_file = self.create_upload([b'only'])
+
+        response = self.preflight(master_file, [b'only', b'extra'])
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(master_file.chunkedfile_set.exists())
+
+    def test_deleting_chunk_releases_blob(self):
+        master_file = self.create_upload([b'data'])
+        self.post_chunk(master_file, 0, b'data')
+
+        master_file.chunkedfile_set.get().delete()
+
+        blob = ChunkBlob.objects.get()
+        self.assertEqual(blob.ref_count, 0)
+        self.assertTrue(blob.file.storage.exists(blob.file.name))
+
+
+@override_settings(MERGE_ASYNC=False, CHUNK_COMPRESSION='zlib')
+class CompressionTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunked_file_url = reverse('chunkedfile-list')
+        rows = (f'{n},2024-01-{n % 28 + 1:02d},item-{n % 7},{n * 3}\n'
+                for n in range(4000))
+        self.text = ''.join(rows).encode()
+        self.noise = random.Random(15).randbytes(64 * 1024)
+
+    def upload(self, chunks):
+        master_file = MasterFile.objects.create(
+            file_name='data.csv',
+            md5_checksum=hashlib.md5(b''.join(chunks)).hexdigest(),
+            number_of_chunks=len(chunks))
+        for number, chunk in enumerate(chunks):
+            response = Creator.post_chunked_file(
+                self.client, self.chunked_file_url, master_file.id,
+                f'chunk-{number}', chunk, number,
+                hashlib.md5(chunk).hexdigest(), timezone.now())
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return master_file
+
+    def test_entropy_probe(self):
+        self.assertTrue(compression.is_compressible(self.text))
+        self.assertFalse(compression.is_compressible(self.noise))
+        self.assertEqual(compression.entropy(b'aaaa'), 0.0)
+
+    def test_text_chunk_is_stored_compressed(self):
+        self.upload([self.text])
+
+        blob = ChunkBlob.objects.get()
+        self.assertEqual(blob.codec, compression.ZLIB)
+        self.assertEqual(blob.size, len(self.text))
+        self.assertTrue(blob.file.name.endswith('.gz'))
+        self.assertEqual(blob.stored_size, blob.file.size)
+        self.assertLess(blob.stored_size, len(self.text) // 2)
+
+    def test_incompressible_chunk_is_stored_raw(self):
+        self.upload([self.noise])
+
+        blob = ChunkBlob.objects.get()
+        self.assertEqual(blob.codec, compression.NONE)
+        self.assertEqual(blob.file.read(), self.noise)
+        self.assertEqual(os.listdir(os.path.dirname(blob.file.path)),
+                         [blob.digest])
+
+    def test_merge_decompresses_chunks(self):
+        master_file = self.upload([self.text, self.noise, self.text[:100]])
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.COMPLETED)
+        self.assertEqual(master_file.file.read(),
+                         self.text + self.noise + self.text[:100])
+
+    @override_settings(CHUNK_COMPRESSION='lzma', MERGE_ON_COMPLETE=False)
+    def test_chunk_stream_seeks_back_in_compressed_chunk(self):
+        master_file = self.upload([self.text, self.text[::-1]])
+        content = self.text + self.text[::-1]
+        stream = streams.ChunkStream(
+            master_file.chunkedfile_set.select_related('blob').order_by(
+                'chunk_number'))
+
+        with io.BufferedReader(stream, buffer_size=1024) as reader:
+            reader.seek(len(self.text) + 5000)
+            self.assertEqual(reader.read(10), content[-len(self.text) + 5000:
+                                                      -len(self.text) + 5010])
+            reader.seek(len(self.text) + 10)
+            self.assertEqual(reader.read(), content[len(self.text) + 10:])
+
+    @override_settings(CHUNK_COMPRESSION='brotli')
+    def test_unknown_codec_is_rejected(self):
+        with self.assertRaises(ValueError):
+            compression.get_codec()
+
+
+class BatchUploadTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.batch_url = reverse('masterfile-batch')
+        self.files = {f'note-{n}.txt': f'note {n}\n'.encode() * (n + 1)
+                      for n in range(5)}
+
+    def post_files(self, files, checksums=None):
+        data = {'files': [SimpleUploadedFile(name, content)
+                          for name, content in files.items()]}
+        if checksums is not None:
+            data['md5_checksum'] = checksums
+        return self.client.post(self.batch_url, data, format='multipart')
+
+    def tar(self, files):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as archive:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        return buffer.getvalue()
+
+    def assert_stored(self, response, files):
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([data['file_name'] for data in response.data],
+                         list(files))
+        for data in response.data:
+            master_file = MasterFile.objects.get(id=data['id'])
+            content = files[master_file.file_name]
+            self.assertEqual(master_file.status, MasterFile.COMPLETED)
+            self.assertTrue(master_file.is_complete())
+            self.assertEqual(master_file.md5_checksum,
+                             hashlib.md5(content).hexdigest())
+            self.assertEqual(master_file.file.read(), content)
+        # The bytes are written once, as the merged files.
+        self.assertFalse(ChunkedFile.objects.exists())
+        self.assertFalse(ChunkBlob.objects.exists())
+
+    def test_multipart_batch(self):
+        checksums = [hashlib.md5(content).hexdigest()
+                     for content in self.files.values()]
+
+        response = self.post_files(self.files, checksums)
+
+        self.assert_stored(response, self.files)
+
+    def test_tar_batch(self):
+        files = {'docs/a.txt': b'alpha', 'docs/b.txt': b'beta',
+                 'empty.txt': b''}
+
+        response = self.client.post(self.batch_url, self.tar(files),
+                                    content_type='application/x-tar')
+
+        self.assert_stored(response, files)
+        self.assertEqual(
+            MasterFile.objects.get(file_name='docs/a.txt').file.name,
+            'master_files/a.txt')
+
+    def test_checksum_mismatch_stores_nothing(self):
+        checksums = [hashlib.md5(content).hexdigest()
+                     for content in self.files.values()]
+        checksums[-1] = hashlib.md5(b'other').hexdigest()
+
+        response = self.post_files(self.files, checksums)
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertFalse(MasterFile.objects.exists())
+        self.assertEqual(
+            os.listdir(os.path.join(self.media_root, 'master_files')), [])
+
+    @override_settings(BATCH_MAX_FILE_SIZE=8)
+    def test_large_file_is_rejected(self):
+        response = self.post_files({'small': b'tiny', 'large': b'x' * 9})
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertFalse(MasterFile.objects.exists())
+
+    @override_settings(DATA_UPLOAD_MAX_NUMBER_FILES=3)
+    def test_too_many_multipart_files(self):
+        response = self.post_files(self.files)
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertFalse(MasterFile.objects.exists())
+
+    @override_settings(BATCH_MAX_FILES=3)
+    def test_too_many_tar_members(self):
+        response = self.client.post(self.batch_url, self.tar(self.files),
+                                    content_type='application/x-tar')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertFalse(MasterFile.objects.exists())
+
+    def test_invalid_tar(self):
+        response = self.client.post(self.batch_url, b'not a tar archive',
+                                    content_type='application/x-tar')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ArchiveDownloadTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.archive_url = reverse('masterfile-archive')
+        self.merged, self.merged_content = self.create_master_file(
+            [b'merged ' * 100, b'file'], file_name='docs/report.txt')
+        merge.merge_chunks(self.merged)
+        self.unmerged, self.unmerged_content = self.create_master_file(
+            [b'not ', b'merged'], file_name='../notes.txt')
+        self.incomplete, _ = self.create_master_file([b'partial'])
+        self.incomplete.number_of_chunks = 2
+        self.incomplete.save()
+
+    def download(self, **params):
+        params.setdefault('ids', [self.merged.id, self.unmerged.id,
+                                  self.incomplete.id])
+        response = self.client.get(self.archive_url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content)
+
+    def test_zip_archive(self):
+        content = self.download()
+
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(),
+                             ['docs/report.txt', 'notes.txt'])
+            self.assertEqual(archive.read('docs/report.txt'),
+                             self.merged_content)
+            self.assertEqual(archive.read('notes.txt'),
+                             self.unmerged_content)
+            self.assertEqual(archive.getinfo('notes.txt').compress_type,
+                             zipfile.ZIP_DEFLATED)
+
+    def test_stored_zip_of_selected_files(self):
+        content = self.download(ids=[self.unmerged.id, self.incomplete.id],
+                                compression='stored')
+
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(archive.namelist(), ['notes.txt'])
+            info = archive.getinfo('notes.txt')
+            self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(archive.read(info), self.unmerged_content)
+
+    def test_zip64_records(self):
+        with mock.patch.object(zipfile, 'ZIP64_LIMIT', 100):
+            content = self.download()
+
+        self.assertIn(b'PK\x06\x06', content)
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(archive.read('docs/report.txt'),
+                             self.merged_content)
+
+    def test_tar_archive_with_duplicate_names(self):
+        duplicate, _ = self.create_master_file([b'again'],
+                                               file_name='notes.txt')
+
+        response = self.client.post(self.archive_url, {
+            'ids': [self.unmerged.id, duplicate.id],
+            'archive_format': 'tar'}, format='json')
+
+        self.assertEqual(response['Content-Type'], 'application/x-tar')
+        content = b''.join(response.streaming_content)
+        self.assertEqual(len(content) % tarfile.RECORDSIZE, 0)
+        with tarfile.open(fileobj=io.BytesIO(content)) as archive:
+            self.assertEqual(archive.getnames(),
+                             ['notes.txt', 'notes (1).txt'])
+            self.assertEqual(archive.extractfile('notes (1).txt').read(),
+                             b'again')
+
+    @override_settings(DOWNLOAD_BUFFER_SIZE=64 * 1024)
+    def test_archive_memory_is_bounded_by_buffer(self):
+        large, _ = self.create_master_file([os.urandom(4 * 1024 * 1024)])
+        for iter_archive in (archives.iter_zip, archives.iter_tar):
+            tracemalloc.start()
+            try:
+                size = sum(len(part) for part in iter_archive([large]))
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertGreater(size, 4 * 1024 * 1024)
+            self.assertLess(peak, 1024 * 1024)
+
+    def test_no_matching_files(self):
+        response = self.client.get(self.archive_url, {'prefix': 'missing/'})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_only_incomplete_files_match(self):
+        response = self.client.get(self.archive_url,
+                                   {'ids': [self.incomplete.id]})
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_whole_store_cannot_be_archived(self):
+        for params in ({}, {'archive_format': 'tar'}):
+            response = self.client.get(self.archive_url, params)
+
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(GC_UPLOAD_MAX_AGE=3600, GC_MERGED_CHUNK_AGE=3600,
+                   GC_GRACE_PERIOD=3600, GC_BATCH_SIZE=2, GC_BATCH_PAUSE=0)
+class GarbageCollectionTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.long_ago = timezone.now() - timedelta(hours=2)
+
+    def create_blob_chunk(self, master_file, chunk_number, chunk):
+        blob = acquire_blob(ContentFile(chunk),
+                            hashlib.sha256(chunk).hexdigest())
+        ChunkedFile(master_file=master_file, chunk_number=chunk_number,
+                    md5_checksum=hashlib.md5(chunk).hexdigest(),
+                    file=blob.file.name, blob=blob).save()
+        return blob
+
+    def create_upload(self, chunks, age=None):
+        master_file = MasterFile.objects.create(
+            file_name='data.bin',
+            md5_checksum=hashlib.md5(b''.join(chunks)).hexdigest(),
+            number_of_chunks=len(chunks) + 1)
+        blobs = [self.create_blob_chunk(master_file, number, chunk)
+                 for number, chunk in enumerate(chunks)]
+        if age is not None:
+            MasterFile.objects.filter(pk=master_file.pk).update(
+                uploaded_at=age)
+            master_file.chunkedfile_set.update(uploaded_at=age)
+        return master_file, blobs
+
+    def age_blobs(self):
+        ChunkBlob.objects.update(created_at=self.long_ago)
+
+    def age_file(self, name):
+        path = os.path.join(self.media_root, name)
+        os.utime(path, (self.long_ago.timestamp(),) * 2)
+        return path
+
+    def test_stale_uploads_are_expired(self):
+        stale, (blob,) = self.create_upload([b'stale'])
+        legacy = self.create_chunk(stale, 1, b'legacy')
+        MasterFile.objects.filter(pk=stale.pk).update(
+            uploaded_at=self.long_ago)
+        stale.chunkedfile_set.update(uploaded_at=self.long_ago)
+        active, _ = self.create_upload([b'active'])
+
+        expired = Sweeper().expire_stale_uploads()
+
+        self.assertEqual(expired, 1)
+        self.assertFalse(MasterFile.objects.filter(pk=stale.pk).exists())
+        self.assertTrue(MasterFile.objects.filter(pk=active.pk).exists())
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 0)
+        self.assertFalse(os.path.exists(legacy.file.path))
+
+    def test_chunks_of_verified_merges_are_released(self):
+        master_file, blobs = self.create_upload([b'one', b'two'])
+        master_file.number_of_chunks = 2
+        master_file.save()
+        tasks.run_merge(master_file.id)
+        MasterFile.objects.filter(pk=master_file.pk).update(
+            merged_at=self.long_ago)
+        self.age_blobs()
+
+        counts = Sweeper().run()
+
+        self.assertEqual(counts['released_chunks'], 2)
+        self.assertEqual(counts['collected_blobs'], 2)
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.file.read(), b'onetwo')
+        self.assertFalse(master_file.chunkedfile_set.exists())
+        self.assertFalse(ChunkBlob.objects.exists())
+        for blob in blobs:
+            self.assertFalse(os.path.exists(blob.file.path))
+
+    def test_blobs_of_deleted_files_are_collected(self):
+        master_file, (blob,) = self.create_upload([b'deleted'])
+        shared, _ = self.create_upload([b'deleted'])
+
+        response = APIClient().delete(
+            reverse('masterfile-detail', args=[master_file.id]))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        APIClient().delete(reverse('masterfile-detail', args=[shared.id]))
+        self.age_blobs()
+
+        counts = Sweeper().run()
+
+        self.assertEqual(counts['collected_blobs'], 1)
+        self.assertFalse(ChunkBlob.objects.exists())
+        self.assertFalse(os.path.exists(blob.file.path))
+
+    def test_unverified_merge_keeps_chunks(self):
+        master_file, _ = self.create_upload([b'chunk'])
+        master_file.file.save('merged.bin', ContentFile(b'corrupt'),
+                              save=False)
+        master_file.status = MasterFile.COMPLETED
+        master_file.merged_at = self.long_ago
+        master_file.save()
+
+        with self.assertLogs('upload.cleanup', level='WARNING'):
+            self.assertEqual(Sweeper().release_merged_chunks(), 0)
+        self.assertTrue(master_file.chunkedfile_set.exists())
+
+    def test_referenced_blobs_and_recent_files_are_kept(self):
+        _, (blob,) = self.create_upload([b'kept'])
+        self.age_blobs()
+        orphan = os.path.join(self.media_root, blob_name('ab' * 32))
+        recent = os.path.join(self.media_root, 'chunked_files', 'recent')
+        for path in (orphan, recent):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'data')
+        self.age_file(blob.file.name)
+        self.age_file(blob_name('ab' * 32))
+
+        counts = Sweeper().run()
+
+        self.assertEqual(counts['collected_blobs'], 0)
+        self.assertEqual(counts['orphan_files'], 1)
+        self.assertTrue(os.path.exists(blob.file.path))
+        self.assertTrue(os.path.exists(recent))
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_rows_with_missing_files_are_repaired(self):
+        master_file, (blob,) = self.create_upload([b'lost'])
+        os.remove(blob.file.path)
+        merged, _ = self.create_master_file([b'merged'])
+        merge.merge_chunks(merged)
+        MasterFile.objects.filter(pk=merged.pk).update(
+            status=MasterFile.COMPLETED)
+        os.remove(merged.file.path)
+
+        with self.assertLogs('upload.cleanup', level='WARNING'):
+            self.assertEqual(Sweeper().repair_missing_files(), 2)
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.received_chunks, 0)
+        self.assertFalse(ChunkBlob.objects.exists())
+        merged.refresh_from_db()
+        self.assertEqual(merged.status, MasterFile.FAILED)
+        self.assertFalse(merged.file)
+        self.assertEqual(merged.received_chunks, 1)
+
+    def test_lost_merge_of_released_chunks_is_not_served(self):
+        master_file, _ = self.create_upload([b'one', b'two'])
+        master_file.number_of_chunks = 2
+        master_file.save()
+        tasks.run_merge(master_file.id)
+        MasterFile.objects.filter(pk=master_file.pk).update(
+            merged_at=self.long_ago)
+        Sweeper().release_merged_chunks()
+        os.remove(MasterFile.objects.get(pk=master_file.pk).file.path)
+
+        with self.assertLogs('upload.cleanup', level='WARNING'):
+            self.assertEqual(Sweeper().repair_missing_files(), 1)
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.received_chunks, 0)
+        self.assertEqual(master_file.received_bytes, 0)
+        self.assertEqual(master_file.missing_chunks(), [0, 1])
+        response = APIClient().get(
+            f"{reverse('chunkedfile-download-file')}"
+            f"?master_file_id={master_file.id}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_command(self):
+        self.create_upload([b'stale'], age=self.long_ago)
+        output = io.StringIO()
+
+        call_command('collect_garbage', pause=0, stdout=output)
+
+        self.assertIn('expired uploads: 1', output.getvalue())
+
+
+class ListEndpointTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.master_file_url = reverse('masterfile-list')
+        self.chunked_file_url = reverse('chunkedfile-list')
+        self.now = timezone.now()
+        self.master_files = [
+            MasterFile.objects.create(file_name=f'file-{n}', md5_checksum='',
+                                      number_of_chunks=1)
+            for n in range(5)]
+        # Three files share a timestamp, so pages must break ties by id.
+        for master_file, hours in zip(self.master_files, [3, 2, 2, 2, 1]):
+            MasterFile.objects.filter(pk=master_file.pk).update(
+                uploaded_at=self.now - timedelta(hours=hours))
+
+    def walk(self, **params):
+        ids = []
+        response = self.client.get(self.master_file_url, params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [item['id'] for item in response.data['results']]
+            if not response.data['next']:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def test_keyset_pages_cover_every_row_once(self):
+        ids = self.walk(page_size=2)
+
+        expected = [file.id for file in reversed(self.master_files[1:4])]
+        self.assertEqual(ids, [self.master_files[4].id, *expected,
+                               self.master_files[0].id])
+
+    def test_filters(self):
+        MasterFile.objects.filter(pk=self.master_files[0].pk).update(
+            status=MasterFile.COMPLETED)
+
+        completed = self.walk(status='completed')
+        recent = self.walk(
+            uploaded_after=(self.now - timedelta(minutes=90)).isoformat())
+
+        self.assertEqual(completed, [self.master_files[0].id])
+        self.assertEqual(recent, [self.master_files[4].id])
+
+    def test_lean_chunk_list(self):
+        master_file, _ = self.create_master_file([b'a', b'b', b'c'])
+        self.create_master_file([b'other'])
+
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                f'{self.chunked_file_url}?master_file={master_file.id}')
+
+        chunks = response.data['results']
+        self.assertEqual(sorted(chunk['chunk_number'] for chunk in chunks),
+                         [0, 1, 2])
+        self.assertNotIn('file', chunks[0])
+        self.assertIsNone(response.data['next'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(f'{self.master_file_url}?cursor=bogus')
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_file_list_page(self):
+        with override_settings(LIST_PAGE_SIZE=3):
+            response = self.client.get(reverse('master_files'))
+
+        self.assertEqual(len(response.context['master_files']), 3)
+        self.assertContains(response, 'Older files')
+
+
+class MetricsTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunked_file_url = reverse('chunkedfile-list')
+
+    def sample(self, name, **labels):
+        return metric_sample(name, **labels)
+
+    def test_histogram_rendering(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ['kind'],
+                                      buckets=[1, 5])
+        metrics._registry.remove(histogram)
+        histogram.observe(0.5, kind='a')
+        histogram.observe(3, kind='a')
+        histogram.observe(10, kind='a')
+
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{kind="a",le="1"} 1',
+            'test_seconds_bucket{kind="a",le="5"} 2',
+            'test_seconds_bucket{kind="a",le="+Inf"} 3',
+            'test_seconds_sum{kind="a"} 13.5',
+            'test_seconds_count{kind="a"} 3',
+        ])
+
+    def test_chunk_upload_metrics(self):
+        master_file = MasterFile.objects.create(
+            file_name='file.bin', md5_checksum='', number_of_chunks=2)
+        uploads = self.sample('xdrive_upload_duration_seconds_count',
+                              kind='chunk', status=201)
+        ingested = self.sample('xdrive_ingested_bytes_total', kind='chunk')
+        requests = self.sample('xdrive_request_db_queries_count',
+                               view='chunkedfile-list')
+
+        Creator.post_chunked_file(
+            self.client, self.chunked_file_url, master_file.id, 'chunk-0',
+            b'chunk' * 100, 0, hashlib.md5(b'chunk' * 100).hexdigest(),
+            timezone.now())
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertEqual(self.sample('xdrive_upload_duration_seconds_count',
+                                     kind='chunk', status=201), uploads + 1)
+        self.assertGreater(
+            self.sample('xdrive_ingested_bytes_total', kind='chunk'),
+            ingested + 500)
+        self.assertEqual(self.sample('xdrive_request_db_queries_count',
+                                     view='chunkedfile-list'), requests + 1)
+        self.assertEqual(self.sample('xdrive_uploads_in_flight',
+                                     kind='chunk'), 0)
+
+    def test_merge_metrics(self):
+        master_file, content = self.create_master_file([b'one', b'two'])
+        merges = self.sample('xdrive_merge_duration_seconds_count',
+                             result='completed')
+        merged = self.sample('xdrive_merge_bytes_sum')
+
+        tasks.run_merge(master_file.id)
+
+        self.assertEqual(self.sample('xdrive_merge_duration_seconds_count',
+                                     result='completed'), merges + 1)
+        self.assertEqual(self.sample('xdrive_merge_bytes_sum'),
+                         merged + len(content))
+
+    def test_download_metrics(self):
+        master_file, content = self.create_master_file([b'x' * 1000])
+        merge.merge_chunks(master_file)
+        downloaded = self.sample('xdrive_downloaded_bytes_total',
+                                 kind='file')
+
+        response = self.client.get(
+            f"{reverse('chunkedfile-download-file')}"
+            f"?master_file_id={master_file.id}")
+        # Recorded once the response has been sent.
+        self.assertEqual(self.sample('xdrive_downloaded_bytes_total',
+                                     kind='file'), downloaded)
+        # The test client closes the response once it is consumed.
+        b''.join(response.streaming_content)
+
+        self.assertEqual(self.sample('xdrive_downloaded_bytes_total',
+                                     kind='file'), downloaded + len(content))
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(MERGE_ASYNC=False)
+class AsyncViewTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.async_client = AsyncClient()
+        self.chunks = [bytes(range(256)) * 40, b'tail' * 100]
+
+    async def consume(self, response):
+        self.assertTrue(response.is_async)
+        return b''.join([part async for part in response.streaming_content])
+
+    async def test_asgi_application_serves_static_files(self):
+        with override_settings(DEBUG=True):
+            application = importlib.reload(XDrive.asgi).application
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http', 'method': 'GET', 'path': '/static/scripts.js',
+            'query_string': b'', 'headers': [(b'host', b'localhost')],
+        })
+        await communicator.send_input({'type': 'http.request'})
+
+        start = await communicator.receive_output()
+
+        self.assertEqual(start['status'], status.HTTP_200_OK)
+
+    async def test_asgi_application_releases_request_thread(self):
+        threads = []
+
+        def get(pk):
+            threads.append(threading.current_thread())
+            raise MasterFile.DoesNotExist
+
+        communicator = ApplicationCommunicator(XDrive.asgi.application, {
+            'type': 'http', 'method': 'GET',
+            'path': reverse('async-chunkedfile-merge-status'),
+            'query_string': b'master_file_id=1',
+            'headers': [(b'host', b'localhost')],
+        })
+        await communicator.send_input({'type': 'http.request'})
+        with mock.patch.object(MasterFile.objects, 'get', get):
+            start = await communicator.receive_output()
+
+        self.assertEqual(start['status'], status.HTTP_404_NOT_FOUND)
+        # The request's thread is gone before the body is sent.
+        self.assertFalse(threads[0].is_alive())
+
+    async def test_upload_chunk(self):
+        master_file = await MasterFile.objects.acreate(
+            file_name='file.bin', md5_checksum='', number_of_chunks=2)
+
+        response = await self.async_client.post(
+            reverse('async-chunkedfile-list'), {
+                'master_file': master_file.id,
+                'file': SimpleUploadedFile('chunk-0', self.chunks[0]),
+                'chunk_number': 0,
+                'md5_checksum': hashlib.md5(self.chunks[0]).hexdigest(),
+                'uploaded_at': timezone.now().isoformat(),
+            })
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        chunk = await ChunkedFile.objects.aget(master_file=master_file,
+                                               chunk_number=0)
+        self.assertEqual(chunk.size, len(self.chunks[0]))
+
+    async def test_merge_status(self):
+        url = reverse('async-chunkedfile-merge-status')
+        master_file = await MasterFile.objects.acreate(
+            file_name='file.bin', md5_checksum='', number_of_chunks=1,
+            status=MasterFile.MERGING, merged_bytes=50, received_bytes=100)
+
+        queries = metric_sample('xdrive_request_db_queries_sum',
+                                view='async-chunkedfile-merge-status')
+        response = await self.async_client.get(
+            f'{url}?master_file_id={master_file.id}')
+        missing = await self.async_client.get(url)
+        unknown = await self.async_client.get(f'{url}?master_file_id=0')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['status'], MasterFile.MERGING)
+        self.assertEqual(response.json()['progress'], 0.5)
+        self.assertEqual(missing.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(unknown.status_code, status.HTTP_404_NOT_FOUND)
+        # One lookup per request with an id, counted by the middleware.
+        self.assertEqual(
+            metric_sample('xdrive_request_db_queries_sum',
+                          view='async-chunkedfile-merge-status'),
+            queries + 2)
+
+    def test_download_merged_file(self):
+        master_file, content = self.create_master_file(self.chunks)
+        merge.merge_chunks(master_file)
+        url = f"{reverse('async-chunkedfile-download-file')}" \
+              f"?master_file_id={master_file.id}"
+
+        async def download():
+            full = await self.async_client.get(url)
+            partial = await self.async_client.get(
+                url, headers={'Range': 'bytes=100-199'})
+            return (full, await self.consume(full),
+                    partial, await self.consume(partial))
+
+        full, body, partial, part = async_to_sync(download)()
+
+        self.assertEqual(full.status_code, status.HTTP_200_OK)
+        self.assertEqual(body, content)
+        self.assertEqual(int(full['Content-Length']), len(content))
+        self.assertEqual(partial.status_code,
+                         status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(part, content[100:200])
+
+    def test_download_from_chunks(self):
+        master_file, content = self.create_master_file(self.chunks)
+        url = f"{reverse('async-chunkedfile-download-file')}" \
+              f"?master_file_id={master_file.id}"
+
+        async def download():
+            response = await self.async_client.get(url)
+            return response, await self.consume(response)
+
+        response, body = async_to_sync(download)()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(body, content)
+
+
+@override_settings(MERGE_ASYNC=False, MERGE_ON_COMPLETE=False)
+class UploadSessionTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunked_file_url = reverse('chunkedfile-list')
+        self.chunks = [b'first chunk', b'second chunk', b'third chunk']
+        response = Creator.post_master_file(
+            self.client, reverse('masterfile-list'), 'file.bin',
+            hashlib.md5(b''.join(self.chunks)).hexdigest(), 3)
+        self.master_file_id = response.data['id']
+        self.token = response.data['upload_session']
+
+    def post_chunk(self, number, token=None, **fields):
+        return self.client.post(self.chunked_file_url, {
+            'file': SimpleUploadedFile('chunk', self.chunks[number]),
+            'chunk_number': number,
+            'md5_checksum': hashlib.md5(self.chunks[number]).hexdigest(),
+            **fields,
+        }, format='multipart',
+            headers={sessions.SESSION_HEADER: token or self.token})
+
+    def test_token_names_master_file(self):
+        self.assertEqual(sessions.read_token(self.token),
+                         self.master_file_id)
+
+    def test_chunk_upload_with_session(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post_chunk(0)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['master_file'], self.master_file_id)
+        self.assertEqual(MasterFile.objects.get().received_chunks, 1)
+
+    def test_invalid_token_is_refused(self):
+        response = self.post_chunk(0, token=self.token + 'x')
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(ChunkedFile.objects.exists())
+
+    def test_master_file_must_match_session(self):
+        other = MasterFile.objects.create(file_name='other.bin',
+                                          md5_checksum='', number_of_chunks=1)
+
+        response = self.post_chunk(0, master_file=other.id)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_steady_state_reads_no_metadata(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_chunk(0)
+
+        with CaptureQueriesContext(connection) as queries, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.post_chunk(1)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # Store the blob and the chunk, then lock, update and re-read the
+        # counters: the master file's metadata comes from the session.
+        statements = [query['sql'] for query in queries.captured_queries
+                      if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 6)
+        self.assertEqual(sessions.get(self.master_file_id)[
+            sessions.FIELDS.index('received_chunks')], 2)
+
+    @override_settings(UPLOAD_SESSION_CACHE='default')
+    def test_shared_cache_serves_other_processes(self):
+        MasterFile.objects.get_session(self.master_file_id)
+        sessions.clear()
+
+        with self.assertNumQueries(0):
+            master_file = MasterFile.objects.get_session(self.master_file_id)
+
+        self.assertEqual(master_file.number_of_chunks, 3)
+
+    def test_merge_drops_session(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for number in range(3):
+                self.post_chunk(number)
+        self.assertIsNotNone(sessions.get(self.master_file_id))
+
+        self.client.get(f"{reverse('chunkedfile-merge-chunks')}"
+                        f"?master_file_id={self.master_file_id}")
+
+        self.assertIsNone(sessions.get(self.master_file_id))
+        self.assertEqual(MasterFile.objects.get_session(
+            self.master_file_id).status, MasterFile.COMPLETED)
+
+
+class ContentDefinedChunkingTests(MediaRootMixin, TestCase):
+    SIZES = {'min_size': 256, 'avg_size': 1024, 'max_size': 4096}
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.data = random.Random(0).randbytes(64 * 1024)
+
+    def split(self, data):
+        return list(chunking.iter_chunks(io.BytesIO(data), **self.SIZES))
+
+    def test_gear_table_matches_client(self):
+        # web/static/cdc.js builds the same table; boundaries differ if not.
+        self.assertEqual(chunking.GEAR[:3],
+                         [0xe124b63a, 0x8b9a74ab, 0x64e1b3ac])
+
+    def test_chunks_cover_data_within_limits(self):
+        chunks = self.split(self.data)
+
+        self.assertEqual(b''.join(chunks), self.data)
+        boundaries = chunking.chunk_boundaries(io.BytesIO(self.data),
+                                               **self.SIZES)
+        chunking.validate_boundaries(boundaries, self.SIZES['min_size'],
+                                     self.SIZES['max_size'])
+        self.assertEqual(len(boundaries), len(chunks))
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        original = self.split(self.data)
+        edited = self.split(self.data[:1000] + b'inserted' +
+                            self.data[1000:])
+
+        reused = set(original) & set(edited)
+        self.assertGreaterEqual(len(reused), len(original) - 3)
+
+    def create_cdc_master_file(self, boundaries):
+        return self.client.post(reverse('masterfile-list'), {
+            'file_name': 'data.bin', 'md5_checksum': 'x' * 32,
+            'number_of_chunks': len(boundaries), 'chunking_mode': 'cdc',
+            'chunk_boundaries': boundaries}, format='json')
+
+    @override_settings(CDC_MIN_SIZE=2, CDC_MAX_SIZE=8)
+    def test_master_file_records_boundaries(self):
+        response = self.create_cdc_master_file([5, 13, 14])
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        master_file = MasterFile.objects.get()
+        self.assertEqual(master_file.chunk_boundaries, [5, 13, 14])
+        self.assertEqual(master_file.expected_chunk_size(1), 8)
+
+    @override_settings(CDC_MIN_SIZE=2, CDC_MAX_SIZE=8)
+    def test_invalid_boundaries_are_rejected(self):
+        for boundaries in ([5, 4], [5, 20], [1, 5]):
+            response = self.create_cdc_master_file(boundaries)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(CDC_MIN_SIZE=2, CDC_MAX_SIZE=8)
+    def test_chunk_must_match_its_boundaries(self):
+        self.create_cdc_master_file([5, 13])
+        master_file = MasterFile.objects.get()
+
+        response = Creator.post_chunked_file(
+            self.client, reverse('chunkedfile-list'), master_file.id,
+            'chunk-0', b'1234', 0, hashlib.md5(b'1234').hexdigest(),
+            timezone.now())
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('file', response.data)
+
+
+class FakeS3Client:
+    """In-memory stand-in for the boto3 S3 client calls S3Backend makes."""
+
+    class exceptions:
+        class ClientError(Exception):
+            pass
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.checksums = {}
+        self.uploads = {}
+        self.copied = []
+
+    def put_object(self, Bucket, Key, Body, ChecksumSHA256=None):
+        self.objects[Key] = Body
+        if ChecksumSHA256 is not None:
+            self.checksums[Key] = ChecksumSHA256
+
+    def head_object(self, Bucket, Key, ChecksumMode=None):
+        if Key not in self.objects:
+            raise self.exceptions.ClientError('404')
+        head = {'ContentLength': len(self.objects[Key])}
+        if Key in self.checksums:
+            head['ChecksumSHA256'] = self.checksums[Key]
+        return head
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f'upload-{len(self.uploads)}'
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def _add_part(self, upload_id, number, data):
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        self.uploads[upload_id][number] = (etag, data)
+        return etag
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        return {'ETag': self._add_part(UploadId, PartNumber, Body)}
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber,
+                         CopySource):
+        self.copied.append(CopySource['Key'])
+        data = self.objects[CopySource['Key']]
+        return {'CopyPartResult': {
+            'ETag': self._add_part(UploadId, PartNumber, data)}}
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        uploaded = self.uploads.pop(UploadId)
+        parts = MultipartUpload['Parts']
+        for part in parts[:-1]:
+            if len(uploaded[part['PartNumber']][1]) < \
+                    backends.S3_MIN_PART_SIZE:
+                raise ValueError('EntityTooSmall')
+        self.objects[Key] = b''.join(uploaded[part['PartNumber']][1]
+                                     for part in parts)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return (f'https://s3.example.com/{Params["Bucket"]}/{Params["Key"]}'
+                f'?expires={ExpiresIn}')
+
+
+@mock.patch.object(backends, 'S3_MIN_PART_SIZE', 4)
+class S3BackendTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sources = [('a', b'AAAAAA'), ('b', b'bb'), ('c', b'cc'),
+                        ('d', b'DDDDD'), ('e', b'e')]
+        self.client_ = FakeS3Client(
+            {f'media/{name}': data for name, data in self.sources})
+        self.backend = backends.S3Backend(self.client_, 'bucket', 'media')
+
+    def test_compose_copies_large_chunks_in_the_store(self):
+        size = self.backend.compose(
+            ((name, len(data)) for name, data in self.sources), 'merged')
+
+        expected = b''.join(data for _, data in self.sources)
+        self.assertEqual(self.client_.objects['media/merged'], expected)
+        self.assertEqual(size, len(expected))
+        # b and c are uploaded together as one part, e is the last part.
+        self.assertEqual(self.client_.copied, ['media/a', 'media/d'])
+
+    def test_failed_compose_is_aborted(self):
+        del self.client_.objects['media/c']
+
+        with self.assertRaises(KeyError):
+            self.backend.compose(
+                ((name, len(data)) for name, data in self.sources), 'merged')
+
+        self.assertEqual(self.client_.uploads, {})
+        self.assertNotIn('media/merged', self.client_.objects)
+
+    def test_merge_composes_chunks(self):
+        master_file, content = self.create_master_file(
+            [data for _, data in self.sources])
+        self.client_.objects = {
+            f'media/{chunk.file.name}': chunk.file.read()
+            for chunk in master_file.chunkedfile_set.all()}
+
+        with mock.patch.object(merge, 'get_backend',
+                               return_value=self.backend):
+            size = merge.merge_chunks(master_file)
+
+        self.assertEqual(size, len(content))
+        self.assertEqual(
+            self.client_.objects[f'media/{master_file.file.name}'], content)
+
+    def test_download_redirects_to_presigned_url(self):
+        master_file, _ = self.create_master_file([b'data'])
+        master_file.file.name = 'master_files/merged.bin'
+        master_file.save()
+
+        with mock.patch('upload.views.get_backend',
+                        return_value=self.backend):
+            response = self.client.get(
+                f'{reverse("chunkedfile-download-file")}'
+                f'?master_file_id={master_file.id}')
+
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertTrue(response['Location'].startswith(
+            'https://s3.example.com/bucket/media/master_files/merged.bin'))
+
+
+@override_settings(MERGE_ASYNC=False)
+class DirectUploadTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.chunks = [b'first chunk', b'second chunk']
+        self.master_file = MasterFile.objects.create(
+            file_name='data.bin',
+            md5_checksum=hashlib.md5(b''.join(self.chunks)).hexdigest(),
+            number_of_chunks=len(self.chunks))
+
+    def url(self, name):
+        return (f'{reverse(f"chunkedfile-{name}")}'
+                f'?master_file_id={self.master_file.id}')
+
+    def chunk_list(self, numbers, md5=True):
+        chunks = []
+        for number in numbers:
+            chunk = {'chunk_number': number,
+                     'digest': hashlib.sha256(self.chunks[number]).hexdigest()}
+            if md5:
+                chunk['md5_checksum'] = hashlib.md5(
+                    self.chunks[number]).hexdigest()
+            chunks.append(chunk)
+        return {'chunks': chunks}
+
+    def presign(self, numbers):
+        response = self.client.post(self.url('presign'),
+                                    self.chunk_list(numbers, md5=False),
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['uploads']
+
+    def put(self, upload, body):
+        return self.client.generic(upload['method'], upload['url'], body,
+                                   content_type='application/octet-stream')
+
+    def commit(self, numbers):
+        return self.client.post(self.url('commit'), self.chunk_list(numbers),
+                                format='json')
+
+    def test_presigned_upload_and_commit(self):
+        for upload in self.presign([0, 1]):
+            response = self.put(upload, self.chunks[upload['chunk_number']])
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.commit([0, 1])
+
+        self.assertEqual(response.data['stored'], [0, 1])
+        self.master_file.refresh_from_db()
+        self.assertEqual(self.master_file.status, MasterFile.COMPLETED)
+        with self.master_file.file.open('rb') as f:
+            self.assertEqual(f.read(), b''.join(self.chunks))
+
+    def test_corrupted_upload_is_not_committed(self):
+        upload, = self.presign([0])
+
+        response = self.put(upload, b'corrupted')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_422_UNPROCESSABLE_ENTITY)
+        self.assertEqual(self.commit([0]).data['missing'], [0])
+        self.assertFalse(ChunkedFile.objects.exists())
+
+    def test_upload_without_length_is_rejected(self):
+        upload, = self.presign([0])
+
+        response = self.client.generic(
+            upload['method'], upload['url'], self.chunks[0],
+            content_type='application/octet-stream', CONTENT_LENGTH='')
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_411_LENGTH_REQUIRED)
+
+    def test_stream_larger_than_announced_is_not_stored(self):
+        body = b'x' * 100
+        digest = hashlib.sha256(body).hexdigest()
+
+        with self.assertRaises(ChunkTooLarge):
+            store_stream(io.BytesIO(body), digest, buffer_size=16,
+                         max_size=len(self.chunks[0]))
+
+        storage = get_blob_storage()
+        self.assertFalse(storage.exists(blob_name(digest)))
+        directory = os.path.dirname(storage.path(blob_name(digest)))
+        self.assertEqual(os.listdir(directory)
+                         if os.path.isdir(directory) else [], [])
+
+    def test_tampered_upload_url_is_rejected(self):
+        upload, = self.presign([0])
+        upload['url'] = upload['url'].replace('token=', 'token=x')
+
+        response = self.put(upload, self.chunks[0])
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_s3_upload_goes_to_the_store(self):
+        client = FakeS3Client()
+        backend = backends.S3Backend(client, 'bucket')
+        with mock.patch('upload.views.get_backend', return_value=backend):
+            upload, = self.presign([0])
+            self.assertTrue(upload['url'].startswith('https://s3.example'))
+            client.put_object(
+                Bucket='bucket', Key=blob_name(hashlib.sha256(
+                    self.chunks[0]).hexdigest()), Body=self.chunks[0],
+                ChecksumSHA256=upload['headers']['x-amz-checksum-sha256'])
+
+            response = self.commit([0, 1])
+
+        self.assertEqual(response.data['stored'], [0])
+        self.assertEqual(response.data['missing'], [1])
+        self.assertEqual(ChunkBlob.objects.get().size, len(self.chunks[0]))
+
+
+@override_settings(MERGE_ASYNC=False, MERGE_ON_COMPLETE=False,
+                   CHUNK_SIZE=64, CHUNK_SIZE_MIN=16, CHUNK_SIZE_MAX=1024,
+                   CHUNK_SIZE_ALIGN=16, CHUNK_TARGET_SECONDS=4,
+                   CHUNK_MAX_COUNT=10)
+class ChunkSizeNegotiationTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.content = os.urandom(200)
+
+    def create(self, **fields):
+        return self.client.post(reverse('masterfile-list'), {
+            'file_name': 'file.bin',
+            'md5_checksum': hashlib.md5(self.content).hexdigest(),
+            **fields}, format='json')
+
+    def post_chunk(self, master_file_id, number, chunk):
+        return Creator.post_chunked_file(
+            self.client, reverse('chunkedfile-list'), master_file_id,
+            f'chunk-{number}', chunk, number, hashlib.md5(chunk).hexdigest(),
+            timezone.now())
+
+    def test_negotiate_chunk_size(self):
+        # Default size, bounded by the file, the chunk count and the limits.
+        self.assertEqual(negotiate_chunk_size(10_000), 1008)
+        self.assertEqual(negotiate_chunk_size(100), 64)
+        self.assertEqual(negotiate_chunk_size(40), 40)
+        self.assertEqual(negotiate_chunk_size(0), 1)
+        self.assertEqual(negotiate_chunk_size(100_000), 1024)
+        # Four seconds at the client's throughput, aligned.
+        self.assertEqual(negotiate_chunk_size(200, throughput=10), 48)
+        self.assertEqual(negotiate_chunk_size(200, throughput=1), 32)
+
+    def test_create_returns_negotiated_chunk_size(self):
+        response = self.create(file_size=200, throughput=10)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['chunk_size'], 48)
+        self.assertEqual(response.data['number_of_chunks'], 5)
+        self.assertNotIn('throughput', response.data)
+        master_file = MasterFile.objects.get()
+        self.assertEqual((master_file.file_size, master_file.chunk_size),
+                         (200, 48))
+
+    def test_number_of_chunks_must_match(self):
+        mismatched = self.create(file_size=200, number_of_chunks=2)
+        missing = self.create()
+
+        self.assertEqual(mismatched.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertIn('number_of_chunks', mismatched.data)
+        self.assertEqual(missing.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(MasterFile.objects.exists())
+
+    def test_chunks_follow_negotiated_size(self):
+        data = self.create(file_size=200).data
+        chunks = [self.content[n:n + 64] for n in range(0, 200, 64)]
+
+        wrong_size = self.post_chunk(data['id'], 0, chunks[0][:32])
+        out_of_range = self.post_chunk(data['id'], 4, chunks[3])
+        with self.captureOnCommitCallbacks(execute=True):
+            for number, chunk in enumerate(chunks):
+                self.assertEqual(self.post_chunk(data['id'], number,
+                                                 chunk).status_code,
+                                 status.HTTP_201_CREATED)
+        missing = self.client.get(f"{reverse('chunkedfile-missing-chunks')}"
+                                  f"?master_file_id={data['id']}")
+        merged = self.client.get(f"{reverse('chunkedfile-merge-chunks')}"
+                                 f"?master_file_id={data['id']}")
+
+        self.assertEqual(wrong_size.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(out_of_range.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(missing.data['chunk_size'], 64)
+        self.assertEqual(missing.data['missing'], [])
+        self.assertEqual(merged.data['status'], MasterFile.COMPLETED)
+        with MasterFile.objects.get().file.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_layout_cannot_change(self):
+        data = self.create(file_size=200).data
+
+        response = self.client.patch(
+            reverse('masterfile-detail', args=[data['id']]),
+            {'file_size': 300}, format='json')
+        status_update = self.client.patch(
+            reverse('masterfile-detail', args=[data['id']]),
+            {'status': MasterFile.IN_PROGRESS}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(status_update.status_code, status.HTTP_200_OK)
+
+
+@override_settings(MERGE_ASYNC=False, UPLOAD_PREALLOCATE=True, CHUNK_SIZE=64,
+                   CHUNK_SIZE_MIN=16, CHUNK_SIZE_MAX=1024,
+                   CHUNK_SIZE_ALIGN=16, CHUNK_MAX_COUNT=10, GC_GRACE_PERIOD=0)
+class PreallocatedAssemblyTests(MediaRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.content = os.urandom(200)
+        self.chunks = [self.content[n:n + 64] for n in range(0, 200, 64)]
+
+    def create(self, **fields):
+        data = self.client.post(reverse('masterfile-list'), {
+            'file_name': 'file.bin',
+            'md5_checksum': hashlib.md5(self.content).hexdigest(),
+            **fields}, format='json').data
+        return MasterFile.objects.get(pk=data['id'])
+
+    def post_chunk(self, master_file, number, chunk=None):
+        chunk = self.chunks[number] if chunk is None else chunk
+        return Creator.post_chunked_file(
+            self.client, reverse('chunkedfile-list'), master_file.id,
+            f'chunk-{number}', chunk, number, hashlib.md5(chunk).hexdigest(),
+            timezone.now())
+
+    def assembled_bytes(self, master_file):
+        with open(os.path.join(self.media_root,
+                               master_file.assembly_file), 'rb') as f:
+            return f.read()
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(directory, name), self.media_root)
+            for directory, _, names in os.walk(self.media_root)
+            for name in names)
+
+    def test_creation_preallocates_file(self):
+        master_file = self.create(file_size=200)
+
+        self.assertTrue(master_file.assembly_file)
+        self.assertFalse(master_file.file)
+        self.assertEqual(os.path.getsize(os.path.join(
+            self.media_root, master_file.assembly_file)), 200)
+
+    def test_only_negotiated_uploads_are_assembled(self):
+        self.assertFalse(self.create(number_of_chunks=4).assembly_file)
+        with override_settings(UPLOAD_PREALLOCATE=False):
+            self.assertFalse(self.create(file_size=200).assembly_file)
+
+    def test_chunks_in_any_order_complete_the_file(self):
+        master_file = self.create(file_size=200)
+        name = master_file.assembly_file
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for number in reversed(range(len(self.chunks))):
+                response = self.post_chunk(master_file, number)
+                self.assertEqual(response.status_code,
+                                 status.HTTP_201_CREATED)
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.COMPLETED)
+        self.assertEqual(master_file.file.name, name)
+        self.assertEqual(master_file.assembly_file, '')
+        with master_file.file.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+        # One file per upload: no chunk files and no chunk store.
+        self.assertEqual(self.stored_files(), [name])
+        self.assertEqual(ChunkedFile.objects.filter(file='').count(), 4)
+
+    @override_settings(MERGE_ON_COMPLETE=False)
+    def test_replacement_rewrites_in_place(self):
+        master_file = self.create(file_size=200)
+        other = os.urandom(64)
+
+        self.post_chunk(master_file, 1, other)
+        with mock.patch('upload.assembly._copy_file_range',
+                        return_value=None):
+            response = self.post_chunk(master_file, 1)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.assembled_bytes(master_file)[64:128],
+                         self.chunks[1])
+
+    @override_settings(MERGE_ON_COMPLETE=False)
+    def test_download_before_merge(self):
+        master_file = self.create(file_size=200)
+        with self.captureOnCommitCallbacks(execute=True):
+            for number in range(len(self.chunks)):
+                self.post_chunk(master_file, number)
+
+        response = self.client.get(
+            f"{reverse('chunkedfile-download-file')}"
+            f"?master_file_id={master_file.id}",
+            headers={'Range': 'bytes=60-69'})
+
+        self.assertEqual(response.status_code,
+                         status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.content[60:70])
+
+    @override_settings(MERGE_ON_COMPLETE=False)
+    def test_incomplete_upload_is_not_merged(self):
+        master_file = self.create(file_size=200)
+        self.post_chunk(master_file, 0)
+
+        self.client.get(f"{reverse('chunkedfile-merge-chunks')}"
+                        f"?master_file_id={master_file.id}")
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.FAILED)
+        self.assertIn('1 of 4 chunks', master_file.merge_error)
+        self.assertFalse(master_file.file)
+        self.assertTrue(master_file.assembly_file)
+        response = self.client.get(
+            f"{reverse('chunkedfile-download-file')}"
+            f"?master_file_id={master_file.id}")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_assembled_file_is_verified(self):
+        master_file = self.create(file_size=200)
+        for number in range(len(self.chunks)):
+            self.post_chunk(master_file, number)
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.COMPLETED)
+        self.assertTrue(master_file.merge_verified)
+
+    def test_checksum_mismatch_keeps_assembled_file(self):
+        master_file = self.create(
+            file_size=200, md5_checksum=hashlib.md5(b'other').hexdigest())
+        for number in range(len(self.chunks)):
+            self.post_chunk(master_file, number)
+
+        master_file.refresh_from_db()
+        self.assertEqual(master_file.status, MasterFile.FAILED)
+        self.assertIn('checksum', master_file.merge_error)
+        self.assertFalse(master_file.file)
+        self.assertEqual(self.assembled_bytes(master_file), self.content)
+
+    def test_preflight_copies_known_chunks(self):
+        with override_settings(UPLOAD_PREALLOCATE=False):
+            known = self.create(file_size=200)
+        self.post_chunk(known, 2)
+        master_file = self.create(file_size=200)
+
+        response = self.client.post(
+            f"{reverse('chunkedfile-preflight')}"
+            f"?master_file_id={master_file.id}",
+            {'chunks': [{'chunk_number': 2,
+                         'digest': hashlib.sha256(self.chunks[2]).hexdigest(),
+                         'md5_checksum': hashlib.md5(
+                             self.chunks[2]).hexdigest()}]},
+            format='json')
+
+        self.assertEqual(response.data['stored'], [2])
+        self.assertEqual(self.assembled_bytes(master_file)[128:192],
+                         self.chunks[2])
+        self.assertIsNone(ChunkedFile.objects.get(
+            master_file=master_file).blob)
+
+    def test_garbage_collection_keeps_assembled_file(self):
+        master_file = self.create(file_size=200)
+
+        Sweeper().remove_orphan_files()
+
+        self.assertEqual(self.stored_files(), [master_file.assembly_file])
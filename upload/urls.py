@@ -1,6 +1,7 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from . import views
+from . import async_views, views
 
 router = DefaultRouter()
 router.register(r'masterfile', views.MasterFileModelViewSet,
@@ -8,4 +9,12 @@ router.register(r'masterfile', views.MasterFileModelViewSet,
 router.register(r'chunkedfile', views.ChunkedFileModelViewSet,
                 basename='chunkedfile')
 
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    # Asynchronous versions of the busiest endpoints, for ASGI servers.
+    path('async/chunkedfile/', async_views.upload_chunk,
+         name='async-chunkedfile-list'),
+    path('async/chunkedfile/merge-status/', async_views.merge_status,
+         name='async-chunkedfile-merge-status'),
+    path('async/chunkedfile/download/', async_views.download_file,
+         name='async-chunkedfile-download-file'),
+]
@@ -1,5 +1,112 @@
+import hashlib
 from math import ceil
 
+from django.conf import settings
+
 
 def get_number_of_chunks(file_size, chunk_size):
     return ceil(file_size / chunk_size)
+
+
+def negotiate_chunk_size(file_size, throughput=None):
+    """
+    Chunk size for uploading ``file_size`` bytes from a client that sends
+    ``throughput`` bytes per second, or at an unknown rate: each chunk
+    takes about ``settings.CHUNK_TARGET_SECONDS``, but large files are cut
+    in at most ``settings.CHUNK_MAX_COUNT`` chunks and files smaller than
+    a chunk are sent whole.
+    """
+    size = throughput * settings.CHUNK_TARGET_SECONDS if throughput \
+        else settings.CHUNK_SIZE
+    size = max(size, file_size / settings.CHUNK_MAX_COUNT)
+    size = min(max(size, settings.CHUNK_SIZE_MIN), settings.CHUNK_SIZE_MAX)
+    size = ceil(size / settings.CHUNK_SIZE_ALIGN) * settings.CHUNK_SIZE_ALIGN
+    return max(min(size, file_size), 1)
+
+
+def set_chunk_bit(bitmap, chunk_number, received=True):
+    """
+    Return a copy of the received-chunk ``bitmap`` with the bit of
+    ``chunk_number`` set (or cleared). Bit ``n`` is ``1 << n % 8`` of byte
+    ``n // 8``; the bitmap grows as needed.
+    """
+    index, mask = divmod(chunk_number, 8)
+    bitmap = bytearray(bitmap)
+    if len(bitmap) <= index:
+        bitmap.extend(bytes(index + 1 - len(bitmap)))
+    if received:
+        bitmap[index] |= 1 << mask
+    else:
+        bitmap[index] &= ~(1 << mask) & 0xFF
+    return bytes(bitmap)
+
+
+def has_chunk(bitmap, chunk_number):
+    index, mask = divmod(chunk_number, 8)
+    return index < len(bitmap) and bool(bitmap[index] & (1 << mask))
+
+
+def has_all_chunks(bitmap, number_of_chunks):
+    """Whether ``bitmap`` has the bits of chunks 0 to number_of_chunks - 1."""
+    full, rest = divmod(number_of_chunks, 8)
+    bitmap = bytes(bitmap)
+    if bitmap[:full] != b'\xff' * full:
+        return False
+    mask = (1 << rest) - 1
+    return not rest or (len(bitmap) > full and bitmap[full] & mask == mask)
+
+
+def iter_missing_chunks(bitmap, number_of_chunks):
+    for start, end in missing_chunk_ranges(bitmap, number_of_chunks):
+        yield from range(start, end + 1)
+
+
+def missing_chunk_ranges(bitmap, number_of_chunks):
+    """
+    Run-length encode the chunks absent from ``bitmap`` as a list of
+    inclusive ``[start, end]`` chunk number ranges. Whole bytes that are
+    all set or all clear are handled without looking at single bits.
+    """
+    ranges = []
+    start = None
+    for index in range(0, number_of_chunks, 8):
+        byte = bitmap[index // 8] if index // 8 < len(bitmap) else 0
+        width = min(8, number_of_chunks - index)
+        if byte == 0xFF and width == 8:
+            if start is not None:
+                ranges.append([start, index - 1])
+                start = None
+            continue
+        if byte == 0:
+            if start is None:
+                start = index
+            continue
+        for bit in range(width):
+            received = byte & (1 << bit)
+            if received and start is not None:
+                ranges.append([start, index + bit - 1])
+                start = None
+            elif not received and start is None:
+                start = index + bit
+    if start is not None:
+        ranges.append([start, number_of_chunks - 1])
+    return ranges
+
+
+def file_digest(file, algorithm, chunk_size=1024 * 1024):
+    """Hex digest of ``file``, read in ``chunk_size`` pieces."""
+    hasher = hashlib.new(algorithm)
+    for data in file.chunks(chunk_size):
+        hasher.update(data)
+    return hasher.hexdigest()
+
+
+def uploaded_file_digest(file, algorithm):
+    """
+    Digest of an uploaded file, taken from the one computed while it was
+    received (see ``upload.handlers``) or, failing that, by reading it.
+    """
+    digests = getattr(file, 'digests', {})
+    if algorithm in digests:
+        return digests[algorithm]
+    return file_digest(file, algorithm)
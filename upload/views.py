@@ -1,14 +1,46 @@
 import io
-from .models import ChunkedFile, MasterFile
+import tarfile
+
+from . import assembly, sessions, tasks
+from .archives import CONTENT_TYPES, ZIP, iter_tar, iter_zip
+from .batch import (TAR_CONTENT_TYPES, ingest, iter_tar_members,
+                    iter_uploaded_files)
+from .backends import get_backend
+from .blobs import (blob_name, get_blob_storage, link_chunk, register_blob,
+                    store_stream)
+from .downloads import serve_file
+from .filters import ChunkedFileFilter, MasterFileFilter
+from .handlers import ChunkUploadHandler, StoredUploadedFile
+from .metrics import track_download, track_upload
+from .pagination import KeysetPagination
+from .streams import ChunkStream
+from .utils import has_chunk, missing_chunk_ranges
+from .models import ChunkBlob, ChunkedFile, MasterFile
 from rest_framework import viewsets
-from .serializers import ChunkedFileSerializer, MasterFileSerializer
+from .serializers import (ArchiveRequestSerializer,
+                          ChunkDigestListSerializer,
+                          ChunkedFileListSerializer, ChunkedFileSerializer,
+                          ChunkReferenceListSerializer,
+                          MasterFileListSerializer, MasterFileSerializer,
+                          MergeStatusSerializer)
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import TooManyFilesSent
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
 from django.utils import timezone
 from django.views.generic import ListView
+from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
-from django.core.files.base import ContentFile
+from django.urls import reverse
+from django.core.files.storage import FileSystemStorage
+from django.utils.http import content_disposition_header, urlencode
+
+
+DIRECT_UPLOAD_SALT = 'upload.direct-upload'
 
 
 class MasterFileListView(ListView):
@@ -21,14 +53,138 @@ class MasterFileListView(ListView):
         return context
 
 
-class MasterFileModelViewSet(viewsets.ModelViewSet):
+class LeanListMixin:
+    """
+    List pages are paginated by keyset on ``(uploaded_at, id)``, filtered
+    with ``filterset_class`` and rendered with ``list_serializer_class``
+    from only the columns it outputs.
+    """
+    pagination_class = KeysetPagination
+    filter_backends = [DjangoFilterBackend]
+    list_serializer_class = None
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return self.list_serializer_class
+        return super().get_serializer_class()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            columns = {field.name
+                       for field in queryset.model._meta.concrete_fields}
+            queryset = queryset.only(*(
+                name for name in self.list_serializer_class.Meta.fields
+                if name in columns))
+        return queryset
+
+
+class MasterFileModelViewSet(LeanListMixin, viewsets.ModelViewSet):
     queryset = MasterFile.objects.all()
     serializer_class = MasterFileSerializer
+    list_serializer_class = MasterFileListSerializer
+    filterset_class = MasterFileFilter
+
+    @action(detail=False, methods=['post'], url_path='batch')
+    @track_upload('batch')
+    def batch(self, request):
+        """
+        Create many small files in one request, each stored as a single
+        chunk and completed right away. The body is either a multipart
+        form with repeated ``files`` parts, optionally with one
+        ``md5_checksum`` per file in the same order, or a tar archive
+        (``Content-Type: application/x-tar``) read as it streams in.
+        Multipart bodies are limited to Django's
+        ``DATA_UPLOAD_MAX_NUMBER_FILES`` files, archives to
+        ``BATCH_MAX_FILES``.
+        """
+        algorithm = request.query_params.get('checksum_algorithm', 'md5')
+        if algorithm not in dict(MasterFile.CHECKSUM_ALGORITHM_CHOICES):
+            return Response({"error": "Unsupported checksum_algorithm"},
+                            status=400)
+        if request.content_type.split(';')[0].strip() in TAR_CONTENT_TYPES:
+            files = iter_tar_members(request.stream or io.BytesIO())
+        else:
+            try:
+                uploads = request.FILES.getlist('files')
+            except TooManyFilesSent:
+                return Response({"error": "Too many files, send larger "
+                                          "batches as a tar archive"},
+                                status=413)
+            if not uploads:
+                return Response({"error": "No files in the batch"},
+                                status=400)
+            checksums = request.data.getlist('md5_checksum')
+            if checksums and len(checksums) != len(uploads):
+                return Response({"error": "Expected one md5_checksum per "
+                                          "file"}, status=400)
+            files = iter_uploaded_files(uploads, checksums)
+
+        try:
+            master_files = ingest(files, algorithm)
+        except tarfile.TarError:
+            return Response({"error": "Invalid tar archive"}, status=400)
+        if not master_files:
+            return Response({"error": "No files in the batch"}, status=400)
+        serializer = self.get_serializer(master_files, many=True)
+        return Response(serializer.data, status=201)
 
+    @action(detail=False, methods=['get', 'post'], url_path='archive')
+    @track_download('archive')
+    def archive(self, request):
+        """
+        Download many files as one zip or tar archive generated on the
+        fly. Files are picked by ``ids`` (repeated query parameter, or a
+        list in a POST body for long lists) and/or a file name ``prefix``;
+        ``archive_format`` is ``zip`` (default) or ``tar`` and zip
+        ``compression`` is ``deflate`` (default) or ``stored``. At least
+        one of ``ids`` and ``prefix`` is required, so no request archives
+        the whole store. Files that are neither merged nor complete are
+        left out.
+        """
+        data = request.data if request.method == 'POST' else \
+            request.query_params
+        serializer = ArchiveRequestSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        options = serializer.validated_data
+        if not options.get('ids') and not options.get('prefix'):
+            return Response({"error": "ids or prefix is required"},
+                            status=400)
+
+        # Merged or complete files, the only ones open_content can read.
+        master_files = MasterFile.objects.filter(
+            Q(received_chunks__gte=F('number_of_chunks')) |
+            Q(file__isnull=False) & ~Q(file='')).order_by('id')
+        if 'ids' in options:
+            master_files = master_files.filter(id__in=options['ids'])
+        if 'prefix' in options:
+            master_files = master_files.filter(
+                file_name__startswith=options['prefix'])
+        if not master_files.exists():
+            return Response({"error": "No files match the request"},
+                            status=404)
+
+        archive_format = options['archive_format']
+        if archive_format == ZIP:
+            parts = iter_zip(master_files.iterator(), options['compression'])
+        else:
+            parts = iter_tar(master_files.iterator())
+        response = StreamingHttpResponse(
+            parts, content_type=CONTENT_TYPES[archive_format])
+        response['Content-Disposition'] = content_disposition_header(
+            True, f'files.{archive_format}')
+        return response
 
-class ChunkedFileModelViewSet(viewsets.ModelViewSet):
+
+class ChunkedFileModelViewSet(LeanListMixin, viewsets.ModelViewSet):
     queryset = ChunkedFile.objects.all()
     serializer_class = ChunkedFileSerializer
+    list_serializer_class = ChunkedFileListSerializer
+    filterset_class = ChunkedFileFilter
+
+    def initialize_request(self, request, *args, **kwargs):
+        request.upload_handlers = [ChunkUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
 
     @action(detail=False, methods=['get'], url_path='last-chunk')
     def last_chunk(self, request):
@@ -37,7 +193,7 @@ class ChunkedFileModelViewSet(viewsets.ModelViewSet):
             return Response({"error": "master_file_id parameter is required"},
                             status=400)
 
-        master_file = get_object_or_404(MasterFile, id=master_file_id)
+        master_file = get_session_or_404(master_file_id)
         last_chunk = ChunkedFile.objects.filter(master_file=master_file).\
             order_by('-chunk_number').first()
 
@@ -48,14 +204,273 @@ class ChunkedFileModelViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(last_chunk)
         return Response(serializer.data)
 
-    @action(detail=False, methods=['get'], url_path='merge-chunks')
-    def merge_chunks(self, request):
+    @track_upload('chunk')
+    def create(self, request, *args, **kwargs):
+        """
+        Store a chunk. Uploading a chunk number that already exists for
+        the master file replaces it instead of adding a duplicate row.
+        """
+        upload = request.FILES.get('file')
+        stored = False
+        try:
+            response = self.store_chunk(request)
+            stored = response.status_code in (200, 201)
+            return response
+        finally:
+            # ChunkUploadHandler already wrote the bytes to storage; drop
+            # them if no chunk row ended up pointing at the file.
+            if not stored and isinstance(upload, StoredUploadedFile):
+                upload.delete()
+
+    def store_chunk(self, request):
+        context = self.get_serializer_context()
+        token = request.headers.get(sessions.SESSION_HEADER)
+        if token:
+            try:
+                context['upload_session'] = sessions.read_token(token)
+            except signing.BadSignature:
+                return Response({"error": "Invalid or expired upload "
+                                          "session"}, status=403)
+        serializer = self.get_serializer(data=request.data, context=context)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        existing = None
+        # The session's bitmap spares the lookup for new chunks; when it is
+        # out of date the insert below fails and the chunk is found anyway.
+        if has_chunk(data['master_file'].received_bitmap,
+                     data['chunk_number']):
+            existing = ChunkedFile.objects.filter(
+                master_file=data['master_file'],
+                chunk_number=data['chunk_number']).first()
+
+        if existing is None:
+            try:
+                with transaction.atomic():
+                    self.perform_create(serializer)
+            except IntegrityError:
+                # Another request stored the same chunk concurrently.
+                existing = ChunkedFile.objects.get(
+                    master_file=data['master_file'],
+                    chunk_number=data['chunk_number'])
+            else:
+                headers = self.get_success_headers(serializer.data)
+                return Response(serializer.data, status=201,
+                                headers=headers)
+
+        if existing.master_file.status in (MasterFile.MERGING,
+                                           MasterFile.COMPLETED):
+            return Response({"error": "Chunks of a merged file cannot be "
+                                      "replaced"}, status=409)
+        return self.replace_chunk(existing, request.data, context)
+
+    def replace_chunk(self, chunk, data, context):
+        serializer = self.get_serializer(chunk, data=data, context=context)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data)
+
+    def perform_create(self, serializer):
+        chunk = serializer.save()
+        if settings.MERGE_ON_COMPLETE and chunk.master_file.is_complete():
+            tasks.schedule_merge(chunk.master_file_id)
+
+    @action(detail=False, methods=['post'], url_path='preflight')
+    def preflight(self, request):
+        """
+        Take ``{"chunks": [{"chunk_number", "digest", "md5_checksum"}]}``
+        with the SHA-256 ``digest`` of each chunk the client is about to
+        upload. Chunks whose bytes are already in the chunk store are
+        stored right away as references to them, so the client only has to
+        upload the chunk numbers answered as ``missing``.
+        """
+        master_file_id = request.query_params.get('master_file_id')
+        if not master_file_id:
+            return Response({"error": "master_file_id parameter is required"},
+                            status=400)
+
+        master_file = get_object_or_404(MasterFile, id=master_file_id)
+        if master_file.status in (MasterFile.MERGING, MasterFile.COMPLETED):
+            return Response({"error": "Chunks of a merged file cannot be "
+                                      "replaced"}, status=409)
+        serializer = ChunkReferenceListSerializer(
+            data=request.data, context={'master_file': master_file})
+        serializer.is_valid(raise_exception=True)
+        chunks = serializer.validated_data['chunks']
+
+        blobs = ChunkBlob.objects.in_bulk(
+            [chunk['digest'].lower() for chunk in chunks],
+            field_name='digest')
+        stored, missing = self.link_chunks(
+            master_file, chunks,
+            lambda chunk: blobs.get(chunk['digest'].lower()))
+        return Response({
+            "master_file": master_file.id,
+            "stored": stored,
+            "missing": missing,
+        })
+
+    @action(detail=False, methods=['post'], url_path='presign')
+    def presign(self, request):
+        """
+        Take ``{"chunks": [{"chunk_number", "digest"}]}`` and answer with a
+        ``{"url", "method", "headers"}`` request per chunk that stores its
+        bytes directly in the chunk store, without passing through Django
+        on S3 storage. Once uploaded, chunks are recorded with ``commit``.
+        """
         master_file_id = request.query_params.get('master_file_id')
         if not master_file_id:
             return Response({"error": "master_file_id parameter is required"},
                             status=400)
 
         master_file = get_object_or_404(MasterFile, id=master_file_id)
+        if master_file.status in (MasterFile.MERGING, MasterFile.COMPLETED):
+            return Response({"error": "Chunks of a merged file cannot be "
+                                      "replaced"}, status=409)
+        serializer = ChunkDigestListSerializer(
+            data=request.data, context={'master_file': master_file})
+        serializer.is_valid(raise_exception=True)
+
+        backend = get_backend(get_blob_storage())
+        uploads = []
+        for chunk in serializer.validated_data['chunks']:
+            digest = chunk['digest'].lower()
+            upload = backend.upload_request(blob_name(digest), digest)
+            if upload is None:
+                upload = direct_upload_request(request, master_file,
+                                               chunk['chunk_number'], digest)
+            uploads.append({"chunk_number": chunk['chunk_number'], **upload})
+        return Response({
+            "master_file": master_file.id,
+            "expires_in": settings.UPLOAD_URL_EXPIRE,
+            "uploads": uploads,
+        })
+
+    @action(detail=False, methods=['put'], url_path='direct-upload')
+    @track_upload('direct')
+    def direct_upload(self, request):
+        """
+        Stand-in for a presigned storage URL on storages without them:
+        store the raw request body as the chunk content named by the
+        signed ``token`` query parameter.
+        """
+        try:
+            target = signing.loads(request.query_params.get('token', ''),
+                                   salt=DIRECT_UPLOAD_SALT,
+                                   max_age=settings.UPLOAD_URL_EXPIRE)
+        except signing.BadSignature:
+            return Response({"error": "Invalid or expired upload URL"},
+                            status=403)
+        try:
+            size = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return Response({"error": "Content-Length is required"},
+                            status=411)
+        if size > target['max_size']:
+            return Response({"error": "Chunk is too large"}, status=413)
+        # Content-Length is only what the client claims: the body is
+        # counted as it is stored too.
+        store_stream(request.stream or io.BytesIO(), target['digest'],
+                     max_size=target['max_size'])
+        return Response(status=204)
+
+    @action(detail=False, methods=['post'], url_path='commit')
+    def commit(self, request):
+        """
+        Record chunks uploaded through ``presign`` URLs. Takes
+        ``{"chunks": [{"chunk_number", "digest", "md5_checksum"}]}`` and
+        answers with the chunk numbers ``stored`` and those still
+        ``missing`` because their content did not reach the store intact.
+        """
+        master_file_id = request.query_params.get('master_file_id')
+        if not master_file_id:
+            return Response({"error": "master_file_id parameter is required"},
+                            status=400)
+
+        master_file = get_object_or_404(MasterFile, id=master_file_id)
+        if master_file.status in (MasterFile.MERGING, MasterFile.COMPLETED):
+            return Response({"error": "Chunks of a merged file cannot be "
+                                      "replaced"}, status=409)
+        serializer = ChunkReferenceListSerializer(
+            data=request.data, context={'master_file': master_file})
+        serializer.is_valid(raise_exception=True)
+        backend = get_backend(get_blob_storage())
+
+        def uploaded_blob(chunk):
+            digest = chunk['digest'].lower()
+            blob = ChunkBlob.objects.filter(digest=digest).first()
+            if blob is not None:
+                return blob
+            name = blob_name(digest)
+            size = backend.stored_size(name, digest)
+            return None if size is None else register_blob(digest, name,
+                                                           size)
+
+        stored, missing = self.link_chunks(
+            master_file, serializer.validated_data['chunks'], uploaded_blob)
+        return Response({
+            "master_file": master_file.id,
+            "stored": stored,
+            "missing": missing,
+        })
+
+    def link_chunks(self, master_file, chunks, get_blob):
+        """
+        Store each of ``chunks`` not stored yet as a reference to the blob
+        ``get_blob(chunk)`` returns for it, and return the lists of chunk
+        numbers stored and missing.
+        """
+        present = set(ChunkedFile.objects.filter(
+            master_file=master_file,
+            chunk_number__in=[chunk['chunk_number'] for chunk in chunks],
+        ).values_list('chunk_number', flat=True))
+        stored, missing, linked = [], [], False
+        for chunk in chunks:
+            number = chunk['chunk_number']
+            if number not in present:
+                blob = get_blob(chunk)
+                if blob is None or not link_chunk(
+                        master_file, number, chunk['md5_checksum'], blob):
+                    missing.append(number)
+                    continue
+                present.add(number)
+                linked = True
+            stored.append(number)
+
+        if linked and settings.MERGE_ON_COMPLETE and \
+                master_file.is_complete():
+            tasks.schedule_merge(master_file.id)
+        return stored, missing
+
+    @action(detail=False, methods=['get'], url_path='missing-chunks')
+    def missing_chunks(self, request):
+        """
+        List the chunks not uploaded yet as inclusive ``[start, end]``
+        ranges, read from the master file's received-chunk bitmap, with
+        the negotiated chunk size, if any, to cut them from the file.
+        """
+        master_file_id = request.query_params.get('master_file_id')
+        if not master_file_id:
+            return Response({"error": "master_file_id parameter is required"},
+                            status=400)
+
+        master_file = get_session_or_404(master_file_id)
+        return Response({
+            "master_file": master_file.id,
+            "number_of_chunks": master_file.number_of_chunks,
+            "chunk_size": master_file.chunk_size,
+            "received_chunks": master_file.received_chunks,
+            "missing": missing_chunk_ranges(master_file.received_bitmap,
+                                            master_file.number_of_chunks),
+        })
+
+    @action(detail=False, methods=['get', 'post'], url_path='merge-chunks')
+    def merge_chunks(self, request):
+        master_file_id = request.query_params.get('master_file_id')
+        if not master_file_id:
+            return Response({"error": "master_file_id parameter is required"},
+                            status=400)
+
+        master_file = get_session_or_404(master_file_id)
         chunks = ChunkedFile.objects.filter(master_file=master_file)\
             .order_by('chunk_number')
 
@@ -63,43 +478,92 @@ class ChunkedFileModelViewSet(viewsets.ModelViewSet):
             return Response({"error": "No chunks available for "
                                       "this master file"}, status=404)
 
-        combined_file_content = io.BytesIO()
-        for chunk in chunks:
-            with chunk.file.open('rb') as f:
-                combined_file_content.write(f.read())
-
-        combined_file_content.seek(0)
-        django_file = ContentFile(combined_file_content.read(),
-                                  name=master_file.file_name)
-        combined_file_content.close()
-        master_file.file.save(master_file.file_name, django_file)
-
-        response = HttpResponse(django_file,
-                                content_type='application/octet-stream')
-        response['Content-Disposition'] = f'attachment; ' \
-                                          f'filename="{master_file.file_name}"'
-        print(response['Content-Disposition'])
-        return response
+        tasks.schedule_merge(master_file.id)
+
+        master_file.refresh_from_db()
+        merged = master_file.status in (MasterFile.COMPLETED,
+                                        MasterFile.FAILED)
+        return Response(MergeStatusSerializer(master_file).data,
+                        status=200 if merged else 202)
+
+    @action(detail=False, methods=['get'], url_path='merge-status')
+    def merge_status(self, request):
+        master_file_id = request.query_params.get('master_file_id')
+        if not master_file_id:
+            return Response({"error": "master_file_id parameter is required"},
+                            status=400)
+
+        master_file = get_object_or_404(MasterFile, id=master_file_id)
+        return Response(MergeStatusSerializer(master_file).data)
 
     @action(detail=False, methods=['get'], url_path='download')
+    @track_download('file')
     def download_file(self, request):
         master_file_id = request.query_params.get('master_file_id')
         if not master_file_id:
             return Response({"error": "master_file_id parameter is required"},
                             status=400)
 
-        master_file = get_object_or_404(MasterFile,
-                                        id=master_file_id)
+        master_file = get_session_or_404(master_file_id)
 
-        if not master_file.file:
-            return Response({"error": "File not found for this master_file"},
-                            status=404)
+        if master_file.file:
+            return serve_master_file(request, master_file)
+        if master_file.is_complete():
+            return serve_chunks(request, master_file)
+        return Response({"error": "File not found for this master_file"},
+                        status=404)
 
-        with master_file.file.open('rb') as f:
-            response = HttpResponse(f.read(),
-                                    content_type='application/octet-stream')
-            response['Content-Disposition'] = (
-                f'attachment; filename="{master_file.file_name}"'
-            )
 
-        return response
+def get_session_or_404(master_file_id):
+    """``MasterFile.objects.get_session``, raising ``Http404`` on failure."""
+    try:
+        return MasterFile.objects.get_session(master_file_id)
+    except (MasterFile.DoesNotExist, TypeError, ValueError):
+        raise Http404
+
+
+def serve_master_file(request, master_file):
+    field_file = master_file.file
+    url = get_backend(field_file.storage).download_url(
+        field_file.name, master_file.file_name)
+    if url:
+        # The store serves the bytes, ranges included, from a signed URL.
+        return HttpResponseRedirect(url)
+    local = isinstance(field_file.storage, FileSystemStorage)
+    return serve_file(
+        request,
+        lambda: field_file.storage.open(field_file.name, 'rb'),
+        field_file.size,
+        master_file.file_name,
+        etag=master_file.md5_checksum,
+        offload_name=field_file.name,
+        offload_path=field_file.path if local else None,
+    )
+
+
+def serve_chunks(request, master_file):
+    """Serve a complete upload straight from its chunks, without merging."""
+    if master_file.assembly_file:
+        return serve_file(
+            request, lambda: assembly.open_assembled(master_file)[0],
+            master_file.file_size, master_file.file_name,
+            etag=master_file.md5_checksum)
+    stream = ChunkStream(master_file.chunkedfile_set.select_related(
+        'blob').order_by('chunk_number'))
+    return serve_file(request, lambda: stream, stream.size,
+                      master_file.file_name, etag=master_file.md5_checksum)
+
+
+def direct_upload_request(request, master_file, chunk_number, digest):
+    """Signed request to ``direct-upload`` storing one chunk's bytes."""
+    max_size = master_file.expected_chunk_size(chunk_number) or \
+        settings.CHUNK_SIZE
+    token = signing.dumps({"digest": digest, "max_size": max_size},
+                          salt=DIRECT_UPLOAD_SALT)
+    url = f'{reverse("chunkedfile-direct-upload")}?' \
+          f'{urlencode({"token": token})}'
+    return {
+        "url": request.build_absolute_uri(url),
+        "method": "PUT",
+        "headers": {},
+    }
@@ -0,0 +1,81 @@
+// Content-defined chunking (FastCDC style), the same algorithm as
+// upload/chunking.py. Both must produce identical boundaries, so a change
+// here has to be mirrored there.
+
+const CDC = {
+    minSize: 1024 * 1024,     // Same as CDC_MIN_SIZE in XDrive/settings.py
+    avgSize: 4 * 1024 * 1024, // Same as CDC_AVG_SIZE
+    maxSize: 8 * 1024 * 1024, // Same as CDC_MAX_SIZE
+};
+
+const CDC_GEAR = (() => {
+    // xorshift32 from a fixed seed, see _gear_table in upload/chunking.py
+    const table = new Uint32Array(256);
+    let state = 0x2545F491;
+    for (let i = 0; i < 256; i++) {
+        state ^= state << 13;
+        state ^= state >>> 17;
+        state ^= state << 5;
+        table[i] = state >>> 0;
+    }
+    return table;
+})();
+
+function cdcHighBits(count) {
+    return (((2 ** count) - 1) * (2 ** (32 - count))) >>> 0;
+}
+
+function cdcCutPoint(data, { minSize, avgSize, maxSize } = CDC) {
+    // Length of the chunk starting at data[0]; data must hold at least
+    // maxSize bytes unless it is the end of the file.
+    const size = data.length;
+    if (size <= minSize) {
+        return size;
+    }
+    const end = Math.min(size, maxSize);
+    const normal = Math.min(end, avgSize);
+    const bits = Math.floor(Math.log2(avgSize));
+    const maskSmall = cdcHighBits(bits + 1);
+    const maskLarge = cdcHighBits(bits - 1);
+    let fingerprint = 0;
+    let i = minSize;
+    for (; i < normal; i++) {
+        fingerprint = ((fingerprint << 1) + CDC_GEAR[data[i]]) >>> 0;
+        if ((fingerprint & maskSmall) === 0) {
+            return i + 1;
+        }
+    }
+    for (; i < end; i++) {
+        fingerprint = ((fingerprint << 1) + CDC_GEAR[data[i]]) >>> 0;
+        if ((fingerprint & maskLarge) === 0) {
+            return i + 1;
+        }
+    }
+    return end;
+}
+
+function cdcBoundaries(blob, readSlice, params = CDC) {
+    // End offset of every chunk of blob. readSlice(blob, start, end) returns
+    // the bytes as a Uint8Array; at most maxSize bytes are read at once.
+    const boundaries = [];
+    let offset = 0;
+    while (offset < blob.size) {
+        const data = readSlice(blob, offset, Math.min(blob.size, offset + params.maxSize));
+        offset += cdcCutPoint(data, params);
+        boundaries.push(offset);
+    }
+    return boundaries;
+}
+
+async function cdcBoundariesAsync(blob, params = CDC) {
+    // Main-thread variant of cdcBoundaries for browsers without workers
+    const boundaries = [];
+    let offset = 0;
+    while (offset < blob.size) {
+        const slice = blob.slice(offset, Math.min(blob.size, offset + params.maxSize));
+        const data = new Uint8Array(await slice.arrayBuffer());
+        offset += cdcCutPoint(data, params);
+        boundaries.push(offset);
+    }
+    return boundaries;
+}
@@ -0,0 +1,34 @@
+// Computes chunk digests and content-defined chunk boundaries off the main
+// thread so hashing overlaps with uploads.
+importScripts('https://cdnjs.cloudflare.com/ajax/libs/crypto-js/4.0.0/crypto-js.min.js', 'cdc.js');
+
+const SLICE_SIZE = 4 * 1024 * 1024;
+const ALGORITHMS = { md5: CryptoJS.algo.MD5, sha256: CryptoJS.algo.SHA256 };
+
+function digestsOfBlob(blob, algorithms) {
+    // Hash in slices so a whole file never has to be held in memory at once
+    const reader = new FileReaderSync();
+    const hashers = algorithms.map((name) => ALGORITHMS[name].create());
+    for (let offset = 0; offset < blob.size; offset += SLICE_SIZE) {
+        const buffer = reader.readAsArrayBuffer(blob.slice(offset, offset + SLICE_SIZE));
+        const words = CryptoJS.lib.WordArray.create(buffer);
+        hashers.forEach((hasher) => hasher.update(words));
+    }
+    return Object.fromEntries(algorithms.map((name, i) => [name, hashers[i].finalize().toString()]));
+}
+
+function readSlice(blob, start, end) {
+    return new Uint8Array(new FileReaderSync().readAsArrayBuffer(blob.slice(start, end)));
+}
+
+self.onmessage = (event) => {
+    const { id, blob, algorithms, chunking } = event.data;
+    try {
+        const result = chunking
+            ? cdcBoundaries(blob, readSlice, chunking)
+            : digestsOfBlob(blob, algorithms);
+        self.postMessage({ id, result });
+    } catch (error) {
+        self.postMessage({ id, error: String(error) });
+    }
+};
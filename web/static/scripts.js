@@ -94,13 +94,13 @@ function getCsrfToken() {
     return csrfTokenElement.value;
 }
 
-function calculateMd5(blob) {
+function calculateDigests(blob, algorithms) {
     return new Promise((resolve, reject) => {
         const reader = new FileReader();
         reader.onload = function(event) {
-            const data = event.target.result;
-            const md5 = CryptoJS.MD5(CryptoJS.enc.Latin1.parse(data)).toString();
-            resolve(md5);
+            const data = CryptoJS.enc.Latin1.parse(event.target.result);
+            const hash = { md5: CryptoJS.MD5, sha256: CryptoJS.SHA256 };
+            resolve(Object.fromEntries(algorithms.map((name) => [name, hash[name](data).toString()])));
         };
         reader.onerror = function() {
             reject('File read error');
@@ -109,12 +109,238 @@ function calculateMd5(blob) {
     });
 }
 
-async function createMasterFile(fileName, totalChunks, md5Checksum, csrfToken) {
+const CHUNK_SIZE = 5 * 1024 * 1024; // Same as CHUNK_SIZE in XDrive/settings.py
+// 'fixed' splits files every chunk_size bytes, as negotiated with the server
+// (CHUNK_SIZE for uploads created without it); 'cdc' picks boundaries from
+// the content (cdc.js) so edited versions of a file still share most chunks.
+const CHUNKING_MODE = 'fixed';
+const UPLOAD_CONCURRENCY = { initial: 3, min: 1, max: 8 };
+const CONCURRENCY_WINDOW_MS = 2000;
+const CHUNK_MAX_ATTEMPTS = 5;
+const RETRY_BASE_DELAY_MS = 500;
+// Chunks hashed and checked against the stored ones per preflight request;
+// the missing chunks of a batch upload while the next batch is hashed.
+const PREFLIGHT_BATCH_SIZE = 32;
+// Upload rate measured by the last upload, in bytes per second, sent to the
+// server to negotiate the chunk size of the next one.
+const THROUGHPUT_KEY = 'xdrive.uploadThroughput';
+// Send chunk bytes straight to storage through presigned URLs; Django only
+// records them (presign/commit endpoints).
+const DIRECT_UPLOAD = false;
+const MD5_WORKER_URL = document.currentScript
+    ? document.currentScript.src.replace(/scripts\.js(\?.*)?$/, 'md5_worker.js')
+    : '/static/md5_worker.js';
+
+class Md5Hasher {
+    // Hashes blobs in a small pool of Web Workers, or on the main thread
+    // when workers are not available.
+    constructor(size = Math.min(navigator.hardwareConcurrency || 2, 4)) {
+        this.workers = [];
+        this.pending = new Map();
+        this.nextId = 0;
+        if (typeof Worker === 'undefined') {
+            return;
+        }
+        for (let i = 0; i < size; i++) {
+            const worker = new Worker(MD5_WORKER_URL);
+            worker.onmessage = (event) => this.onResult(event.data);
+            this.workers.push(worker);
+        }
+    }
+
+    hash(blob) {
+        return this.digests(blob, ['md5']).then(({ md5 }) => md5);
+    }
+
+    digests(blob, algorithms = ['md5', 'sha256']) {
+        if (this.workers.length === 0) {
+            return calculateDigests(blob, algorithms);
+        }
+        return this.post({ blob, algorithms });
+    }
+
+    boundaries(blob) {
+        // Content-defined chunk boundaries, see cdc.js
+        if (this.workers.length === 0) {
+            return cdcBoundariesAsync(blob);
+        }
+        return this.post({ blob, chunking: CDC });
+    }
+
+    post(message) {
+        const id = this.nextId++;
+        const worker = this.workers[id % this.workers.length];
+        return new Promise((resolve, reject) => {
+            this.pending.set(id, { resolve, reject });
+            worker.postMessage({ id, ...message });
+        });
+    }
+
+    onResult({ id, result, error }) {
+        const { resolve, reject } = this.pending.get(id);
+        this.pending.delete(id);
+        error ? reject(new Error(error)) : resolve(result);
+    }
+
+    terminate() {
+        this.workers.forEach((worker) => worker.terminate());
+    }
+}
+
+class ConcurrencyController {
+    // Hill-climbs the number of in-flight chunk POSTs: keeps moving in the
+    // same direction while throughput improves, turns around when it drops
+    // and halves the limit when requests fail.
+    constructor({ initial, min, max }) {
+        this.limit = initial;
+        this.min = min;
+        this.max = max;
+        this.direction = 1;
+        this.lastThroughput = 0;
+        this.resetWindow();
+    }
+
+    resetWindow() {
+        this.windowStart = performance.now();
+        this.windowBytes = 0;
+        this.windowChunks = 0;
+    }
+
+    recordSuccess(bytes) {
+        this.windowBytes += bytes;
+        this.windowChunks++;
+        const elapsed = performance.now() - this.windowStart;
+        if (elapsed < CONCURRENCY_WINDOW_MS || this.windowChunks < this.limit) {
+            return;
+        }
+        const throughput = this.windowBytes / elapsed;
+        if (throughput < this.lastThroughput) {
+            this.direction = -this.direction;
+        }
+        this.lastThroughput = throughput;
+        this.limit = Math.min(this.max, Math.max(this.min, this.limit + this.direction));
+        this.resetWindow();
+    }
+
+    recordFailure() {
+        this.limit = Math.max(this.min, Math.floor(this.limit / 2));
+        this.direction = 1;
+        this.resetWindow();
+    }
+}
+
+function sleep(ms) {
+    return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+function isRetryable(error) {
+    const response = error.cause && error.cause.response;
+    if (!response) {
+        return true; // Network error or timeout
+    }
+    if (response.data && response.data.retryable) {
+        return true; // e.g. the chunk arrived corrupted and failed its checksum
+    }
+    return response.status >= 500 || response.status === 408 || response.status === 429;
+}
+
+function getChunkNumbers(totalChunks) {
+    return Array.from({ length: totalChunks }, (_, i) => i);
+}
+
+function fixedBoundaries(size, chunkSize = CHUNK_SIZE) {
+    const totalChunks = Math.max(1, Math.ceil(size / chunkSize));
+    return Array.from({ length: totalChunks }, (_, i) => Math.min(size, (i + 1) * chunkSize));
+}
+
+function getMeasuredThroughput() {
+    const throughput = Number(localStorage.getItem(THROUGHPUT_KEY));
+    return throughput > 0 ? throughput : undefined;
+}
+
+function saveMeasuredThroughput(bytes, startedAt) {
+    const seconds = (performance.now() - startedAt) / 1000;
+    if (bytes > 0 && seconds > 0) {
+        localStorage.setItem(THROUGHPUT_KEY, String(Math.round(bytes / seconds)));
+    }
+}
+
+function chunkSlicer(file, boundaries) {
+    return (i) => file.slice(i ? boundaries[i - 1] : 0, boundaries[i]);
+}
+
+async function uploadChunkWithRetry(masterFileId, chunk, chunkNumber, hasher, controller, csrfToken, known, sendChunk) {
+    if (!known.has(chunkNumber)) {
+        known.set(chunkNumber, await hasher.digests(chunk));
+    }
+    const { md5: chunkMd5 } = known.get(chunkNumber);
+    for (let attempt = 1; ; attempt++) {
+        try {
+            await sendChunk(masterFileId, chunk, chunkNumber, chunkMd5, csrfToken);
+            controller.recordSuccess(chunk.size);
+            return;
+        } catch (error) {
+            controller.recordFailure();
+            if (attempt >= CHUNK_MAX_ATTEMPTS || !isRetryable(error)) {
+                throw error;
+            }
+            const delay = RETRY_BASE_DELAY_MS * 2 ** (attempt - 1);
+            console.warn(`Reintentando chunk ${chunkNumber} en ${delay} ms (intento ${attempt + 1})`);
+            await sleep(delay * (0.5 + Math.random()));
+        }
+    }
+}
+
+function uploadChunks(masterFileId, chunkNumbers, getChunk, hasher, csrfToken, known = new Map(), sendChunk = uploadChunkToServer) {
+    // Uploads chunks in any order with up to `controller.limit` requests in
+    // flight. On failure rejects with `error.pendingChunks` listing the chunk
+    // numbers that were not uploaded. `known` maps chunk numbers to the
+    // { md5, sha256 } digests already computed.
+    const controller = new ConcurrencyController(UPLOAD_CONCURRENCY);
+    const queue = [...chunkNumbers];
+    const inFlight = new Set();
+    let failed = false;
+
+    return new Promise((resolve, reject) => {
+        const pump = () => {
+            if (failed) {
+                return;
+            }
+            if (queue.length === 0 && inFlight.size === 0) {
+                resolve();
+                return;
+            }
+            while (inFlight.size < controller.limit && queue.length > 0) {
+                const chunkNumber = queue.shift();
+                inFlight.add(chunkNumber);
+                uploadChunkWithRetry(masterFileId, getChunk(chunkNumber), chunkNumber, hasher, controller, csrfToken, known, sendChunk)
+                    .then(() => {
+                        inFlight.delete(chunkNumber);
+                        pump();
+                    })
+                    .catch((error) => {
+                        failed = true;
+                        error.pendingChunks = [...inFlight, ...queue];
+                        reject(error);
+                    });
+            }
+        };
+        pump();
+    });
+}
+
+async function createMasterFile(fileName, fileSize, md5Checksum, csrfToken, chunkingMode = 'fixed', chunkBoundaries = []) {
+    // Fixed-size uploads get their chunk size and number of chunks from the
+    // server, see MasterFileSerializer.
+    const fields = chunkingMode === 'cdc'
+        ? { number_of_chunks: chunkBoundaries.length, chunk_boundaries: chunkBoundaries }
+        : { file_size: fileSize, throughput: getMeasuredThroughput() };
     try {
         const response = await axios.post('/upload/masterfile/', {
             file_name: fileName,
             md5_checksum: md5Checksum,
-            number_of_chunks: totalChunks
+            chunking_mode: chunkingMode,
+            ...fields
         }, {
             headers: {
                 'X-CSRFToken': csrfToken
@@ -126,7 +352,14 @@ async function createMasterFile(fileName, totalChunks, md5Checksum, csrfToken) {
     }
 }
 
-let simulateNetworkFailureAfterChunks = 2; // Simular falla después de 3 chunks subidos
+async function getMasterFile(masterFileId) {
+    try {
+        const response = await axios.get(`/upload/masterfile/${masterFileId}/`);
+        return response.data;
+    } catch (error) {
+        handleError(error, 'Failed to fetch master file');
+    }
+}
 
 async function uploadChunkToServer(masterFileId, chunk, chunkNumber, chunkMd5, csrfToken) {
     const formData = new FormData();
@@ -147,6 +380,94 @@ async function uploadChunkToServer(masterFileId, chunk, chunkNumber, chunkMd5, c
     }
 }
 
+async function preflightChunks(masterFileId, batch, getChunk, hasher, csrfToken, known) {
+    // Sends the SHA-256 of each chunk of `batch`; the server keeps the chunks
+    // it already has from any upload and answers with the missing ones.
+    const chunks = await Promise.all(batch.map(async (chunkNumber) => {
+        const { md5, sha256 } = await hasher.digests(getChunk(chunkNumber));
+        known.set(chunkNumber, { md5, sha256 });
+        return { chunk_number: chunkNumber, digest: sha256, md5_checksum: md5 };
+    }));
+    try {
+        const response = await axios.post(`/upload/chunkedfile/preflight/?master_file_id=${masterFileId}`, { chunks }, {
+            headers: {
+                'X-CSRFToken': csrfToken
+            }
+        });
+        return response.data.missing;
+    } catch (error) {
+        handleError(error, 'Failed to check stored chunks');
+    }
+}
+
+async function uploadMissingChunks(masterFileId, chunkNumbers, getChunk, hasher, csrfToken) {
+    // Preflights the chunks PREFLIGHT_BATCH_SIZE at a time and uploads the
+    // missing ones of each batch while the next one is hashed and checked, so
+    // hashing and uploading overlap. Returns the chunk numbers uploaded; on
+    // failure rejects with `error.pendingChunks` like uploadChunks.
+    const known = new Map();
+    const sendChunk = DIRECT_UPLOAD ? directChunkSender(known) : uploadChunkToServer;
+    const batches = [];
+    for (let i = 0; i < chunkNumbers.length; i += PREFLIGHT_BATCH_SIZE) {
+        batches.push(chunkNumbers.slice(i, i + PREFLIGHT_BATCH_SIZE));
+    }
+    const uploaded = [];
+    let next = batches.length > 0 ? preflightChunks(masterFileId, batches[0], getChunk, hasher, csrfToken, known) : null;
+    for (let b = 0; b < batches.length; b++) {
+        let missing;
+        try {
+            missing = await next;
+        } catch (error) {
+            error.pendingChunks = batches.slice(b).flat();
+            throw error;
+        }
+        next = b + 1 < batches.length
+            ? preflightChunks(masterFileId, batches[b + 1], getChunk, hasher, csrfToken, known)
+            : null;
+        try {
+            await uploadChunks(masterFileId, missing, getChunk, hasher, csrfToken, known, sendChunk);
+        } catch (error) {
+            if (next) {
+                next.catch(() => {});
+            }
+            error.pendingChunks = [...(error.pendingChunks || []), ...batches.slice(b + 1).flat()];
+            throw error;
+        }
+        uploaded.push(...missing);
+    }
+    return uploaded;
+}
+
+function directChunkSender(known) {
+    // Sends a chunk to a presigned storage URL, then asks the server to
+    // record it. A chunk that did not reach storage intact is retried.
+    return async (masterFileId, chunk, chunkNumber, chunkMd5, csrfToken) => {
+        const { sha256 } = known.get(chunkNumber);
+        const headers = { 'X-CSRFToken': csrfToken };
+        try {
+            const presigned = await axios.post(`/upload/chunkedfile/presign/?master_file_id=${masterFileId}`, {
+                chunks: [{ chunk_number: chunkNumber, digest: sha256 }]
+            }, { headers });
+            const upload = presigned.data.uploads[0];
+            const sameOrigin = new URL(upload.url, window.location.href).origin === window.location.origin;
+            await axios({
+                method: upload.method,
+                url: upload.url,
+                data: chunk,
+                headers: { 'Content-Type': 'application/octet-stream', ...upload.headers, ...(sameOrigin ? headers : {}) }
+            });
+            const committed = await axios.post(`/upload/chunkedfile/commit/?master_file_id=${masterFileId}`, {
+                chunks: [{ chunk_number: chunkNumber, digest: sha256, md5_checksum: chunkMd5 }]
+            }, { headers });
+            if (committed.data.missing.length > 0) {
+                throw new Error(`Chunk ${chunkNumber} did not reach storage`);
+            }
+        } catch (error) {
+            handleError(error, 'Failed to upload chunk to storage');
+        }
+    };
+}
+
 async function getLastUploadedChunk(masterFileId) {
     try {
         const response = await axios.get(`/upload/chunkedfile/last-chunk/?master_file_id=${masterFileId}`);
@@ -162,13 +483,23 @@ async function getLastUploadedChunk(masterFileId) {
     }
 }
 
+async function getMissingChunks(masterFileId) {
+    try {
+        const response = await axios.get(`/upload/chunkedfile/missing-chunks/?master_file_id=${masterFileId}`);
+        return response.data.missing.flatMap(([start, end]) =>
+            Array.from({ length: end - start + 1 }, (_, i) => start + i));
+    } catch (error) {
+        handleError(error, 'Failed to fetch missing chunks');
+    }
+}
+
 function handleError(error, message) {
     if (error.response) {
         console.error(`${message}: ${error.response.data}`);
     } else {
         console.error(`${message}: Network Error`);
     }
-    throw new Error(message);
+    throw new Error(message, { cause: error });
 }
 
 async function updateMasterFileStatus(masterFileId, status, csrfToken) {
@@ -187,8 +518,9 @@ async function updateMasterFileStatus(masterFileId, status, csrfToken) {
 }
 
 async function mergeChunks(masterFileId, csrfToken) {
+    // The server merges in the background and answers with the merge status
     try {
-        const response = await axios.get(`/upload/chunkedfile/merge-chunks/?master_file_id=${masterFileId}`, null, {
+        const response = await axios.post(`/upload/chunkedfile/merge-chunks/?master_file_id=${masterFileId}`, null, {
             headers: {
                 'X-CSRFToken': csrfToken
             }
@@ -199,52 +531,66 @@ async function mergeChunks(masterFileId, csrfToken) {
     }
 }
 
-async function uploadFile(event, masterFileId = null, startChunk = 0) {
+async function getMergeStatus(masterFileId) {
+    try {
+        const response = await axios.get(`/upload/chunkedfile/merge-status/?master_file_id=${masterFileId}`);
+        return response.data;
+    } catch (error) {
+        handleError(error, 'Failed to fetch merge status');
+    }
+}
+
+async function uploadFile(event, masterFileId = null) {
     console.log("1 - Iniciando función uploadFile");
     event.preventDefault();
 
+    const hasher = new Md5Hasher();
     try {
         const fileInput = document.getElementById(masterFileId ? `file-input-${masterFileId}` : 'file');
         const file = fileInput.files[0];
-        const totalChunks = 5; // Dividir en 5 partes
-        const chunkSize = Math.ceil(file.size / totalChunks); // Tamaño de cada chunk
         const csrfToken = getCsrfToken();
-        const fileMd5 = await calculateMd5(file);
+        let chunkNumbers;
+        let boundaries;
 
         if (!masterFileId) {
-            const masterFile = await createMasterFile(file.name, totalChunks, fileMd5, csrfToken);
+            const chunkingMode = file.size > 0 ? CHUNKING_MODE : 'fixed';
+            const cdcBoundaries = chunkingMode === 'cdc' ? await hasher.boundaries(file) : [];
+            const fileMd5 = await hasher.hash(file);
+            const masterFile = await createMasterFile(file.name, file.size, fileMd5, csrfToken, chunkingMode, cdcBoundaries);
             masterFileId = masterFile.id;
+            boundaries = chunkingMode === 'cdc' ? cdcBoundaries : fixedBoundaries(file.size, masterFile.chunk_size);
+            chunkNumbers = getChunkNumbers(boundaries.length);
         } else {
-            const lastUploadedChunk = await getLastUploadedChunk(masterFileId);
-            startChunk = lastUploadedChunk ? lastUploadedChunk + 1 : 0;
+            const masterFile = await getMasterFile(masterFileId);
+            boundaries = masterFile.chunking_mode === 'cdc'
+                ? masterFile.chunk_boundaries
+                : fixedBoundaries(file.size, masterFile.chunk_size || CHUNK_SIZE);
+            chunkNumbers = await getMissingChunks(masterFileId);
         }
+        const totalChunks = boundaries.length;
 
-        for (let i = startChunk; i < totalChunks; i++) {
-            const chunk = file.slice(i * chunkSize, (i + 1) * chunkSize);
-            const chunkMd5 = await calculateMd5(chunk);
-            console.log(`2 - Subiendo chunk ${i + 1} de ${totalChunks} con MD5: ${chunkMd5}`);
-            try {
-                await uploadChunkToServer(masterFileId, chunk, i, chunkMd5, csrfToken);
-            } catch (error) {
-                console.warn(`Error subiendo chunk ${i + 1}, almacenando en IndexedDB para reanudar luego`);
-                // Almacenar todos los chunks faltantes en IndexedDB
-                for (let j = i; j < totalChunks; j++) {
-                    const remainingChunk = file.slice(j * chunkSize, (j + 1) * chunkSize);
-                    await storeChunkInIndexedDB(masterFileId, file.name, remainingChunk, j);
-                }
-                throw error;
-            }
-            if (i === startChunk) {
-                await updateMasterFileStatus(masterFileId, 'in_progress', csrfToken);
+        await updateMasterFileStatus(masterFileId, 'in_progress', csrfToken);
+        const getChunk = chunkSlicer(file, boundaries);
+        console.log(`2 - Subiendo hasta ${chunkNumbers.length} de ${totalChunks} chunks`);
+        const startedAt = performance.now();
+        try {
+            const uploaded = await uploadMissingChunks(masterFileId, chunkNumbers, getChunk, hasher, csrfToken);
+            saveMeasuredThroughput(uploaded.reduce((bytes, i) => bytes + getChunk(i).size, 0), startedAt);
+        } catch (error) {
+            console.warn('Error subiendo chunks, almacenando los pendientes en IndexedDB para reanudar luego');
+            for (const chunkNumber of error.pendingChunks || []) {
+                await storeChunkInIndexedDB(masterFileId, file.name, getChunk(chunkNumber), chunkNumber);
             }
+            throw error;
         }
         await mergeChunks(masterFileId, csrfToken);
-        await updateMasterFileStatus(masterFileId, 'completed', csrfToken);
         await clearChunksFromIndexedDB(masterFileId); //
 
         console.log('4 - Archivo subido exitosamente!');
     } catch (error) {
         console.error('Error durante la subida del archivo:', error);
+    } finally {
+        hasher.terminate();
     }
 }
 
@@ -269,24 +615,23 @@ async function printIndexedDBContents() {
 
     async function resumeUpload(event, masterFileId) {
         event.preventDefault();
-        const csrfToken = getCsrfTokened();
+        const csrfToken = getCsrfToken();
 
         const storedChunks = await getChunksFromIndexedDB(masterFileId);
         if (storedChunks.length > 0) {
-            console.log(`Reanudando la carga desde IndexedDB, chunk ${storedChunks[0].chunkNumber + 1}`);
-            for (const {fileId, chunkNumber, chunk } of storedChunks) {
-                const chunkMd5 = await calculateMd5(chunk);
-                console.log(`Subiendo chunk ${chunkNumber + 1} desde IndexedDB`);
-                console.log("MasterFileId : "+fileId)
-                console.log("File : "+chunk)
-                console.log("ChunkNumber : "+chunkNumber)
-                console.log("ChunkMd5 : "+chunkMd5)
-                console.log("CsrfToken : "+csrfToken)
-                await uploadChunkToServer(fileId, chunk, chunkNumber, chunkMd5, csrfToken);
-
+            // Only chunks the server reports as missing are sent again
+            const missing = new Set(await getMissingChunks(masterFileId));
+            const chunks = new Map(storedChunks
+                .filter(({ chunkNumber }) => missing.has(chunkNumber))
+                .map(({ chunkNumber, chunk }) => [chunkNumber, chunk]));
+            console.log(`Reanudando la carga desde IndexedDB, ${chunks.size} chunks pendientes`);
+            const hasher = new Md5Hasher();
+            try {
+                await uploadChunks(Number(masterFileId), [...chunks.keys()], (i) => chunks.get(i), hasher, csrfToken);
+            } finally {
+                hasher.terminate();
             }
             await mergeChunks(masterFileId, csrfToken);
-            await updateMasterFileStatus(masterFileId, 'completed', csrfToken);
             await clearChunksFromIndexedDB(masterFileId);
         }
     }
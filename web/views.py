@@ -1,5 +1,8 @@
+from django.http import Http404
 from django.shortcuts import render
+from upload.filters import MasterFileFilter
 from upload.models import MasterFile
+from upload.pagination import keyset_page
 
 
 def home_page(request):
@@ -7,7 +10,20 @@ def home_page(request):
 
 
 def masterFileListView(request):
-    master_files = MasterFile.objects.all()
+    queryset = MasterFileFilter(request.GET, MasterFile.objects.only(
+        'id', 'file', 'file_name', 'md5_checksum', 'number_of_chunks',
+        'uploaded_at', 'status')).qs
+    try:
+        master_files, next_cursor = keyset_page(queryset,
+                                                request.GET.get('cursor'))
+    except ValueError:
+        raise Http404('Invalid cursor')
+    next_query = None
+    if next_cursor:
+        params = request.GET.copy()
+        params['cursor'] = next_cursor
+        next_query = params.urlencode()
     return render(
-        request, "components/list.html", {"master_files": master_files}
+        request, "components/list.html",
+        {"master_files": master_files, "next_query": next_query}
     )